@@ -0,0 +1,6 @@
+"""Performance benchmarks for KU Polls.
+
+Each benchmark is a standalone script, run from the project directory with
+``python -m benchmarks.<name>``. Benchmarks run against a throwaway test
+database, so they never touch the data of the configured database.
+"""
@@ -0,0 +1,92 @@
+"""Votes per second through the batch vote API and through the vote form.
+
+Uploads --votes votes to /polls/votes/ in batches of each --batch size,
+then posts the same number of votes one at a time to the vote form, both
+through the test client, and reports the votes recorded per second and
+the queries per request.
+
+Usage: python -m benchmarks.batch_votes [--votes 5000] [--batch 1 100 1000 5000]
+"""
+import argparse
+import contextlib
+import time
+
+from benchmarks import harness
+
+
+@contextlib.contextmanager
+def count_queries():
+    """Count the queries run in the block, in the list it yields."""
+    from django.db import connection
+
+    count = [0]
+
+    def counting(execute, sql, params, many, context):
+        count[0] += 1
+        return execute(sql, params, many, context)
+
+    with connection.execute_wrapper(counting):
+        yield count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--votes', type=int, default=5000, help='votes per run')
+    parser.add_argument('--batch', type=int, nargs='+', default=[1, 100, 1000, 5000],
+                        help='batch sizes to upload')
+    parser.add_argument('--choices', type=int, default=4, help='choices of the question')
+    args = parser.parse_args()
+
+    harness.setup()
+    from django.contrib.auth.models import Permission, User
+    from django.test import Client
+    from django.urls import reverse
+    from polls.models import Choice, Question
+
+    with harness.test_database():
+        users = User.objects.bulk_create(User(username=f'bench{i}') for i in range(args.votes))
+        kiosk = User.objects.create(username='kiosk')
+        kiosk.user_permissions.add(Permission.objects.get(codename='add_vote'))
+        client = Client()
+        client.force_login(kiosk)
+
+        print(f"{'mode':>12} {'requests':>9} {'votes/s':>9} {'queries/request':>16}")
+
+        def report(mode, requests, elapsed, queries):
+            print(f"{mode:>12} {requests:>9} {args.votes / elapsed:>9.1f} "
+                  f"{queries / requests:>16.1f}")
+
+        for size in args.batch:
+            question = Question.objects.create(question_text=f'Batches of {size}')
+            choices = Choice.objects.bulk_create(
+                Choice(question=question, choice_text=f'Choice {i}') for i in range(args.choices))
+            records = [{'user': user.username, 'question': question.pk,
+                        'choice': choices[i % len(choices)].pk} for i, user in enumerate(users)]
+            batches = [records[start:start + size] for start in range(0, len(records), size)]
+            with count_queries() as queries:
+                start = time.perf_counter()
+                for batch in batches:
+                    client.post(reverse('polls:batch_vote'), {'votes': batch},
+                                content_type='application/json')
+                elapsed = time.perf_counter() - start
+            report(f'batch {size}', len(batches), elapsed, queries[0])
+
+        question = Question.objects.create(question_text='Vote form')
+        choices = Choice.objects.bulk_create(Choice(question=question, choice_text=f'Choice {i}')
+                                             for i in range(args.choices))
+        voters = []
+        for user in users:
+            voter = Client()
+            voter.force_login(user)
+            voters.append(voter)
+        with count_queries() as queries:
+            start = time.perf_counter()
+            for i, voter in enumerate(voters):
+                voter.post(reverse('polls:vote', args=(question.pk,)),
+                           {'choice': choices[i % len(choices)].pk})
+            elapsed = time.perf_counter() - start
+        report('vote form', len(voters), elapsed, queries[0])
+
+
+if __name__ == '__main__':
+    main()
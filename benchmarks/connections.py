@@ -0,0 +1,87 @@
+"""Database connection cost per request, with and without reuse.
+
+Serves the same read-heavy workload with a new database connection per
+request (CONN_MAX_AGE = 0), with persistent connections, and, when
+psycopg_pool is installed, with a connection pool. Like a WSGI server,
+it closes expired connections when each request starts and finishes.
+Connections to an in-memory SQLite database are never closed, so run it
+against PostgreSQL.
+
+Usage: python -m benchmarks.connections [--requests 1000]
+"""
+import argparse
+import importlib.util
+import time
+
+from benchmarks import harness
+
+MODES = {
+    'per-request': {'CONN_MAX_AGE': 0, 'pool': False},
+    'persistent': {'CONN_MAX_AGE': 60, 'pool': False},
+    'pool': {'CONN_MAX_AGE': 0, 'pool': {'min_size': 1, 'max_size': 4}},
+}
+
+
+def configure(connection, mode):
+    """Switch the default connection to one of MODES."""
+    connection.close()
+    connection.settings_dict['CONN_MAX_AGE'] = MODES[mode]['CONN_MAX_AGE']
+    if connection.vendor == 'postgresql':
+        connection.close_pool()
+        connection.settings_dict['OPTIONS']['pool'] = MODES[mode]['pool']
+
+
+def run(client, urls, repeat):
+    from django.db import close_old_connections
+
+    samples = []
+    for _ in range(repeat):
+        for url in urls:
+            start = time.perf_counter()
+            close_old_connections()
+            client.get(url)
+            close_old_connections()
+            samples.append(time.perf_counter() - start)
+    return samples
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--requests', type=int, default=1000, help='requests per mode')
+    args = parser.parse_args()
+
+    harness.setup()
+    from django.db import connection
+    from django.test import Client
+    from polls import instrumentation
+    from polls.models import Choice, Question
+
+    with harness.test_database():
+        question = Question.objects.create(question_text='Question')
+        Choice.objects.bulk_create(Choice(question=question, choice_text=f'Choice {i}')
+                                   for i in range(4))
+        urls = ['/polls/', f'/polls/{question.id}/results/', f'/polls/{question.id}/results.json']
+        client = Client()
+        modes = list(MODES)
+        if connection.vendor != 'postgresql' or not importlib.util.find_spec('psycopg_pool'):
+            modes.remove('pool')
+
+        print(f"{'mode':>12} {'req/s':>9} {'p50 ms':>9} {'p99 ms':>9} {'opened/req':>11}")
+        for mode in modes:
+            configure(connection, mode)
+            run(client, urls, 5)
+            instrumentation.reset()
+            start = time.perf_counter()
+            samples = run(client, urls, max(1, args.requests // len(urls)))
+            elapsed = time.perf_counter() - start
+            stats = harness.summarize(samples)
+            usage = instrumentation.connection_usage()['databases']['default']
+            print(f"{mode:>12} {len(samples) / elapsed:>9.1f} {stats['p50_ms']:>9.2f} "
+                  f"{stats['p99_ms']:>9.2f} {usage['opened_per_request']:>11.2f}")
+            if usage['pool']:
+                print(f"{'':>12} pool: {usage['pool']}")
+        configure(connection, 'persistent')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+"""Vote throughput on one hot poll, with single-row and sharded counters.
+
+Concurrent workers each cast new votes on the same choice of one
+question, with the persisted vote counters on: first with one counter
+row per choice, where every vote waits for the row lock of the vote
+before it, then with the counters spread over --shards rows. The vote
+trends are off, as their minute rollup is a single row per choice that
+both runs would wait on. Each worker has its own database connection and
+commits every vote, like a request would. Run it against PostgreSQL;
+SQLite locks the whole database for each write, so sharding can't help
+there.
+
+Usage: python -m benchmarks.counters [--votes 5000] [--concurrency 16] [--shards 16]
+"""
+import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks import harness
+
+
+def run(votes_by_worker):
+    """Cast every worker's votes in its own thread; return the elapsed time and samples."""
+    from django.db import connection
+    from polls.voting import cast_vote
+
+    def work(votes):
+        samples = []
+        try:
+            for user, choice in votes:
+                start = time.perf_counter()
+                cast_vote(user, choice)
+                samples.append(time.perf_counter() - start)
+        finally:
+            connection.close()
+        return samples
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(len(votes_by_worker)) as executor:
+        outcomes = list(executor.map(work, votes_by_worker))
+    return time.perf_counter() - start, [sample for samples in outcomes for sample in samples]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--votes', type=int, default=5000, help='votes per mode')
+    parser.add_argument('--concurrency', type=int, default=16, help='concurrent workers')
+    parser.add_argument('--shards', type=int, default=16, help='counter rows per choice when sharded')
+    args = parser.parse_args()
+
+    harness.setup()
+    from django.contrib.auth.models import User
+    from django.db import connection
+    from django.test.utils import override_settings
+    from polls.counters import vote_count_with_shards
+    from polls.models import Choice, Question
+
+    with harness.test_database(), \
+            override_settings(POLLS_VOTE_COUNTERS=True, POLLS_VOTE_TRENDS=False):
+        if connection.vendor != 'postgresql':
+            print(f"Running on {connection.vendor}, which serializes writes; "
+                  f"use PostgreSQL to see the effect of sharding.")
+        users = User.objects.bulk_create(User(username=f'bench{i}') for i in range(args.votes))
+
+        print(f"{'mode':>12} {'votes':>7} {'votes/s':>9} {'p50 ms':>9} {'p99 ms':>9} {'counted':>8}")
+        for mode, shards in (('single row', 0), (f'{args.shards} shards', args.shards)):
+            question = Question.objects.create(question_text=f'Hot question ({mode})',
+                                               counter_shards=shards)
+            choice = Choice.objects.create(question=question, choice_text='Hot choice')
+            votes = [[] for _ in range(args.concurrency)]
+            for i, user in enumerate(users):
+                votes[i % args.concurrency].append((user, choice))
+            elapsed, samples = run(votes)
+            stats = harness.summarize(samples)
+            counted = Choice.objects.annotate(total=vote_count_with_shards()).get(pk=choice.pk).total
+            print(f"{mode:>12} {len(samples):>7} {len(samples) / elapsed:>9.1f} "
+                  f"{stats['p50_ms']:>9.2f} {stats['p99_ms']:>9.2f} {counted:>8}")
+
+
+if __name__ == '__main__':
+    main()
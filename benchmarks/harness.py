@@ -0,0 +1,59 @@
+"""Shared helpers for the KU Polls benchmark scripts."""
+import contextlib
+import os
+import statistics
+import time
+
+import django
+
+
+def setup():
+    """Configure Django so the benchmark can use the ORM and test client."""
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'mysite.settings')
+    django.setup()
+
+
+@contextlib.contextmanager
+def test_database():
+    """
+    Create a test database for the duration of the block and destroy it
+    afterwards, the same way `manage.py test` does.
+    """
+    from django.db import connection
+    from django.test.utils import setup_test_environment, teardown_test_environment
+
+    setup_test_environment()
+    old_name = connection.settings_dict['NAME']
+    connection.creation.create_test_db(verbosity=0)
+    try:
+        yield
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        teardown_test_environment()
+
+
+def time_calls(func, repeat):
+    """Call `func` `repeat` times and return each call's duration in seconds."""
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def percentile(samples, percent):
+    """Return the `percent` percentile of `samples` (nearest rank)."""
+    ordered = sorted(samples)
+    index = max(0, min(len(ordered) - 1, round(percent / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def summarize(samples):
+    """Summarize durations in seconds as mean/p50/p95/p99 in milliseconds."""
+    return {
+        'mean_ms': statistics.fmean(samples) * 1000,
+        'p50_ms': percentile(samples, 50) * 1000,
+        'p95_ms': percentile(samples, 95) * 1000,
+        'p99_ms': percentile(samples, 99) * 1000,
+    }
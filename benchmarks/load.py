@@ -0,0 +1,271 @@
+"""Load test of the poll pages with concurrent simulated users.
+
+Seeds a synthetic dataset into a throwaway test database, then logged-in
+simulated users browse the index, detail and results pages and vote,
+each worker thread driving its users one request at a time through the
+test Client. With --url it drives a running server instead, over HTTP,
+using the users and questions that `manage.py seed_polls` put in the
+database the settings point to.
+
+It reports throughput, p50/p95/p99 latency and queries per request for
+each endpoint, from the request metrics (on a server, /metrics must be
+enabled for the query counts). --output saves the report as JSON and
+--baseline compares it with an earlier saved report. Concurrent votes
+need a database that takes concurrent writes, such as PostgreSQL; on
+SQLite run it with --concurrency 1.
+
+Usage: python -m benchmarks.load [--requests 2000] [--concurrency 10] [--output run.json]
+       python -m benchmarks.load --url http://127.0.0.1:8000 [--prefix bench]
+"""
+import argparse
+import datetime
+import json
+import random
+import re
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from http.cookiejar import CookieJar
+
+from benchmarks import harness
+
+ENDPOINTS = ('index', 'detail', 'results', 'vote')
+
+
+def parse_mix(text):
+    """Parse 'index=30,detail=20,...' into {endpoint: weight}."""
+    mix = {}
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        if name not in ENDPOINTS:
+            raise argparse.ArgumentTypeError(f"unknown endpoint {name!r}")
+        mix[name] = float(weight)
+    return mix
+
+
+def build_workload(args, questions, users):
+    """Return, per worker, a list of (user index, endpoint, url, post data)."""
+    rng = random.Random(args.seed)
+    names, weights = zip(*args.mix.items())
+    workers = [[] for _ in range(args.concurrency)]
+    for _ in range(args.requests):
+        user = rng.randrange(users)
+        endpoint = rng.choices(names, weights)[0]
+        question, choice_ids = rng.choice(questions)
+        if endpoint == 'index':
+            request = (user, endpoint, '/polls/', None)
+        elif endpoint == 'vote':
+            request = (user, endpoint, f'/polls/{question}/vote/', {'choice': rng.choice(choice_ids)})
+        else:
+            path = '' if endpoint == 'detail' else 'results/'
+            request = (user, endpoint, f'/polls/{question}/{path}', None)
+        workers[user % args.concurrency].append(request)
+    return workers
+
+
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+class HttpUser:
+    """A user of a running server, logged in with a session cookie."""
+
+    def __init__(self, base_url, username, password):
+        self.base_url = base_url.rstrip('/')
+        self.cookies = CookieJar()
+        self.opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(self.cookies),
+                                                  _NoRedirect)
+        self.request('/accounts/login/')
+        status = self.request('/accounts/login/', {'username': username, 'password': password})
+        if status != 302:
+            raise RuntimeError(f"Could not log in as {username} (status {status})")
+
+    def csrf_token(self):
+        return next((cookie.value for cookie in self.cookies if cookie.name == 'csrftoken'), '')
+
+    def request(self, path, data=None):
+        """Make a request and return its status code, without following redirects."""
+        url = self.base_url + path
+        body = None
+        headers = {}
+        if data is not None:
+            body = urllib.parse.urlencode({**data, 'csrfmiddlewaretoken': self.csrf_token()}).encode()
+            headers = {'Referer': url, 'X-CSRFToken': self.csrf_token()}
+        try:
+            with self.opener.open(urllib.request.Request(url, body, headers)) as response:
+                response.read()
+                return response.status
+        except urllib.error.HTTPError as error:
+            return error.code
+
+
+def drive(workers, send):
+    """Run every worker's requests in its own thread; return the elapsed time and samples."""
+    def work(requests):
+        samples = []
+        for user, endpoint, url, data in requests:
+            start = time.perf_counter()
+            status = send(user, url, data)
+            samples.append((endpoint, time.perf_counter() - start, status >= 400))
+        return samples
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(len(workers)) as executor:
+        outcomes = list(executor.map(work, workers))
+    return time.perf_counter() - start, [sample for samples in outcomes for sample in samples]
+
+
+def query_totals(text):
+    """Return {view: (queries, requests)} from the Prometheus metrics text."""
+    totals = {}
+    for name, view, value in re.findall(
+            r'^polls_db_queries_(sum|count)\{view="([^"]+)"\} (\S+)$', text, re.M):
+        queries, requests = totals.get(view, (0.0, 0.0))
+        totals[view] = (float(value), requests) if name == 'sum' else (queries, float(value))
+    return totals
+
+
+def make_report(args, elapsed, samples, queries):
+    """Summarize the samples per endpoint and in total."""
+    report = {'started_at': args.started_at, 'target': args.url or 'test client',
+              'args': {key: value for key, value in vars(args).items() if key != 'started_at'},
+              'elapsed_s': elapsed, 'endpoints': {}}
+    groups = {endpoint: [] for endpoint in args.mix}
+    for endpoint, seconds, error in samples:
+        groups[endpoint].append((seconds, error))
+    groups['total'] = [(seconds, error) for _, seconds, error in samples]
+    for endpoint, group in groups.items():
+        if not group:
+            continue
+        durations = [seconds for seconds, _ in group]
+        report['endpoints'][endpoint] = {
+            'requests': len(group),
+            'errors': sum(error for _, error in group),
+            'throughput_rps': len(group) / elapsed,
+            **harness.summarize(durations),
+            'p95_ms': harness.percentile(durations, 95) * 1000,
+            'queries_per_request': queries.get(f'polls:{endpoint}'),
+        }
+    return report
+
+
+def print_report(report, baseline=None):
+    print(f"{'endpoint':>8} {'requests':>9} {'req/s':>9} {'p50 ms':>9} {'p95 ms':>9} "
+          f"{'p99 ms':>9} {'queries':>8} {'errors':>7}")
+    for endpoint, stats in report['endpoints'].items():
+        queries = stats['queries_per_request']
+        print(f"{endpoint:>8} {stats['requests']:>9} {stats['throughput_rps']:>9.1f} "
+              f"{stats['p50_ms']:>9.2f} {stats['p95_ms']:>9.2f} {stats['p99_ms']:>9.2f} "
+              f"{'-' if queries is None else f'{queries:.1f}':>8} {stats['errors']:>7}")
+    if baseline:
+        print(f"\nChange from the baseline of {baseline['started_at']}:")
+        for endpoint, stats in report['endpoints'].items():
+            old = baseline['endpoints'].get(endpoint)
+            if old:
+                changes = ', '.join(
+                    f"{key} {(stats[key] - old[key]) / old[key] * 100:+.1f}%"
+                    for key in ('throughput_rps', 'p50_ms', 'p99_ms') if old[key])
+                print(f"{endpoint:>8} {changes}")
+
+
+def run_client(args):
+    """Seed a throwaway database and drive it with the test Client."""
+    harness.setup()
+    from django.contrib.auth.models import User
+    from django.test import Client
+    from polls import instrumentation
+    from polls.seeding import seed_dataset
+
+    with harness.test_database():
+        created = seed_dataset(questions=args.questions, choices=args.choices, users=args.users,
+                               votes=args.votes, seed=args.seed)
+        questions = [(question, created['choices'][question]) for question in created['questions']]
+        clients = []
+        for user in User.objects.filter(pk__in=created['users']).order_by('pk'):
+            client = Client()
+            client.force_login(user)
+            clients.append(client)
+        workers = build_workload(args, questions, len(clients))
+
+        def send(user, url, data):
+            client = clients[user]
+            response = client.get(url) if data is None else client.post(url, data)
+            return response.status_code
+
+        instrumentation.reset()
+        elapsed, samples = drive(workers, send)
+        queries = {view: total / count for view, (counts, total) in instrumentation.DB_QUERIES.series.items()
+                   if (count := sum(counts))}
+        return make_report(args, elapsed, samples, queries)
+
+
+def run_server(args):
+    """Drive a running server, using the data seeded by `manage.py seed_polls`."""
+    harness.setup()
+    from django.contrib.auth.models import User
+    from polls.models import Question
+
+    open_questions = (Question.objects.can_vote().filter(question_text__startswith=f'{args.prefix} ')
+                      .prefetch_related('choice_set'))
+    questions = [(question.pk, [choice.pk for choice in question.choice_set.all()])
+                 for question in open_questions]
+    usernames = list(User.objects.filter(username__startswith=args.prefix)
+                     .order_by('pk').values_list('username', flat=True)[:args.users])
+    if not questions or not usernames:
+        raise SystemExit(f"No seeded data with prefix {args.prefix!r}; run manage.py seed_polls first.")
+    users = [HttpUser(args.url, username, args.password) for username in usernames]
+    workers = build_workload(args, questions, len(users))
+
+    def metrics():
+        try:
+            with urllib.request.urlopen(args.url.rstrip('/') + '/metrics') as response:
+                return response.read().decode()
+        except urllib.error.HTTPError:
+            return ''
+
+    before = query_totals(metrics())
+    elapsed, samples = drive(workers, lambda user, url, data: users[user].request(url, data))
+    # With several server processes the metrics come from one of them
+    queries = {}
+    for view, (total, count) in query_totals(metrics()).items():
+        old_total, old_count = before.get(view, (0.0, 0.0))
+        if count > old_count:
+            queries[view] = (total - old_total) / (count - old_count)
+    return make_report(args, elapsed, samples, queries)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--requests', type=int, default=2000, help='requests in total')
+    parser.add_argument('--concurrency', type=int, default=10, help='concurrent workers')
+    parser.add_argument('--mix', type=parse_mix, default='index=30,detail=20,results=30,vote=20',
+                        help='weights of the endpoints')
+    parser.add_argument('--questions', type=int, default=50, help='seeded questions')
+    parser.add_argument('--choices', type=int, default=4, help='choices per seeded question')
+    parser.add_argument('--users', type=int, default=200, help='simulated users')
+    parser.add_argument('--votes', type=int, default=2000, help='seeded votes')
+    parser.add_argument('--seed', type=int, default=0, help='random seed of data and workload')
+    parser.add_argument('--url', help='base URL of a running server to drive instead')
+    parser.add_argument('--prefix', default='bench', help='username prefix of the seeded users')
+    parser.add_argument('--password', default='bench-password', help='password of the seeded users')
+    parser.add_argument('--output', help='save the report to this JSON file')
+    parser.add_argument('--baseline', help='compare with a report saved by an earlier run')
+    args = parser.parse_args()
+    args.started_at = datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds')
+
+    report = run_server(args) if args.url else run_client(args)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as stream:
+            baseline = json.load(stream)
+    print_report(report, baseline)
+    if args.output:
+        with open(args.output, 'w') as stream:
+            json.dump(report, stream, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+"""Results-page latency as the Question table grows.
+
+Grows the Question table step by step and times the results page of one
+question at every step. Since the published-question filter runs in SQL,
+the latency should stay flat instead of growing with the table size.
+
+Usage: python -m benchmarks.results_scaling [--sizes 100,1000,10000,100000]
+"""
+import argparse
+import datetime
+
+from benchmarks import harness
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', default='100,1000,10000,100000',
+                        help='comma-separated Question table sizes')
+    parser.add_argument('--repeat', type=int, default=50,
+                        help='requests timed at every size')
+    parser.add_argument('--choices', type=int, default=4,
+                        help='choices of the question being viewed')
+    args = parser.parse_args()
+    sizes = sorted(int(size) for size in args.sizes.split(','))
+
+    harness.setup()
+    from django.test import Client
+    from django.urls import reverse
+    from django.utils import timezone
+    from polls.models import Choice, Question
+
+    with harness.test_database():
+        now = timezone.now()
+        question = Question.objects.create(question_text='Benchmark question',
+                                           pub_date=now - datetime.timedelta(days=1))
+        Choice.objects.bulk_create(
+            Choice(question=question, choice_text=f'Choice {i}')
+            for i in range(args.choices))
+        url = reverse('polls:results', args=(question.id,))
+        client = Client()
+
+        rows = 1
+        print(f"{'questions':>10} {'mean ms':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+        for size in sizes:
+            Question.objects.bulk_create(
+                (Question(question_text=f'Question {i}',
+                          pub_date=now - datetime.timedelta(minutes=i))
+                 for i in range(rows, size)),
+                batch_size=1000)
+            rows = max(rows, size)
+            client.get(url)  # warm up
+            stats = harness.summarize(harness.time_calls(lambda: client.get(url), args.repeat))
+            print(f"{size:>10} {stats['mean_ms']:>9.2f} {stats['p50_ms']:>9.2f} "
+                  f"{stats['p95_ms']:>9.2f} {stats['p99_ms']:>9.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+"""Sync (WSGI) against async (ASGI) views under a vote-heavy workload.
+
+Simulated users vote and read results concurrently, first through the
+sync views with the test Client from a thread pool, then through the
+async views with the AsyncClient from tasks on one event loop. Every
+worker drives its own users one request at a time. It measures Django's
+request handling of each stack, without a real server in front of it.
+Concurrent votes need a database that takes concurrent writes, such as
+PostgreSQL; on SQLite run it with --concurrency 1.
+
+Usage: python -m benchmarks.wsgi_vs_asgi [--requests 2000] [--concurrency 20]
+"""
+import argparse
+import asyncio
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks import harness
+
+
+def build_workload(args, questions, users):
+    """Return a list of (user index, url, post data) requests per worker."""
+    rng = random.Random(args.seed)
+    workers = [[] for _ in range(args.concurrency)]
+    for _ in range(args.requests):
+        user = rng.randrange(len(users))
+        question, choice_ids = rng.choice(questions)
+        if rng.random() < args.vote_ratio:
+            request = (user, f'/polls/{question.id}/vote/', {'choice': rng.choice(choice_ids)})
+        else:
+            request = (user, f'/polls/{question.id}/results/', None)
+        workers[user % args.concurrency].append(request)
+    return workers
+
+
+def run_wsgi(workers, users):
+    from django.test import Client
+
+    clients = []
+    for user in users:
+        client = Client()
+        client.force_login(user)
+        clients.append(client)
+
+    def work(requests):
+        samples, errors = [], 0
+        for user, url, data in requests:
+            start = time.perf_counter()
+            if data is None:
+                response = clients[user].get(url)
+            else:
+                response = clients[user].post(url, data)
+            samples.append(time.perf_counter() - start)
+            errors += response.status_code >= 400
+        return samples, errors
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(len(workers)) as executor:
+        outcomes = list(executor.map(work, workers))
+    return time.perf_counter() - start, outcomes
+
+
+def run_asgi(workers, users):
+    from django.test import AsyncClient
+
+    async def main():
+        clients = []
+        for user in users:
+            client = AsyncClient()
+            await client.aforce_login(user)
+            clients.append(client)
+
+        async def work(requests):
+            samples, errors = [], 0
+            for user, url, data in requests:
+                begin = time.perf_counter()
+                if data is None:
+                    response = await clients[user].get(url)
+                else:
+                    response = await clients[user].post(url, data)
+                samples.append(time.perf_counter() - begin)
+                errors += response.status_code >= 400
+            return samples, errors
+
+        start = time.perf_counter()
+        outcomes = await asyncio.gather(*(work(requests) for requests in workers))
+        return time.perf_counter() - start, outcomes
+
+    return asyncio.run(main())
+
+
+def report(name, elapsed, outcomes):
+    samples = [sample for worker_samples, _ in outcomes for sample in worker_samples]
+    errors = sum(worker_errors for _, worker_errors in outcomes)
+    stats = harness.summarize(samples)
+    print(f"{name:>6} {len(samples):>9} {len(samples) / elapsed:>9.1f} "
+          f"{stats['p50_ms']:>9.2f} {stats['p99_ms']:>9.2f} {errors:>7}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--requests', type=int, default=2000, help='requests per stack')
+    parser.add_argument('--concurrency', type=int, default=20, help='concurrent workers')
+    parser.add_argument('--users', type=int, default=100, help='simulated users')
+    parser.add_argument('--questions', type=int, default=5, help='open questions')
+    parser.add_argument('--choices', type=int, default=4, help='choices per question')
+    parser.add_argument('--vote-ratio', type=float, default=0.8,
+                        help='share of requests that are votes, the rest read results')
+    parser.add_argument('--seed', type=int, default=0, help='random seed of the workload')
+    args = parser.parse_args()
+
+    harness.setup()
+    from django.contrib.auth.models import User
+    from django.test.utils import override_settings
+    from polls.models import Choice, Question
+
+    with harness.test_database():
+        User.objects.bulk_create(User(username=f'bench{i}') for i in range(args.users))
+        users = list(User.objects.order_by('pk'))
+        questions = []
+        for i in range(args.questions):
+            question = Question.objects.create(question_text=f'Question {i}')
+            choices = Choice.objects.bulk_create(
+                Choice(question=question, choice_text=f'Choice {j}') for j in range(args.choices))
+            questions.append((question, [choice.pk for choice in choices]))
+        workers = build_workload(args, questions, users)
+
+        print(f"{'stack':>6} {'requests':>9} {'req/s':>9} {'p50 ms':>9} {'p99 ms':>9} {'errors':>7}")
+        with override_settings(ROOT_URLCONF='mysite.urls'):
+            report('WSGI', *run_wsgi(workers, users))
+        with override_settings(ROOT_URLCONF='mysite.async_urls'):
+            report('ASGI', *run_asgi(workers, users))
+
+
+if __name__ == '__main__':
+    main()
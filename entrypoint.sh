@@ -1,6 +1,28 @@
 #!/bin/sh
+# Start the application. SERVER_MODE selects the server:
+#   dev  - Django's development server (default)
+#   wsgi - gunicorn with WEB_CONCURRENCY preloaded worker processes
+#   asgi - gunicorn with uvicorn workers, for the async views and live results
+# The workers of wsgi and asgi must share a cache (CACHE_BACKEND); bootstrap
+# refuses to start them with a per-process local memory cache.
+set -e
 
-python manage.py migrate
-python manage.py loaddata data/users.json data/polls-v4.json data/votes-v4.json
-python manage.py createsuperuser --username admin --email admin@example.com --noinput
-python manage.py runserver 0.0.0.0:8000
+# Seconds since the epoch, for the time-to-first-request report in the log
+export POLLS_BOOT_STARTED="$(date +%s)"
+
+python manage.py bootstrap
+
+case "${SERVER_MODE:-dev}" in
+  wsgi)
+    exec gunicorn mysite.wsgi:application --preload \
+      --workers "${WEB_CONCURRENCY:-4}" --bind 0.0.0.0:8000
+    ;;
+  asgi)
+    exec gunicorn mysite.asgi:application --preload \
+      --workers "${WEB_CONCURRENCY:-4}" --worker-class uvicorn.workers.UvicornWorker \
+      --bind 0.0.0.0:8000
+    ;;
+  *)
+    exec python manage.py runserver 0.0.0.0:8000
+    ;;
+esac
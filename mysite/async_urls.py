@@ -0,0 +1,8 @@
+"""
+URL configuration serving the async polls views, used as ROOT_URLCONF
+when POLLS_ASYNC_VIEWS is on.
+"""
+
+from .urls import build_urlpatterns
+
+urlpatterns = build_urlpatterns('polls.async_urls')
@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/4.2/ref/settings/
 """
 
+import sys
 from pathlib import Path
 from decouple import config, Csv
 
@@ -42,7 +43,9 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'polls.middleware.RequestMetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
+    'polls.middleware.StickyPrimaryMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -51,11 +54,15 @@ MIDDLEWARE = [
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
 
-ROOT_URLCONF = 'mysite.urls'
+# Serve the async polls views, for running under ASGI
+POLLS_ASYNC_VIEWS = config("POLLS_ASYNC_VIEWS", cast=bool, default=False)
+
+ROOT_URLCONF = 'mysite.async_urls' if POLLS_ASYNC_VIEWS else 'mysite.urls'
 
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        # The Django backend, timing template rendering for the request metrics
+        'BACKEND': 'polls.instrumentation.InstrumentedDjangoTemplates',
         'DIRS': [BASE_DIR / 'templates'],
         'APP_DIRS': True,
         'OPTIONS': {
@@ -75,6 +82,11 @@ WSGI_APPLICATION = 'mysite.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/4.2/ref/settings/#databases
 
+# Connections are kept open between requests for DATABASE_CONN_MAX_AGE
+# seconds, or borrowed from a psycopg connection pool if DATABASE_POOL is set
+# (recommended under ASGI, where persistent connections aren't reused).
+DATABASE_POOL = config("DATABASE_POOL", cast=bool, default=False)
+
 DATABASES = {
     "default": {
         "ENGINE": "django.db.backends.postgresql",
@@ -82,10 +94,72 @@ DATABASES = {
         "USER": config("DATABASE_USER", default="pollsapp"),
         "PASSWORD": config("DATABASE_PASSWORD", default="password"),
         "HOST": config("DATABASE_HOST", default="localhost"),
-        "PORT": config("DATABASE_PORT", default="5432")
+        "PORT": config("DATABASE_PORT", default="5432"),
+        # A pool doesn't support persistent connections
+        "CONN_MAX_AGE": 0 if DATABASE_POOL else config("DATABASE_CONN_MAX_AGE", cast=int, default=60),
+        "CONN_HEALTH_CHECKS": config("DATABASE_CONN_HEALTH_CHECKS", cast=bool, default=True),
+        # Needed behind a transaction-pooling proxy such as PgBouncer
+        "DISABLE_SERVER_SIDE_CURSORS": config("DATABASE_DISABLE_SERVER_SIDE_CURSORS",
+                                              cast=bool, default=False),
+        "OPTIONS": {
+            "pool": {
+                "min_size": config("DATABASE_POOL_MIN_SIZE", cast=int, default=2),
+                "max_size": config("DATABASE_POOL_MAX_SIZE", cast=int, default=10),
+                "timeout": config("DATABASE_POOL_TIMEOUT", cast=float, default=10),
+            } if DATABASE_POOL else False,
+        },
     }
 }
 
+# Read replicas of the default database, by host. Reads of the polls go to
+# the replicas through polls.routers.ReplicaRouter.
+for number, host in enumerate(config("DATABASE_REPLICA_HOSTS", cast=Csv(), default=""), 1):
+    DATABASES[f"replica{number}"] = {**DATABASES["default"], "HOST": host,
+                                     "TEST": {"MIRROR": "default"}}
+
+POLLS_READ_REPLICAS = [alias for alias in DATABASES if alias != "default"]
+
+# Under `manage.py test`, a second connection to the test database stands in
+# for a replica, so the tests can route reads to it without a replica server.
+# It isn't one of POLLS_READ_REPLICAS; the tests that use it add it there.
+if sys.argv[1:2] == ["test"]:
+    DATABASES["replica"] = {**DATABASES["default"], "TEST": {"MIRROR": "default"}}
+DATABASE_ROUTERS = ["polls.routers.ReplicaRouter"]
+
+
+# How entrypoint.sh serves the site: dev (runserver), or wsgi or asgi with
+# WEB_CONCURRENCY gunicorn worker processes.
+SERVER_MODE = config("SERVER_MODE", default="dev")
+WEB_CONCURRENCY = config("WEB_CONCURRENCY", cast=int, default=4)
+
+
+# Cache
+# https://docs.djangoproject.com/en/5.1/topics/cache/
+# Results, pages, vote maps and the poll schedule are invalidated through
+# the cache, so all worker processes must share it. Local memory is only
+# the default for the development server; the wsgi and asgi modes default
+# to the file-based cache, which the workers of one host share without a
+# database query per lookup, and Redis also serves several hosts.
+
+if SERVER_MODE == "dev":
+    _DEFAULT_CACHE = ("django.core.cache.backends.locmem.LocMemCache", "ku-polls")
+else:
+    _DEFAULT_CACHE = ("django.core.cache.backends.filebased.FileBasedCache",
+                      "/var/tmp/ku-polls-cache")
+
+CACHES = {
+    "default": {
+        "BACKEND": config("CACHE_BACKEND", default=_DEFAULT_CACHE[0]),
+        "LOCATION": config("CACHE_LOCATION", default=_DEFAULT_CACHE[1]),
+    }
+}
+if CACHES["default"]["BACKEND"] != "django.core.cache.backends.redis.RedisCache":
+    # The other backends cull entries beyond MAX_ENTRIES, 300 by default,
+    # which is fewer than the vote maps of the active users
+    CACHES["default"]["OPTIONS"] = {
+        "MAX_ENTRIES": config("CACHE_MAX_ENTRIES", cast=int, default=10000),
+    }
+
 
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
@@ -133,6 +207,8 @@ STATIC_URL = 'static/'
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
+# Logs are written by a background thread, so requests never wait on the
+# log sink. LOG_FORMAT is json (one object per line) or text.
 LOGGING = {
     'version': 1,
     'disable_existing_loggers': False,
@@ -145,12 +221,24 @@ LOGGING = {
             'format': '{levelname} {message}',
             'style': '{',
         },
+        'json': {
+            '()': 'polls.log.JsonFormatter',
+        },
+    },
+    'filters': {
+        # Repeated failed votes and logins from one address
+        'rate_limit': {
+            '()': 'polls.log.RateLimitFilter',
+            'rate': config("LOG_RATE_LIMIT", cast=int, default=10),
+            'per': config("LOG_RATE_LIMIT_PERIOD", cast=float, default=60),
+        },
     },
     'handlers': {
         'console': {
             'level': 'DEBUG',
-            'class': 'logging.StreamHandler',
-            'formatter': 'details',
+            '()': 'polls.log.QueueingStreamHandler',
+            'formatter': 'json' if config("LOG_FORMAT", default="json") == 'json' else 'details',
+            'filters': ['rate_limit'],
         },
     },
     'loggers': {
@@ -164,5 +252,71 @@ LOGGING = {
             'level': 'INFO',
             'propagate': False,
         },
+        # Every request, when LOG_REQUESTS is on; otherwise only slow ones
+        'polls.requests': {
+            'handlers': ['console'],
+            'level': 'DEBUG' if config("LOG_REQUESTS", cast=bool, default=False) else 'WARNING',
+            'propagate': False,
+        },
     },
 }
+
+# KU Polls
+
+# Keep persisted vote counters on Choice and Question, so results are read
+# from the counters instead of counting the Vote table.
+POLLS_VOTE_COUNTERS = config("POLLS_VOTE_COUNTERS", cast=bool, default=False)
+
+# Keep minute and hour rollups of the votes for the vote trends, and the
+# number of hours minute rollups are kept before being compacted into hours.
+# Off by default: each vote then also updates its minute rollup, in its
+# transaction, which every vote on the same choice that minute waits for.
+POLLS_VOTE_TRENDS = config("POLLS_VOTE_TRENDS", cast=bool, default=False)
+POLLS_TREND_MINUTE_RETENTION = config("POLLS_TREND_MINUTE_RETENTION", cast=int, default=24)
+
+# Maximum number of seconds cached results can be served before recounting.
+POLLS_RESULTS_CACHE_TIMEOUT = config("POLLS_RESULTS_CACHE_TIMEOUT", cast=int, default=300)
+
+# Number of seconds a user's cached {question: choice} vote map is kept.
+POLLS_USER_VOTES_CACHE_TIMEOUT = config("POLLS_USER_VOTES_CACHE_TIMEOUT", cast=int, default=3600)
+
+# Anonymous index and results pages: number of seconds the whole page is
+# cached (0 turns the page cache off; votes and question edits purge it
+# sooner), and the s-maxage that lets a reverse proxy cache it.
+POLLS_PAGE_CACHE_TIMEOUT = config("POLLS_PAGE_CACHE_TIMEOUT", cast=int, default=60)
+POLLS_PAGE_CACHE_MAX_AGE = config("POLLS_PAGE_CACHE_MAX_AGE", cast=int, default=5)
+
+# Number of polls listed on each page of the index.
+POLLS_INDEX_PAGE_SIZE = config("POLLS_INDEX_PAGE_SIZE", cast=int, default=5)
+
+# Live results stream: the broadcaster class, the most updates pushed per
+# second for each question, and the seconds between keep-alive comments.
+POLLS_RESULTS_BROADCASTER = config("POLLS_RESULTS_BROADCASTER",
+                                   default="polls.broadcast.ResultsBroadcaster")
+POLLS_LIVE_RESULTS_RATE = config("POLLS_LIVE_RESULTS_RATE", cast=float, default=2)
+POLLS_LIVE_RESULTS_HEARTBEAT = config("POLLS_LIVE_RESULTS_HEARTBEAT", cast=float, default=15)
+
+# Vote ingestion: 'direct' writes each vote in the request, 'queued' appends
+# it to the vote journal for flush_vote_journal to write in batches. Votes are
+# written directly again while the journal lags by more than the limits below.
+POLLS_VOTE_INGESTION = config("POLLS_VOTE_INGESTION", default="direct")
+POLLS_VOTE_JOURNAL = config("POLLS_VOTE_JOURNAL", default=str(BASE_DIR / 'vote-journal.sqlite3'))
+POLLS_VOTE_QUEUE_MAX_LAG = config("POLLS_VOTE_QUEUE_MAX_LAG", cast=float, default=30)
+POLLS_VOTE_QUEUE_MAX_PENDING = config("POLLS_VOTE_QUEUE_MAX_PENDING", cast=int, default=100000)
+POLLS_VOTE_FLUSH_BATCH = config("POLLS_VOTE_FLUSH_BATCH", cast=int, default=1000)
+
+# Seconds after a client's write during which its reads, and the recount of
+# changed results, use the primary database instead of a lagging replica.
+POLLS_REPLICA_STICKY_SECONDS = config("POLLS_REPLICA_STICKY_SECONDS", cast=float, default=5)
+
+# Serve the request metrics of each process at /metrics, in the Prometheus
+# text format. Requests slower than POLLS_SLOW_REQUEST_MS are logged with
+# their SQL, for the share POLLS_SLOW_SQL_SAMPLE_RATE (0 to 1) of requests.
+POLLS_METRICS_ENABLED = config("POLLS_METRICS_ENABLED", cast=bool, default=False)
+POLLS_SLOW_REQUEST_MS = config("POLLS_SLOW_REQUEST_MS", cast=float, default=500)
+POLLS_SLOW_SQL_SAMPLE_RATE = config("POLLS_SLOW_SQL_SAMPLE_RATE", cast=float, default=0)
+
+# Fixture files, relative to the project directory, imported by
+# `manage.py bootstrap` whenever their contents change.
+POLLS_BOOTSTRAP_FIXTURES = config("POLLS_BOOTSTRAP_FIXTURES", cast=Csv(),
+                                  default="data/users.json,data/polls-v4.json,data/votes-v4.json")
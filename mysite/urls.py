@@ -19,9 +19,18 @@ from django.contrib import admin
 from django.urls import include, path
 from django.views.generic.base import RedirectView
 
-urlpatterns = [
-    path('', RedirectView.as_view(url='polls/')),
-    path('polls/', include('polls.urls')),
-    path('admin/', admin.site.urls),
-    path('accounts/', include('django.contrib.auth.urls')),
-]
+from polls.views import metrics
+
+
+def build_urlpatterns(polls_urlconf):
+    """Return the site's URL patterns, serving the polls from `polls_urlconf`."""
+    return [
+        path('', RedirectView.as_view(url='polls/')),
+        path('polls/', include(polls_urlconf)),
+        path('admin/', admin.site.urls),
+        path('accounts/', include('django.contrib.auth.urls')),
+        path('metrics', metrics, name='metrics'),
+    ]
+
+
+urlpatterns = build_urlpatterns('polls.urls')
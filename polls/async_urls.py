@@ -0,0 +1,19 @@
+from django.urls import path
+from . import async_views, views
+from .pages import aindex_version, aresults_page_version, cache_anonymous_page
+
+app_name = 'polls'
+urlpatterns = [
+    path('', cache_anonymous_page(aindex_version, params=async_views.IndexView.query_params)(
+        async_views.IndexView.as_view()), name='index'),
+    path('<int:pk>/', async_views.DetailView.as_view(), name='detail'),
+    path('<int:pk>/results/',
+         cache_anonymous_page(aresults_page_version)(async_views.ResultsView.as_view()),
+         name='results'),
+    path('<int:pk>/results.json', views.results_json, name='results_json'),
+    path('<int:pk>/results/stream/', views.results_stream, name='results_stream'),
+    path('<int:pk>/trend.json', views.trend_json, name='trend_json'),
+    path('results.json', views.bulk_results_json, name='bulk_results_json'),
+    path('votes/', views.batch_vote, name='batch_vote'),
+    path('<int:question_id>/vote/', async_views.vote, name='vote'),
+]
@@ -0,0 +1,141 @@
+"""Async versions of the polls page views, for serving KU Polls under ASGI.
+
+They run on the event loop with Django's async ORM, so a request doesn't
+hop to the sync thread pool and hold one of its threads, and they use
+the async cache API, as the cache may be a database table. The exception
+is casting a vote: its upsert is a raw SQL statement, which has no async
+equivalent, so that single step runs in a thread.
+
+mysite.async_urls routes to these views, and settings select it as the
+root URLconf when POLLS_ASYNC_VIEWS is on.
+"""
+from asgiref.sync import sync_to_async
+from django.contrib import messages
+from django.contrib.auth.decorators import login_required
+from django.core.exceptions import SynchronousOnlyOperation
+from django.http import HttpResponseRedirect
+from django.shortcuts import aget_object_or_404
+from django.template.response import TemplateResponse
+from django.urls import reverse
+
+from . import views
+from .broadcast import get_broadcaster
+from .ingest import discard_pending, enqueue_vote, queue_accepting
+from .models import Choice, Question
+from .results import aget_results_table, aget_tallies, invalidate_results
+from .voting import acast_vote, aget_user_votes, aremember_vote
+
+
+async def render_page(request, template_name, context):
+    """
+    Render a page without leaving the event loop.
+
+    The user is loaded with the async auth API and the messages are read
+    up front, so the template doesn't touch the database. Messages are read
+    from their cookie; only messages that overflowed into the session are
+    read in a thread.
+    """
+    request.user = await request.auser()
+    storage = messages.get_messages(request)
+    try:
+        list(storage)
+    except SynchronousOnlyOperation:
+        await sync_to_async(list)(storage)
+    response = TemplateResponse(request, template_name, context)
+    return response.render()
+
+
+class IndexView(views.IndexView):
+    """Async version of views.IndexView."""
+
+    async def get(self, request, *args, **kwargs):
+        questions = [question async for question in self.get_queryset()]
+        user = await request.auser()
+        user_votes = {}
+        if user.is_authenticated:
+            user_votes = await aget_user_votes(user)
+        context = self.get_page_context(questions, user_votes)
+        return await render_page(request, self.template_name, context)
+
+
+class DetailView(views.DetailView):
+    """Async version of views.DetailView."""
+
+    async def get(self, request, *args, **kwargs):
+        try:
+            question = await self.get_queryset().aget(pk=self.kwargs['pk'])
+        except Question.DoesNotExist:
+            messages.error(request, "This question is not available.")
+            return HttpResponseRedirect(reverse('polls:index'))
+
+        if not question.can_vote():
+            messages.error(request, "Voting on this question is currently not allowed.")
+            return HttpResponseRedirect(reverse('polls:index'))
+
+        this_user = await request.auser()
+        last_vote = None
+        if this_user.is_authenticated:
+            last_vote = (await aget_user_votes(this_user)).get(question.id)
+        return await render_page(request, self.template_name, {
+            'question': question,
+            'choices': [choice async for choice in question.choice_set.all()],
+            'last_vote': last_vote,
+        })
+
+
+class ResultsView(views.ResultsView):
+    """Async version of views.ResultsView."""
+
+    async def get(self, request, *args, **kwargs):
+        question = await aget_object_or_404(self.get_queryset(), pk=self.kwargs['pk'])
+        context = {'question': question, 'object': question}
+        context.update(await aget_tallies(question))
+        context['results_table'] = await aget_results_table(question)
+        return await render_page(request, self.template_name, context)
+
+
+@login_required
+async def vote(request, question_id):
+    """Async version of views.vote."""
+    question = await Question.objects.filter(pk=question_id).afirst()
+    if question is None or not question.can_vote():
+        messages.error(request, "Voting on this question is currently not allowed.")
+        return HttpResponseRedirect(reverse('polls:index'))
+    this_user = await request.auser()
+    ip_address = views.get_client_ip(request)
+
+    try:
+        selected_choice = await question.choice_set.aget(pk=request.POST['choice'])
+    except (KeyError, Choice.DoesNotExist):
+        views.logger.warning("%s failed to vote in %s from %s", this_user, question, ip_address,
+                             extra=views.vote_log_fields(this_user, question, None, ip_address,
+                                                         'vote_failed'))
+        # Redisplay the question voting form.
+        return await render_page(request, 'polls/detail.html', {
+            'question': question,
+            'choices': [choice async for choice in question.choice_set.all()],
+            'error_message': "You didn't select a choice.",
+        })
+
+    # Record the vote, replacing the user's earlier vote on this question.
+    # It is committed once acast_vote() returns, or queued under load.
+    if await sync_to_async(queue_accepting)():
+        previous_choice_id = (await aget_user_votes(this_user)).get(question.id)
+        await sync_to_async(enqueue_vote)(this_user, selected_choice)
+    else:
+        previous_choice_id = await acast_vote(this_user, selected_choice)
+        await sync_to_async(discard_pending)([(this_user.pk, question.id)])
+        await sync_to_async(invalidate_results)(question.id)
+        get_broadcaster().notify(question.id)
+    await aremember_vote(this_user, question.id, selected_choice.id)
+
+    if previous_choice_id is None:
+        messages.success(request, f"You voted for '{selected_choice.choice_text}'")
+    else:
+        views.logger.info("%s voted for Choice %s in Question %s from %s",
+                          this_user, selected_choice.id, question.id, ip_address,
+                          extra=views.vote_log_fields(this_user, question, selected_choice,
+                                                      ip_address, 'vote_changed'))
+        messages.success(request, f"Your vote was changed to '{selected_choice.choice_text}'")
+
+    return HttpResponseRedirect(reverse('polls:results', args=(question.id,)))
@@ -0,0 +1,127 @@
+"""Preparing the database when a container starts.
+
+Each step of bootstrap only does work when it is needed, so starting
+another container against a ready database costs a few queries: pending
+migrations are applied, fixture files are imported only when their
+checksum differs from the one recorded in FixtureLoad, and the admin
+account is created only if it doesn't exist.
+"""
+import contextlib
+import hashlib
+import logging
+import os
+import time
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import connection
+from django.db.migrations.executor import MigrationExecutor
+
+from .models import FixtureLoad
+from .transfer import Importer, guess_format, read_rows
+
+logger = logging.getLogger('polls')
+
+# Key of the PostgreSQL advisory lock that serializes concurrent bootstraps
+_LOCK_KEY = 0x6b75706f6c6c73
+
+# When this process started serving, for the time-to-first-request report
+_process_started = time.time()
+_first_request_seen = False
+
+
+@contextlib.contextmanager
+def bootstrap_lock():
+    """
+    Hold a database-wide lock while bootstrapping, so that containers
+    starting together don't migrate or import at the same time.
+    """
+    if connection.vendor != 'postgresql':
+        yield
+        return
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT pg_advisory_lock(%s)', [_LOCK_KEY])
+    try:
+        yield
+    finally:
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT pg_advisory_unlock(%s)', [_LOCK_KEY])
+
+
+def pending_migrations():
+    """Return the migrations not yet applied to the database."""
+    executor = MigrationExecutor(connection)
+    return [migration for migration, _ in
+            executor.migration_plan(executor.loader.graph.leaf_nodes())]
+
+
+def file_checksum(path):
+    """Return the SHA-256 hex digest of a file, read in chunks."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as stream:
+        while chunk := stream.read(1 << 20):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def changed_fixtures(paths):
+    """Return (path, checksum) for the fixtures that changed since they were imported."""
+    loaded = dict(FixtureLoad.objects.filter(fixture__in=[str(path) for path in paths])
+                  .values_list('fixture', 'checksum'))
+    changed = []
+    for path in paths:
+        checksum = file_checksum(path)
+        if loaded.get(str(path)) != checksum:
+            changed.append((path, checksum))
+    return changed
+
+
+def load_fixtures(paths, batch_size=1000):
+    """
+    Import the fixtures that changed, in order, and record their checksums.
+    Returns the paths imported.
+    """
+    changed = changed_fixtures(paths)
+    importer = Importer(batch_size)
+    for path, _ in changed:
+        with open(path, encoding='utf-8', newline='') as stream:
+            for label, pk, fields in read_rows(stream, guess_format(path)):
+                importer.add(label, pk, fields)
+    importer.finish()
+    for path, checksum in changed:
+        FixtureLoad.objects.update_or_create(fixture=str(path), defaults={'checksum': checksum})
+    return [path for path, _ in changed]
+
+
+def ensure_admin(username, email, password=None):
+    """
+    Create the admin account unless a user with its username exists.
+    Without a password it can't log in until one is set. Returns True if
+    it was created.
+    """
+    if User.objects.filter(username=username).exists():
+        return False
+    User.objects.create_superuser(username, email, password)
+    return True
+
+
+def report_first_request():
+    """
+    Log how long after the container started (POLLS_BOOT_STARTED, set by
+    entrypoint.sh) or else after the process started, this process is
+    serving its first request.
+    """
+    global _first_request_seen
+    if _first_request_seen:
+        return
+    _first_request_seen = True
+    started = os.environ.get('POLLS_BOOT_STARTED')
+    since = "container start" if started else "process start"
+    elapsed = time.time() - (float(started) if started else _process_started)
+    logger.info("First request in process %s served %.2fs after %s", os.getpid(), elapsed, since,
+                extra={'time_to_first_request': elapsed})
+
+
+def default_fixtures():
+    """Return the paths of the fixtures in POLLS_BOOTSTRAP_FIXTURES."""
+    return [settings.BASE_DIR / path for path in settings.POLLS_BOOTSTRAP_FIXTURES]
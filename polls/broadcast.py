@@ -0,0 +1,191 @@
+"""Live results broadcasting for the Server-Sent Events results stream.
+
+Subscribers are the open results streams of an ASGI worker. Each one is
+an asyncio queue fed by a single ticker task per question, so an idle
+subscriber costs one queue and one suspended generator.
+
+Changes are coalesced: notify() only marks a question dirty, and the
+question's ticker recounts and pushes at most POLLS_LIVE_RESULTS_RATE
+updates per second, each holding only the choices whose tally changed.
+
+The broadcaster class is set by POLLS_RESULTS_BROADCASTER. The default
+ResultsBroadcaster is notified in-process when results change, which
+reaches the subscribers of the same process. CachePollingBroadcaster
+watches the results versions in the shared cache instead, so it also
+sees votes cast in other processes when the cache is file-based or Redis.
+"""
+import asyncio
+import functools
+import json
+import logging
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from .results import get_tallies_many, results_versions
+
+logger = logging.getLogger('polls')
+
+
+def _snapshot(question_id):
+    """Return a {choice_id: votes} dict of the question's current tallies."""
+    tallies = get_tallies_many([question_id])[question_id]
+    return {choice.pk: choice.num_votes for choice in tallies['choices']}
+
+
+class ResultsBroadcaster:
+    """In-process fan-out of results updates to live results subscribers."""
+
+    def __init__(self, rate=None, queue_size=16):
+        self.interval = 1 / (rate or settings.POLLS_LIVE_RESULTS_RATE)
+        self.queue_size = queue_size
+        self._loop = None
+        self._subscribers = {}
+        self._dirty = {}
+        self._tickers = {}
+        self._snapshots = {}
+        self._starting = {}
+
+    def notify(self, question_id):
+        """
+        Tell subscribers that a question's results changed. Safe to call
+        from any thread; does nothing if nobody is subscribed.
+        """
+        loop = self._loop
+        if loop is None or loop.is_closed() or question_id not in self._subscribers:
+            return
+        loop.call_soon_threadsafe(self._mark_dirty, question_id)
+
+    def _mark_dirty(self, question_id):
+        if question_id in self._dirty:
+            self._dirty[question_id].set()
+
+    def _bind(self):
+        """Attach to the running event loop, dropping state of a previous loop."""
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._subscribers, self._dirty, self._tickers, self._snapshots = {}, {}, {}, {}
+            self._starting = {}
+
+    async def subscribe(self, question_id, heartbeat=None):
+        """
+        Yield the tallies of a question as {choice_id: votes} dicts: the
+        full tallies first, then the changed tallies of every update.
+        With a `heartbeat`, yield None after that many seconds without
+        an update.
+        """
+        self._bind()
+        queue = asyncio.Queue(self.queue_size)
+        subscribers = self._subscribers.setdefault(question_id, set())
+        subscribers.add(queue)
+        try:
+            # Subscribers arriving while the first one counts the tallies
+            # wait for it, so each question gets a single ticker
+            async with self._starting.setdefault(question_id, asyncio.Lock()):
+                if question_id not in self._tickers:
+                    self._dirty[question_id] = asyncio.Event()
+                    self._snapshots[question_id] = await sync_to_async(_snapshot)(question_id)
+                    self._tickers[question_id] = asyncio.create_task(self._tick(question_id))
+            yield dict(self._snapshots[question_id])
+            while True:
+                try:
+                    yield await asyncio.wait_for(queue.get(), heartbeat)
+                except asyncio.TimeoutError:
+                    yield None
+        finally:
+            subscribers.discard(queue)
+            if not subscribers:
+                self._stop(question_id)
+
+    def _stop(self, question_id):
+        """Forget a question nobody is subscribed to any more."""
+        self._subscribers.pop(question_id, None)
+        self._dirty.pop(question_id, None)
+        self._snapshots.pop(question_id, None)
+        self._starting.pop(question_id, None)
+        ticker = self._tickers.pop(question_id, None)
+        if ticker is not None:
+            ticker.cancel()
+
+    async def _tick(self, question_id):
+        """Push the changed tallies of a question, at most once per interval."""
+        dirty = self._dirty[question_id]
+        while True:
+            await dirty.wait()
+            dirty.clear()
+            try:
+                snapshot = await sync_to_async(_snapshot)(question_id)
+            except Exception:
+                logger.exception("Could not count the results of question %s", question_id)
+                await asyncio.sleep(self.interval)
+                continue
+            previous = self._snapshots.get(question_id, {})
+            changes = {choice_id: votes for choice_id, votes in snapshot.items()
+                       if previous.get(choice_id) != votes}
+            self._snapshots[question_id] = snapshot
+            if changes:
+                for queue in self._subscribers.get(question_id, ()):
+                    if queue.full():
+                        # A slow reader gets the full tallies instead of a backlog
+                        while not queue.empty():
+                            queue.get_nowait()
+                        queue.put_nowait(dict(snapshot))
+                    else:
+                        queue.put_nowait(changes)
+            await asyncio.sleep(self.interval)
+
+
+class CachePollingBroadcaster(ResultsBroadcaster):
+    """
+    Broadcaster that polls the results versions of the subscribed
+    questions in the shared cache, once per interval for all of them,
+    so votes cast by other processes reach this process's subscribers.
+    """
+
+    def _bind(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            super()._bind()
+            self._versions = {}
+            self._poller = asyncio.create_task(self._poll())
+
+    async def _poll(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            question_ids = list(self._subscribers)
+            if not question_ids:
+                continue
+            versions = await sync_to_async(results_versions)(question_ids)
+            for question_id, version in versions.items():
+                if self._versions.get(question_id, version) != version:
+                    self._mark_dirty(question_id)
+            self._versions = versions
+
+
+@functools.cache
+def get_broadcaster():
+    """Return the broadcaster of this process."""
+    return import_string(settings.POLLS_RESULTS_BROADCASTER)()
+
+
+async def results_events(question_id):
+    """
+    Yield the live results of a question as Server-Sent Events, with a
+    comment line every POLLS_LIVE_RESULTS_HEARTBEAT seconds of silence to
+    keep idle connections open.
+    """
+    updates = get_broadcaster().subscribe(question_id,
+                                          heartbeat=settings.POLLS_LIVE_RESULTS_HEARTBEAT)
+    event = 'snapshot'
+    try:
+        async for tallies in updates:
+            if tallies is None:
+                yield ': heartbeat\n\n'
+                continue
+            data = json.dumps({'question': question_id, 'choices': tallies})
+            yield f'event: {event}\ndata: {data}\n\n'
+            event = 'update'
+    finally:
+        await updates.aclose()
@@ -0,0 +1,42 @@
+"""System checks of the deployment settings the polls app relies on."""
+from django.conf import settings
+from django.core.checks import Error, Warning, register
+
+LOCAL_CACHES = ('django.core.cache.backends.locmem.LocMemCache',
+                'django.core.cache.backends.dummy.DummyCache')
+
+
+@register()
+def check_shared_cache(app_configs, **kwargs):
+    """
+    Several worker processes need a shared cache: with a per-process one,
+    results, pages, vote maps and the poll schedule go stale in every
+    worker but the one that invalidated them.
+    """
+    backend = settings.CACHES['default']['BACKEND']
+    if (settings.SERVER_MODE != 'dev' and settings.WEB_CONCURRENCY > 1
+            and backend in LOCAL_CACHES):
+        return [Error(
+            f"{backend} is not shared between the {settings.WEB_CONCURRENCY} worker processes "
+            f"of SERVER_MODE = {settings.SERVER_MODE}.",
+            hint="Set CACHE_BACKEND to the file-based or Redis cache, or WEB_CONCURRENCY to 1.",
+            id='polls.E001',
+        )]
+    return []
+
+
+@register()
+def check_database_cache(app_configs, **kwargs):
+    """
+    Results versions, tallies, pages, vote maps and the poll schedule are
+    looked up in the cache on most requests; with the database cache each
+    lookup is a query, and async views run each one in a thread.
+    """
+    backend = settings.CACHES['default']['BACKEND']
+    if settings.SERVER_MODE != 'dev' and backend == 'django.core.cache.backends.db.DatabaseCache':
+        return [Warning(
+            f"{backend} turns every cache lookup into a database query.",
+            hint="Set CACHE_BACKEND to the file-based or Redis cache.",
+            id='polls.W001',
+        )]
+    return []
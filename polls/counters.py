@@ -0,0 +1,219 @@
+"""Denormalized vote counters kept on Choice and Question.
+
+The counters are opt-in through the POLLS_VOTE_COUNTERS setting. When they
+are enabled, every change to a Vote is mirrored on the counters with F()
+expressions inside the same transaction, and results are read from the
+counters instead of counting the Vote table.
+
+Every vote on a poll updates the same counter rows, so votes on a busy
+poll queue on their row locks. For a question with counter_shards set,
+votes are instead added to one of that many ChoiceCounterShard rows per
+choice, picked at random, and a choice's votes are its vote_count plus
+the sum of its shards, and its question's votes are its total_votes plus
+the shards of all its choices. compact_shards() periodically folds the
+shards back into vote_count and total_votes. A choice's shards are also
+folded in before it is deleted, so its cascaded votes come off counters
+that hold them.
+"""
+import random
+from collections import Counter
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import IntegrityError, connection, transaction
+from django.db.models import Count, F, OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+
+from .models import Choice, ChoiceCounterShard, Question, Vote
+
+
+def counters_enabled():
+    """Return True if the persisted vote counters are maintained."""
+    return settings.POLLS_VOTE_COUNTERS
+
+
+def vote_count_with_shards():
+    """
+    Return an expression for the votes of a Choice: its vote_count plus
+    the counts of its shards.
+    """
+    shards = ChoiceCounterShard.objects.filter(choice=OuterRef('pk')).order_by() \
+        .values('choice').annotate(total=Sum('count')).values('total')
+    return F('vote_count') + Coalesce(Subquery(shards), 0)
+
+
+def _shards_key(question_id):
+    return f'polls:counters:shards:{question_id}'
+
+
+def counter_shards(question_ids):
+    """
+    Return a {question_id: counter_shards} dict, from the cache. A stale
+    value only changes which rows the next votes go to, not the counts.
+    """
+    keys = {_shards_key(question_id): question_id for question_id in question_ids}
+    shards = {keys[key]: value for key, value in cache.get_many(keys).items()}
+    missing = [question_id for question_id in question_ids if question_id not in shards]
+    if missing:
+        loaded = dict(Question.objects.filter(pk__in=missing).values_list('pk', 'counter_shards'))
+        cache.set_many({_shards_key(question_id): value for question_id, value in loaded.items()},
+                       settings.POLLS_RESULTS_CACHE_TIMEOUT)
+        shards.update(loaded)
+    return shards
+
+
+def forget_counter_shards(question_id):
+    """Drop the cached counter_shards of a question that was changed."""
+    cache.delete(_shards_key(question_id))
+
+
+_INCREMENT_SQL = """
+    INSERT INTO {table} ({columns}) VALUES {values}
+    ON CONFLICT ({unique}) DO UPDATE SET {count} = {table}.{count} + EXCLUDED.{count}
+"""
+
+
+def add_to_counts(model, fields, unique_fields, count_field, deltas):
+    """
+    Add each delta of a {(values of `fields`): delta} dict to the
+    `count_field` of the `model` row identified by its `unique_fields`,
+    creating the rows that are missing. On PostgreSQL this is a single
+    INSERT ... ON CONFLICT DO UPDATE statement.
+    """
+    deltas = {key: delta for key, delta in deltas.items() if delta}
+    if not deltas:
+        return
+    if connection.vendor == 'postgresql':
+        qn = connection.ops.quote_name
+
+        def column(name):
+            return qn(model._meta.get_field(name).column)
+        row = '(' + ', '.join(['%s'] * (len(fields) + 1)) + ')'
+        sql = _INCREMENT_SQL.format(
+            table=qn(model._meta.db_table),
+            columns=', '.join(column(name) for name in (*fields, count_field)),
+            values=', '.join([row] * len(deltas)),
+            unique=', '.join(column(name) for name in unique_fields),
+            count=column(count_field),
+        )
+        # In a consistent order, so concurrent statements can't deadlock
+        params = [value for key, delta in sorted(deltas.items()) for value in (*key, delta)]
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+        return
+    for key, delta in deltas.items():
+        values = dict(zip(fields, key))
+        rows = model.objects.filter(**{name: values[name] for name in unique_fields})
+        if rows.update(**{count_field: F(count_field) + delta}):
+            continue
+        try:
+            with transaction.atomic():
+                model.objects.create(**values, **{count_field: delta})
+        except IntegrityError:
+            # Created by a concurrent transaction since the update
+            rows.update(**{count_field: F(count_field) + delta})
+
+
+def record_vote_change(question_id, old_choice_id, new_choice_id, use_shards=True):
+    """
+    Mirror a vote change on the counters.
+
+    `old_choice_id` is None for a new vote and `new_choice_id` is None for
+    a deleted vote. Call this inside the transaction that changes the vote.
+    """
+    record_vote_changes([(question_id, old_choice_id, new_choice_id)], use_shards)
+
+
+def record_vote_changes(changes, use_shards=True):
+    """
+    Mirror many vote changes, given as (question_id, old_choice_id,
+    new_choice_id) tuples like record_vote_change(), with one update per
+    changed counter. Changes on questions with counter_shards go to a
+    random shard, unless `use_shards` is False, as for votes deleted with
+    their choice, whose shards may already be gone.
+    """
+    if not counters_enabled():
+        return
+    changes = [change for change in changes if change[1] != change[2]]
+    shards = counter_shards({question_id for question_id, _, _ in changes}) if use_shards else {}
+    choice_deltas = Counter()
+    question_deltas = Counter()
+    shard_deltas = Counter()
+    for question_id, old_choice_id, new_choice_id in changes:
+        count = shards.get(question_id, 0)
+        for choice_id, delta in ((old_choice_id, -1), (new_choice_id, 1)):
+            if choice_id is None:
+                continue
+            if count:
+                shard_deltas[(question_id, choice_id, random.randrange(count))] += delta
+            else:
+                choice_deltas[choice_id] += delta
+        if count:
+            continue
+        if old_choice_id is None:
+            question_deltas[question_id] += 1
+        elif new_choice_id is None:
+            question_deltas[question_id] -= 1
+    for choice_id, delta in choice_deltas.items():
+        if delta:
+            Choice.objects.filter(pk=choice_id).update(vote_count=F('vote_count') + delta)
+    for question_id, delta in question_deltas.items():
+        if delta:
+            Question.objects.filter(pk=question_id).update(total_votes=F('total_votes') + delta)
+    add_to_counts(ChoiceCounterShard, ('question_id', 'choice_id', 'shard'), ('choice_id', 'shard'),
+                  'count', shard_deltas)
+
+
+def compact_shards(choice_ids=None):
+    """
+    Fold the counter shards, or only those of the `choice_ids`, into the
+    vote_count of their choices and the total_votes of their questions,
+    and delete them. Returns the number of shards folded.
+    """
+    shards = ChoiceCounterShard.objects.select_for_update()
+    if choice_ids is not None:
+        shards = shards.filter(choice_id__in=choice_ids)
+    with transaction.atomic():
+        # Lock the shards, so votes wait instead of adding to folded ones
+        shards = list(shards.values_list('pk', 'question_id', 'choice_id', 'count'))
+        choice_totals = Counter()
+        question_totals = Counter()
+        for _, question_id, choice_id, count in shards:
+            choice_totals[choice_id] += count
+            question_totals[question_id] += count
+        for choice_id, total in sorted(choice_totals.items()):
+            if total:
+                Choice.objects.filter(pk=choice_id).update(vote_count=F('vote_count') + total)
+        for question_id, total in sorted(question_totals.items()):
+            if total:
+                Question.objects.filter(pk=question_id).update(total_votes=F('total_votes') + total)
+        ChoiceCounterShard.objects.filter(pk__in=[pk for pk, _, _, _ in shards]).delete()
+    return len(shards)
+
+
+def reconcile_counters():
+    """
+    Recount the counters that drifted from the Vote table, folding the
+    counter shards into them first.
+
+    Returns a (choices, questions) tuple with the number of rows fixed.
+    """
+    compact_shards()
+    choice_votes = Coalesce(Subquery(
+        Vote.objects.filter(choice=OuterRef('pk')).order_by()
+        .values('choice').annotate(total=Count('pk')).values('total')
+    ), 0)
+    stale_choices = Choice.objects.annotate(actual=choice_votes) \
+        .exclude(vote_count=F('actual'))
+    choices_fixed = Choice.objects.filter(pk__in=stale_choices.values('pk')) \
+        .update(vote_count=choice_votes)
+
+    question_votes = Coalesce(Subquery(
+        Choice.objects.filter(question=OuterRef('pk')).order_by()
+        .values('question').annotate(total=Sum('vote_count')).values('total')
+    ), 0)
+    stale_questions = Question.objects.annotate(actual=question_votes) \
+        .exclude(total_votes=F('actual'))
+    questions_fixed = Question.objects.filter(pk__in=stale_questions.values('pk')) \
+        .update(total_votes=question_votes)
+    return choices_fixed, questions_fixed
@@ -0,0 +1,201 @@
+"""Write-behind vote ingestion for traffic spikes.
+
+With POLLS_VOTE_INGESTION set to 'queued', the vote view validates a vote
+and appends it to a durable local journal (a SQLite file at
+POLLS_VOTE_JOURNAL) instead of writing it to the database. The
+flush_vote_journal command then writes the journal to the database in
+batches of upserts, where the last vote of a user on a question wins.
+
+The lag of the journal is bounded: while its oldest vote is older than
+POLLS_VOTE_QUEUE_MAX_LAG seconds, or it holds more than
+POLLS_VOTE_QUEUE_MAX_PENDING votes, votes are written directly again.
+Voters read their own writes: their pending votes are merged into their
+vote map, which the detail page reads. A vote written directly drops the
+user's pending votes on the question, and journaled votes are written
+with the time they were queued, so a late flush never undoes a newer vote.
+Votes whose user or choice was deleted while they were pending are
+dropped, with a warning, when they are flushed.
+
+Run a single flush worker per journal.
+"""
+import datetime
+import functools
+import logging
+import sqlite3
+import threading
+import time
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import transaction
+
+from . import voting
+from .broadcast import get_broadcaster
+from .models import Choice
+from .results import invalidate_results
+
+logger = logging.getLogger('polls')
+
+_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS vote_journal (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        question_id INTEGER NOT NULL,
+        choice_id INTEGER NOT NULL,
+        queued_at REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS vote_journal_user ON vote_journal (user_id, seq);
+"""
+
+
+class VoteJournal:
+    """Append-only journal of the votes waiting to be written, in a SQLite file."""
+
+    def __init__(self, path):
+        self.path = str(path)
+        self._local = threading.local()
+
+    def _connection(self):
+        """Return this thread's connection to the journal, in autocommit mode."""
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=FULL')
+            connection.executescript(_SCHEMA)
+            self._local.connection = connection
+        return connection
+
+    def append(self, user_id, question_id, choice_id):
+        """Durably append a vote to the journal."""
+        self._connection().execute(
+            'INSERT INTO vote_journal (user_id, question_id, choice_id, queued_at) '
+            'VALUES (?, ?, ?, ?)', (user_id, question_id, choice_id, time.time()))
+
+    def pending_votes(self, user_id):
+        """Return a {question_id: choice_id} map of a user's pending votes."""
+        rows = self._connection().execute(
+            'SELECT question_id, choice_id FROM vote_journal WHERE user_id = ? ORDER BY seq',
+            (user_id,))
+        return dict(rows)
+
+    def read_batch(self, size):
+        """
+        Return up to `size` of the oldest pending votes as (seq, user_id,
+        question_id, choice_id, queued_at) tuples.
+        """
+        return self._connection().execute(
+            'SELECT seq, user_id, question_id, choice_id, queued_at FROM vote_journal '
+            'ORDER BY seq LIMIT ?', (size,)).fetchall()
+
+    def discard(self, votes):
+        """Remove the pending votes of the given (user_id, question_id) pairs."""
+        self._connection().executemany(
+            'DELETE FROM vote_journal WHERE user_id = ? AND question_id = ?', votes)
+
+    def remove_through(self, seq):
+        """Remove the pending votes up to and including `seq`."""
+        self._connection().execute('DELETE FROM vote_journal WHERE seq <= ?', (seq,))
+
+    def lag(self):
+        """
+        Return the number of pending votes and the age in seconds of the
+        oldest one, without scanning the journal.
+        """
+        oldest = self._connection().execute(
+            'SELECT seq, queued_at FROM vote_journal ORDER BY seq LIMIT 1').fetchone()
+        if oldest is None:
+            return 0, 0.0
+        newest_seq = self._connection().execute('SELECT MAX(seq) FROM vote_journal').fetchone()[0]
+        return newest_seq - oldest[0] + 1, max(0.0, time.time() - oldest[1])
+
+
+@functools.cache
+def _journal(path):
+    return VoteJournal(path)
+
+
+def get_journal():
+    """Return the journal at POLLS_VOTE_JOURNAL."""
+    return _journal(str(settings.POLLS_VOTE_JOURNAL))
+
+
+def queue_enabled():
+    """Return True if votes are ingested through the journal."""
+    return settings.POLLS_VOTE_INGESTION == 'queued'
+
+
+def queue_accepting():
+    """
+    Return True if a new vote should go to the journal: queued ingestion
+    is on and the journal's lag is within its bounds.
+    """
+    if not queue_enabled():
+        return False
+    pending, age = get_journal().lag()
+    return (pending < settings.POLLS_VOTE_QUEUE_MAX_PENDING
+            and age < settings.POLLS_VOTE_QUEUE_MAX_LAG)
+
+
+def enqueue_vote(user, choice):
+    """Append `user`'s validated vote for `choice` to the journal."""
+    get_journal().append(user.pk, choice.question_id, choice.pk)
+
+
+def pending_votes(user):
+    """Return a {question_id: choice_id} map of the user's votes still in the journal."""
+    if not queue_enabled():
+        return {}
+    return get_journal().pending_votes(user.pk)
+
+
+def discard_pending(votes):
+    """
+    Drop the pending votes of the (user_id, question_id) pairs of votes
+    just written directly, which replace them.
+    """
+    if queue_enabled():
+        get_journal().discard(list(votes))
+
+
+def _valid_entries(batch):
+    """Return the entries of a batch whose user and choice still exist, in two queries."""
+    user_ids = set(User.objects.filter(pk__in={entry[1] for entry in batch})
+                   .values_list('pk', flat=True))
+    choices = set(Choice.objects.filter(pk__in={entry[3] for entry in batch})
+                  .values_list('pk', 'question_id'))
+    valid = []
+    for entry in batch:
+        _, user_id, question_id, choice_id, _ = entry
+        if user_id in user_ids and (choice_id, question_id) in choices:
+            valid.append(entry)
+        else:
+            logger.warning("Dropped the queued vote of user %s for choice %s in question %s; "
+                           "it no longer exists", user_id, choice_id, question_id,
+                           extra={'event': 'vote_dropped', 'user_id': user_id,
+                                  'question': question_id, 'choice': choice_id})
+    return valid
+
+
+def flush(batch_size=None):
+    """
+    Write one batch of pending votes to the database and remove it from
+    the journal. The voters' cached vote maps are dropped, as the votes
+    leave the journal they were merged from. Returns the number of
+    journal entries flushed, dropped ones included.
+    """
+    journal = get_journal()
+    batch = journal.read_batch(batch_size or settings.POLLS_VOTE_FLUSH_BATCH)
+    if not batch:
+        return 0
+    valid = _valid_entries(batch)
+    voting.cast_votes(
+        (user_id, question_id, choice_id,
+         datetime.datetime.fromtimestamp(queued_at, tz=datetime.timezone.utc))
+        for _, user_id, question_id, choice_id, queued_at in valid)
+    for question_id in {entry[2] for entry in valid}:
+        invalidate_results(question_id)
+        transaction.on_commit(lambda question_id=question_id: get_broadcaster().notify(question_id))
+    voting.forget_user_votes_many({entry[1] for entry in valid})
+    journal.remove_through(batch[-1][0])
+    return len(batch)
@@ -0,0 +1,243 @@
+"""Process-wide counters of how the application uses its resources.
+
+The counters belong to the current process; each worker of a multi-process
+server keeps its own.
+
+polls.middleware.RequestMetricsMiddleware measures each request: wall time, the number and
+time of its database queries, and the time spent rendering templates
+(through InstrumentedDjangoTemplates, which includes queries run by the
+templates). The measurements are logged at DEBUG level as structured
+fields on the 'polls.requests' logger, which only lets them through with
+LOG_REQUESTS on, and kept as histograms per URL name, which
+render_metrics() exports in the Prometheus text format. Requests slower
+than POLLS_SLOW_REQUEST_MS are always logged at WARNING level, with their
+SQL if the request was sampled to keep it.
+"""
+import bisect
+import contextvars
+import logging
+import random
+import threading
+import time
+
+from django.conf import settings
+from django.db import connections
+from django.template.backends.django import DjangoTemplates, Template
+
+logger = logging.getLogger('polls.requests')
+
+_lock = threading.Lock()
+_requests = 0
+_connections_opened = {}
+
+
+def record_request():
+    """Count a request handled by this process."""
+    global _requests
+    with _lock:
+        _requests += 1
+
+
+def record_connection(alias):
+    """Count a database connection opened, or borrowed from a pool, for `alias`."""
+    with _lock:
+        _connections_opened[alias] = _connections_opened.get(alias, 0) + 1
+
+
+def reset():
+    """Set the counters and histograms back to zero."""
+    global _requests
+    with _lock:
+        _requests = 0
+        _connections_opened.clear()
+        for histogram in HISTOGRAMS:
+            histogram.series.clear()
+
+
+def connection_usage():
+    """
+    Return a report of the database connections of this process: for each
+    alias the connections opened, and opened per request, plus the
+    statistics of its connection pool, if it has one.
+    """
+    with _lock:
+        requests = _requests
+        opened = dict(_connections_opened)
+    report = {'requests': requests, 'databases': {}}
+    for alias in connections:
+        pool = getattr(connections[alias], 'pool', None)
+        report['databases'][alias] = {
+            'connections_opened': opened.get(alias, 0),
+            'opened_per_request': opened.get(alias, 0) / requests if requests else 0.0,
+            'pool': pool.get_stats() if pool is not None else None,
+        }
+    return report
+
+
+class Histogram:
+    """A Prometheus-style histogram with one series per view."""
+
+    def __init__(self, name, description, buckets):
+        self.name = name
+        self.description = description
+        self.buckets = buckets
+        # {view: [count per bucket (the last is +Inf), sum]}
+        self.series = {}
+
+    def observe(self, view, value):
+        """Add a measurement of `view`; call it while holding the lock."""
+        series = self.series.setdefault(view, [[0] * (len(self.buckets) + 1), 0.0])
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def render(self):
+        """Return the histogram in the Prometheus text format, as lines."""
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} histogram']
+        for view, (counts, total) in sorted(self.series.items()):
+            cumulative = 0
+            for bound, count in zip([*self.buckets, '+Inf'], counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{view="{view}",le="{bound}"}} {cumulative}')
+            lines.append(f'{self.name}_sum{{view="{view}"}} {total}')
+            lines.append(f'{self.name}_count{{view="{view}"}} {cumulative}')
+        return lines
+
+
+SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+REQUEST_SECONDS = Histogram('polls_request_duration_seconds',
+                            "Wall time of requests by view.", SECONDS_BUCKETS)
+DB_SECONDS = Histogram('polls_db_duration_seconds',
+                       "Time spent in database queries per request by view.", SECONDS_BUCKETS)
+DB_QUERIES = Histogram('polls_db_queries', "Database queries per request by view.", QUERY_BUCKETS)
+RENDER_SECONDS = Histogram('polls_template_render_seconds',
+                           "Time spent rendering templates per request by view.", SECONDS_BUCKETS)
+HISTOGRAMS = (REQUEST_SECONDS, DB_SECONDS, DB_QUERIES, RENDER_SECONDS)
+
+
+class RequestMetrics:
+    """The measurements of the request being handled."""
+
+    def __init__(self, keep_sql=False):
+        self.queries = 0
+        self.db_time = 0.0
+        self.render_time = 0.0
+        self.rendering = False
+        # (sql, params, seconds) of every query, when sampled
+        self.statements = [] if keep_sql else None
+
+
+_current = contextvars.ContextVar('polls_request_metrics', default=None)
+
+
+def query_wrapper(execute, sql, params, many, context):
+    """Database execute wrapper timing the queries of the current request."""
+    metrics = _current.get()
+    if metrics is None:
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        elapsed = time.perf_counter() - start
+        metrics.queries += 1
+        metrics.db_time += elapsed
+        if metrics.statements is not None:
+            metrics.statements.append((sql, params, elapsed))
+
+
+def instrument_connection(connection):
+    """Install query_wrapper on a database connection once."""
+    if query_wrapper not in connection.execute_wrappers:
+        connection.execute_wrappers.append(query_wrapper)
+
+
+class InstrumentedTemplate(Template):
+    """A Django template timing its rendering for the current request."""
+
+    def render(self, context=None, request=None):
+        metrics = _current.get()
+        if metrics is None or metrics.rendering:
+            return super().render(context, request)
+        metrics.rendering = True
+        start = time.perf_counter()
+        try:
+            return super().render(context, request)
+        finally:
+            metrics.rendering = False
+            metrics.render_time += time.perf_counter() - start
+
+
+class InstrumentedDjangoTemplates(DjangoTemplates):
+    """The Django template backend, with rendering timed by the instrumentation."""
+
+    def from_string(self, template_code):
+        return InstrumentedTemplate(self.engine.from_string(template_code), self)
+
+    def get_template(self, template_name):
+        return InstrumentedTemplate(super().get_template(template_name).template, self)
+
+
+def start_request():
+    """
+    Start measuring a request in the current context. Returns its
+    RequestMetrics and the token to pass to finish_request().
+    """
+    for connection in connections.all(initialized_only=True):
+        instrument_connection(connection)
+    metrics = RequestMetrics(keep_sql=random.random() < settings.POLLS_SLOW_SQL_SAMPLE_RATE)
+    return metrics, _current.set(metrics)
+
+
+def finish_request(request, response, metrics, token, duration):
+    """Stop measuring a request, then log and record its measurements."""
+    _current.reset(token)
+    match = request.resolver_match
+    view = match.view_name if match else 'unresolved'
+    with _lock:
+        REQUEST_SECONDS.observe(view, duration)
+        DB_SECONDS.observe(view, metrics.db_time)
+        DB_QUERIES.observe(view, metrics.queries)
+        RENDER_SECONDS.observe(view, metrics.render_time)
+    fields = {
+        'view': view,
+        'method': request.method,
+        'status': response.status_code,
+        'duration_ms': round(duration * 1000, 2),
+        'db_queries': metrics.queries,
+        'db_ms': round(metrics.db_time * 1000, 2),
+        'render_ms': round(metrics.render_time * 1000, 2),
+    }
+    logger.debug("%s %s %s %sms, %s queries in %sms, rendered in %sms",
+                request.method, view, response.status_code, fields['duration_ms'],
+                metrics.queries, fields['db_ms'], fields['render_ms'], extra=fields)
+    if duration * 1000 < settings.POLLS_SLOW_REQUEST_MS:
+        return
+    if metrics.statements is None:
+        logger.warning("Slow request %s %s (%sms), %s queries in %sms",
+                       request.method, request.path, fields['duration_ms'],
+                       metrics.queries, fields['db_ms'], extra=fields)
+    else:
+        statements = '\n'.join(f"  {seconds * 1000:.2f}ms: {sql} {params!r}"
+                               for sql, params, seconds in metrics.statements)
+        logger.warning("Slow request %s %s (%sms), its SQL:\n%s",
+                       request.method, request.path, fields['duration_ms'], statements,
+                       extra={**fields, 'sql': metrics.statements})
+
+
+def render_metrics():
+    """Return the metrics of this process in the Prometheus text format."""
+    usage = connection_usage()
+    lines = ['# HELP polls_requests_total Requests handled by this process.',
+             '# TYPE polls_requests_total counter',
+             f'polls_requests_total {usage["requests"]}',
+             '# HELP polls_db_connections_opened_total Database connections opened by this process.',
+             '# TYPE polls_db_connections_opened_total counter']
+    for alias, database in usage['databases'].items():
+        lines.append(f'polls_db_connections_opened_total{{database="{alias}"}} '
+                     f'{database["connections_opened"]}')
+    with _lock:
+        for histogram in HISTOGRAMS:
+            lines.extend(histogram.render())
+    return '\n'.join(lines) + '\n'
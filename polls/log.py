@@ -0,0 +1,152 @@
+"""Non-blocking, structured logging.
+
+QueueingStreamHandler only puts records on a bounded in-memory queue; a
+background thread formats them and writes them to the stream, so a slow
+log sink never holds up a request. When the queue is full, records are
+dropped and counted instead of blocking. JsonFormatter writes each
+record as one JSON object with the fields passed in `extra`, and
+RateLimitFilter keeps repeated events, such as failed logins from one
+IP address, from flooding the log.
+
+This module is loaded by settings.LOGGING, before the apps are ready, so
+it must not import models.
+"""
+import atexit
+import datetime
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from logging.handlers import QueueHandler, QueueListener
+
+# Attributes every LogRecord has; the others come from `extra`
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats a record as a JSON object, with the fields passed in `extra`."""
+
+    def format(self, record):
+        data = {
+            'time': datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc)
+                    .isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for name, value in vars(record).items():
+            if name not in _RECORD_ATTRIBUTES and name != 'rate_limit_key':
+                data[name] = value
+        if record.exc_info:
+            data['exception'] = self.formatException(record.exc_info)
+        return json.dumps(data, default=str)
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Let through at most `rate` records with the same `rate_limit_key`
+    (set in `extra`) every `per` seconds. The first record of the next
+    period reports how many were suppressed. Records without a key pass.
+    """
+
+    def __init__(self, rate=10, per=60, max_keys=10000):
+        super().__init__()
+        self.rate = rate
+        self.per = per
+        self.max_keys = max_keys
+        self._windows = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        key = getattr(record, 'rate_limit_key', None)
+        if key is None:
+            return True
+        now = time.monotonic()
+        with self._lock:
+            window = self._windows.get(key)
+            if window is None or now - window[0] >= self.per:
+                if len(self._windows) >= self.max_keys:
+                    self._windows = {k: w for k, w in self._windows.items() if now - w[0] < self.per}
+                suppressed = window[2] if window else 0
+                self._windows[key] = window = [now, 0, 0]
+                if suppressed:
+                    record.suppressed = suppressed
+            if window[1] >= self.rate:
+                window[2] += 1
+                return False
+            window[1] += 1
+            return True
+
+
+class _Listener(QueueListener):
+    def enqueue_sentinel(self):
+        # Wait for room, as records are still being written on stop
+        self.queue.put(self._sentinel)
+
+
+class QueueingStreamHandler(QueueHandler):
+    """
+    Hands records to a background thread that formats them and writes them
+    to `stream` (stderr by default). At most `maxsize` records wait.
+    """
+
+    def __init__(self, stream=None, maxsize=10000):
+        super().__init__(queue.Queue(maxsize))
+        self.target = logging.StreamHandler(stream)
+        self.dropped = 0
+        self._listener = None
+        self._pid = None
+        self._start_lock = threading.Lock()
+
+    def setFormatter(self, fmt):
+        # Records are formatted by the background thread's handler
+        self.target.setFormatter(fmt)
+
+    def prepare(self, record):
+        # Unlike QueueHandler, leave the message to be formatted lazily
+        return record
+
+    def _ensure_listener(self):
+        """Start the background thread, again in each forked worker process."""
+        if self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            # A forked process has the queue but not the thread draining it
+            self.queue = queue.Queue(self.queue.maxsize)
+            self._listener = _Listener(self.queue, self.target)
+            self._listener.start()
+            self._pid = os.getpid()
+            atexit.register(self.flush_and_stop)
+
+    def enqueue(self, record):
+        self._ensure_listener()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            return
+        if self.dropped:
+            dropped, self.dropped = self.dropped, 0
+            notice = logging.LogRecord(record.name, logging.WARNING, __file__, 0,
+                                       "Dropped %d log records while the log queue was full",
+                                       (dropped,), None)
+            try:
+                self.queue.put_nowait(notice)
+            except queue.Full:
+                self.dropped += dropped
+
+    def flush_and_stop(self):
+        """Write the waiting records and stop the background thread."""
+        if self._listener is not None and self._pid == os.getpid():
+            self._listener.stop()
+            self._listener = None
+            self._pid = None
+        self.target.flush()
+
+    def close(self):
+        self.flush_and_stop()
+        super().close()
@@ -0,0 +1,61 @@
+import os
+import time
+
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+
+from polls import bootstrap
+from polls.transfer import TransferError
+
+
+class Command(BaseCommand):
+    help = ("Prepare the database on container start: apply pending migrations, create the "
+            "database cache table, import fixtures whose contents changed and create the "
+            "admin account if missing. "
+            "Does nothing that was already done.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('fixtures', nargs='*',
+                            help="fixture files to import (default: POLLS_BOOTSTRAP_FIXTURES)")
+        parser.add_argument('--admin-username',
+                            default=os.environ.get('DJANGO_SUPERUSER_USERNAME', 'admin'))
+        parser.add_argument('--admin-email',
+                            default=os.environ.get('DJANGO_SUPERUSER_EMAIL', 'admin@example.com'))
+        parser.add_argument('--no-admin', action='store_true',
+                            help="don't create the admin account")
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        fixtures = options['fixtures'] or bootstrap.default_fixtures()
+        with bootstrap.bootstrap_lock():
+            step = time.perf_counter()
+            pending = bootstrap.pending_migrations()
+            if pending:
+                call_command('migrate', interactive=False, verbosity=options['verbosity'])
+            self.report(f"Applied {len(pending)} migrations", step)
+
+            # Creates the table of a database cache; does nothing for other caches
+            step = time.perf_counter()
+            call_command('createcachetable', verbosity=0)
+            self.report("Checked the cache table", step)
+
+            step = time.perf_counter()
+            try:
+                loaded = bootstrap.load_fixtures(fixtures)
+            except (OSError, TransferError) as error:
+                raise CommandError(error)
+            skipped = len(fixtures) - len(loaded)
+            self.report(f"Imported {len(loaded)} fixtures, {skipped} unchanged", step)
+
+            if not options['no_admin']:
+                step = time.perf_counter()
+                created = bootstrap.ensure_admin(options['admin_username'], options['admin_email'],
+                                                 os.environ.get('DJANGO_SUPERUSER_PASSWORD'))
+                self.report(f"Admin '{options['admin_username']}' "
+                            f"{'created' if created else 'already exists'}", step)
+        self.stdout.write(self.style.SUCCESS(
+            f"Bootstrap finished in {time.perf_counter() - start:.2f}s."
+        ))
+
+    def report(self, message, started):
+        self.stdout.write(f"  {message} ({time.perf_counter() - started:.2f}s)")
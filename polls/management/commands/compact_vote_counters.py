@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+
+from polls.counters import compact_shards
+
+
+class Command(BaseCommand):
+    help = ("Fold the counter shards of questions with counter_shards into their "
+            "Choice and Question vote counters. Run it periodically, e.g. every minute.")
+
+    def handle(self, *args, **options):
+        folded = compact_shards()
+        self.stdout.write(self.style.SUCCESS(f"Compacted {folded} counter shards."))
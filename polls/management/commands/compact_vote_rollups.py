@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+
+from polls.trends import compact_rollups, rebuild_rollups
+
+
+class Command(BaseCommand):
+    help = ("Fold the minute vote rollups older than POLLS_TREND_MINUTE_RETENTION hours "
+            "into hour rollups. Run it periodically, e.g. hourly.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rebuild', action='store_true',
+                            help="replace the rollups with ones counted from the current votes, "
+                                 "after importing or seeding votes")
+
+    def handle(self, *args, **options):
+        if options['rebuild']:
+            created = rebuild_rollups()
+            self.stdout.write(self.style.SUCCESS(f"Rebuilt {created} vote rollups."))
+            return
+        folded = compact_rollups()
+        self.stdout.write(self.style.SUCCESS(f"Compacted {folded} minute vote rollups."))
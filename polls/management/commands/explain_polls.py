@@ -0,0 +1,67 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.test import RequestFactory
+
+from polls import views
+from polls.models import Question, Vote
+from polls.results import tally_queryset
+
+
+class Command(BaseCommand):
+    help = ("Print the database EXPLAIN plan of every query the polls views run, "
+            "so changes to the query plans show up in review.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--question', type=int,
+                            help="question to explain the detail, results and vote "
+                                 "queries for (default: the latest published one)")
+        parser.add_argument('--user', type=int,
+                            help="user to explain the vote queries for (default: the first user)")
+        parser.add_argument('--analyze', action='store_true',
+                            help="run the queries and show actual timings (PostgreSQL)")
+
+    def handle(self, *args, **options):
+        question = self.get_question(options['question'])
+        user_id = options['user'] or User.objects.order_by('pk').values_list('pk', flat=True).first()
+        explain_options = {'analyze': True} if options['analyze'] else {}
+        request = RequestFactory().get('/')
+
+        index = views.IndexView()
+        index.setup(request)
+        open_index = views.IndexView()
+        open_index.setup(RequestFactory().get('/', {'status': 'open'}))
+        detail = views.DetailView()
+        detail.setup(request, pk=question.pk)
+        results = views.ResultsView()
+        results.setup(request, pk=question.pk)
+
+        plans = [
+            ('polls:index', 'latest questions', index.get_queryset()),
+            ('polls:index', 'open questions', open_index.get_queryset()),
+            ('polls:detail', 'question', detail.get_queryset().filter(pk=question.pk)),
+            ('polls:detail', 'choices', question.choice_set.all()),
+            ('polls:detail', 'user votes',
+             Vote.objects.filter(user_id=user_id).values_list('question_id', 'choice_id')),
+            ('polls:results', 'question', results.get_queryset().filter(pk=question.pk)),
+            ('polls:results', 'tallies', tally_queryset(question)),
+            ('polls:vote', 'question', Question.objects.filter(pk=question.pk).order_by('pk')[:1]),
+            ('polls:vote', 'choice', question.choice_set.filter(pk=0)),
+            ('polls:vote', 'previous vote',
+             Vote.objects.filter(user_id=user_id, question_id=question.pk)
+             .values_list('choice_id', flat=True)),
+        ]
+        for view_name, label, queryset in plans:
+            self.stdout.write(self.style.MIGRATE_HEADING(f"{view_name}: {label}"))
+            self.stdout.write(str(queryset.query))
+            self.stdout.write(queryset.explain(**explain_options))
+            self.stdout.write("")
+
+    def get_question(self, question_id):
+        """Return the question to explain the per-question queries with."""
+        questions = Question.objects.order_by('-pub_date')
+        if question_id is not None:
+            questions = questions.filter(pk=question_id)
+        question = questions.is_published().first()
+        if question is None:
+            raise CommandError("There is no published question to explain the queries with.")
+        return question
@@ -0,0 +1,53 @@
+import sys
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from polls.transfer import EXPORT_MODELS, FORMATS, WRITERS, TransferError, export_rows, \
+    guess_format
+
+
+class Command(BaseCommand):
+    help = ("Stream users, polls and votes to a fixture JSON, JSONL or CSV file, "
+            "reading the database in batches.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('output', help="file to write, or - for stdout")
+        parser.add_argument('--format', choices=FORMATS,
+                            help="format of the output (default: from its extension)")
+        parser.add_argument('--model', action='append', dest='models',
+                            help=f"model to export, may be repeated "
+                                 f"(default: {', '.join(EXPORT_MODELS)}); CSV takes one model")
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help="rows read per query")
+
+    def handle(self, *args, **options):
+        output = options['output']
+        try:
+            fmt = options['format'] or ('json' if output == '-' else guess_format(output))
+        except TransferError as error:
+            raise CommandError(error)
+        models = options['models'] or EXPORT_MODELS
+        if fmt == 'csv' and len(models) != 1:
+            raise CommandError("CSV export takes exactly one --model.")
+
+        rows = 0
+
+        def counted(rows_iter):
+            nonlocal rows
+            for row in rows_iter:
+                rows += 1
+                yield row
+
+        start = time.perf_counter()
+        try:
+            if output == '-':
+                WRITERS[fmt](counted(export_rows(models, options['batch_size'])), sys.stdout)
+            else:
+                with open(output, 'w', encoding='utf-8', newline='') as stream:
+                    WRITERS[fmt](counted(export_rows(models, options['batch_size'])), stream)
+        except TransferError as error:
+            raise CommandError(error)
+        elapsed = time.perf_counter() - start
+        self.stderr.write(f"Exported {rows} rows in {elapsed:.2f}s "
+                          f"({rows / max(elapsed, 1e-9):.0f} rows/s).")
@@ -0,0 +1,46 @@
+import logging
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from polls import ingest
+
+logger = logging.getLogger('polls')
+
+
+class Command(BaseCommand):
+    help = ("Write the votes queued in the vote journal to the database in batches. "
+            "Run a single worker per journal.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=settings.POLLS_VOTE_FLUSH_BATCH,
+                            help="votes written per batch")
+        parser.add_argument('--loop', action='store_true',
+                            help="keep flushing new votes until interrupted")
+        parser.add_argument('--interval', type=float, default=1.0,
+                            help="seconds to wait for new votes when looping")
+
+    def handle(self, *args, **options):
+        journal = ingest.get_journal()
+        while True:
+            flushed = 0
+            start = time.perf_counter()
+            try:
+                while batch := ingest.flush(options['batch_size']):
+                    flushed += batch
+            except Exception:
+                if not options['loop']:
+                    raise
+                # The batch stays in the journal and is retried after the interval
+                logger.exception("Could not flush the vote journal")
+                close_old_connections()
+            if flushed or not options['loop']:
+                pending, age = journal.lag()
+                elapsed = time.perf_counter() - start
+                self.stdout.write(f"Flushed {flushed} votes in {elapsed:.2f}s; "
+                                  f"lag: {pending} pending, oldest {age:.1f}s")
+            if not options['loop']:
+                return
+            time.sleep(options['interval'])
@@ -0,0 +1,50 @@
+import sys
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from polls.transfer import FORMATS, Importer, TransferError, guess_format, read_rows
+
+
+class Command(BaseCommand):
+    help = ("Stream users, polls and votes from fixture JSON, JSONL or CSV files into the "
+            "database in batches. Rows are upserted on their primary key, so an import "
+            "can be run again; votes conflicting with another vote of their user on "
+            "the same question are skipped.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('files', nargs='+', help="files to import, or - for stdin")
+        parser.add_argument('--format', choices=FORMATS,
+                            help="format of the files (default: from their extension)")
+        parser.add_argument('--model', help="model of the rows of CSV files, e.g. polls.vote")
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help="rows written per batch")
+
+    def handle(self, *args, **options):
+        importer = Importer(options['batch_size'])
+        start = time.perf_counter()
+        try:
+            for path in options['files']:
+                fmt = options['format'] or guess_format(path)
+                if path == '-':
+                    self._import(importer, sys.stdin, fmt, options['model'])
+                else:
+                    with open(path, encoding='utf-8', newline='') as stream:
+                        self._import(importer, stream, fmt, options['model'])
+            counts = importer.finish()
+        except TransferError as error:
+            raise CommandError(error)
+        elapsed = time.perf_counter() - start
+        rows = sum(counts.values())
+        for label, count in counts.items():
+            self.stdout.write(f"  {label}: {count} rows")
+        for label, count in importer.conflicts.items():
+            self.stdout.write(self.style.WARNING(
+                f"  {label}: {count} conflicting rows skipped"))
+        self.stdout.write(self.style.SUCCESS(
+            f"Imported {rows} rows in {elapsed:.2f}s ({rows / max(elapsed, 1e-9):.0f} rows/s)."
+        ))
+
+    def _import(self, importer, stream, fmt, model):
+        for label, pk, fields in read_rows(stream, fmt, model):
+            importer.add(label, pk, fields, from_csv=fmt == 'csv')
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+
+from polls.counters import reconcile_counters
+
+
+class Command(BaseCommand):
+    help = "Recount the persisted Choice and Question vote counters from the Vote table."
+
+    def handle(self, *args, **options):
+        choices_fixed, questions_fixed = reconcile_counters()
+        self.stdout.write(self.style.SUCCESS(
+            f"Reconciled {choices_fixed} choice and {questions_fixed} question counters."
+        ))
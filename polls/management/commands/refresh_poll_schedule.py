@@ -0,0 +1,31 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from polls.schedule import current_schedule
+
+
+class Command(BaseCommand):
+    help = ("Rebuild the schedule of when polls next open and close. With --loop, rebuild "
+            "it again as each poll opens or closes, so requests don't have to.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--loop', action='store_true',
+                            help="keep rebuilding at each boundary until interrupted")
+        parser.add_argument('--max-interval', type=float, default=60.0,
+                            help="most seconds to wait between rebuilds when looping")
+
+    def handle(self, *args, **options):
+        while True:
+            schedule = current_schedule(rebuild=True)
+            boundary = schedule.next_boundary()
+            self.stdout.write(f"Next change: "
+                              f"{boundary.isoformat() if boundary else 'none scheduled'}")
+            if not options['loop']:
+                return
+            wait = options['max_interval']
+            if boundary is not None:
+                wait = min(wait, (boundary - timezone.now()).total_seconds())
+            # A poll closes just after its end date
+            time.sleep(max(wait, 0) + 0.001)
@@ -0,0 +1,38 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from polls.seeding import DEFAULT_PASSWORD, seed_dataset
+
+
+class Command(BaseCommand):
+    help = ("Insert a synthetic dataset of questions, choices, users and votes for load "
+            "testing, in bulk. Don't run it against a production database.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--questions', type=int, default=100)
+        parser.add_argument('--choices', type=int, default=4, help="choices per question")
+        parser.add_argument('--users', type=int, default=1000)
+        parser.add_argument('--votes', type=int, default=10000,
+                            help="votes, each by a different user and question pair")
+        parser.add_argument('--closed', type=float, default=0.1,
+                            help="share of the questions that have ended")
+        parser.add_argument('--prefix', default='bench', help="prefix of the usernames")
+        parser.add_argument('--password', default=DEFAULT_PASSWORD,
+                            help="password of every seeded user")
+        parser.add_argument('--seed', type=int, default=0, help="random seed")
+        parser.add_argument('--batch-size', type=int, default=5000, help="rows per insert")
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        created = seed_dataset(
+            questions=options['questions'], choices=options['choices'], users=options['users'],
+            votes=options['votes'], closed=options['closed'], prefix=options['prefix'],
+            password=options['password'], seed=options['seed'], batch_size=options['batch_size'],
+        )
+        elapsed = time.perf_counter() - start
+        self.stdout.write(self.style.SUCCESS(
+            f"Seeded {len(created['questions'])} questions, "
+            f"{sum(map(len, created['choices'].values()))} choices, "
+            f"{len(created['users'])} users and {created['votes']} votes in {elapsed:.2f}s."
+        ))
@@ -0,0 +1,90 @@
+"""Middleware for the polls application."""
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+
+from . import instrumentation
+from .routers import use_primary
+
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS', 'TRACE')
+
+
+class StickyPrimaryMiddleware:
+    """
+    Pin the reads of requests that write to the primary database, and of
+    the same client's requests for POLLS_REPLICA_STICKY_SECONDS after a
+    successful write, so users don't miss their own votes on a lagging
+    replica. The end of the window is kept in a cookie.
+    """
+    sync_capable = True
+    async_capable = True
+    cookie_name = 'polls_primary_until'
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        with use_primary(self.pinned(request)):
+            response = self.get_response(request)
+        return self.stick(request, response)
+
+    async def __acall__(self, request):
+        with use_primary(self.pinned(request)):
+            response = await self.get_response(request)
+        return self.stick(request, response)
+
+    def pinned(self, request):
+        """Return True if the request's reads should go to the primary."""
+        if request.method not in SAFE_METHODS:
+            return True
+        try:
+            return float(request.COOKIES.get(self.cookie_name, 0)) > time.time()
+        except ValueError:
+            return False
+
+    def stick(self, request, response):
+        """Start the client's window on the primary after a successful write."""
+        if request.method not in SAFE_METHODS and response.status_code < 400:
+            window = settings.POLLS_REPLICA_STICKY_SECONDS
+            response.set_cookie(self.cookie_name, f'{time.time() + window:.3f}',
+                                max_age=max(1, round(window)), httponly=True, samesite='Lax')
+        return response
+
+
+class RequestMetricsMiddleware:
+    """
+    Measure each request's wall time, database queries and template
+    rendering, log them and add them to the /metrics histograms. With
+    probability POLLS_SLOW_SQL_SAMPLE_RATE a request keeps its SQL, which
+    is logged if it took longer than POLLS_SLOW_REQUEST_MS.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        start = time.perf_counter()
+        metrics, token = instrumentation.start_request()
+        response = self.get_response(request)
+        instrumentation.finish_request(request, response, metrics, token,
+                                       time.perf_counter() - start)
+        return response
+
+    async def __acall__(self, request):
+        start = time.perf_counter()
+        metrics, token = instrumentation.start_request()
+        response = await self.get_response(request)
+        instrumentation.finish_request(request, response, metrics, token,
+                                       time.perf_counter() - start)
+        return response
@@ -0,0 +1,39 @@
+# Generated by Django 5.1.15 on 2026-10-17 04:13
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+
+
+def fill_vote_counters(apps, schema_editor):
+    """Initialize the new counters from the existing votes."""
+    Choice = apps.get_model('polls', 'Choice')
+    Question = apps.get_model('polls', 'Question')
+    Vote = apps.get_model('polls', 'Vote')
+    choice_votes = Vote.objects.filter(choice=OuterRef('pk')).order_by() \
+        .values('choice').annotate(total=Count('pk')).values('total')
+    Choice.objects.update(vote_count=Coalesce(Subquery(choice_votes), 0))
+    question_votes = Choice.objects.filter(question=OuterRef('pk')).order_by() \
+        .values('question').annotate(total=Sum('vote_count')).values('total')
+    Question.objects.update(total_votes=Coalesce(Subquery(question_votes), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('polls', '0003_remove_choice_votes_alter_question_pub_date_vote'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='choice',
+            name='vote_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='question',
+            name='total_votes',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.RunPython(fill_vote_counters, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,60 @@
+# Generated by Django 5.1.15 on 2026-10-17 04:20
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, Max, OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+
+
+def fill_question_and_dedupe(apps, schema_editor):
+    """
+    Copy each vote's question from its choice, then keep only the latest
+    vote of every user on every question and recount the vote counters.
+    """
+    Choice = apps.get_model('polls', 'Choice')
+    Question = apps.get_model('polls', 'Question')
+    Vote = apps.get_model('polls', 'Vote')
+    Vote.objects.update(question=Subquery(
+        Choice.objects.filter(pk=OuterRef('choice')).values('question')[:1]
+    ))
+    latest_votes = Vote.objects.values('user', 'question') \
+        .annotate(latest=Max('pk')).values('latest')
+    _, deleted = Vote.objects.exclude(pk__in=latest_votes).delete()
+    if not deleted:
+        return
+    choice_votes = Vote.objects.filter(choice=OuterRef('pk')).order_by() \
+        .values('choice').annotate(total=Count('pk')).values('total')
+    Choice.objects.update(vote_count=Coalesce(Subquery(choice_votes), 0))
+    question_votes = Choice.objects.filter(question=OuterRef('pk')).order_by() \
+        .values('question').annotate(total=Sum('vote_count')).values('total')
+    Question.objects.update(total_votes=Coalesce(Subquery(question_votes), 0))
+
+
+class Migration(migrations.Migration):
+    # The data step and the ALTER TABLE steps can't share a transaction on
+    # PostgreSQL, so each operation runs in its own.
+    atomic = False
+
+    dependencies = [
+        ('polls', '0004_vote_counters'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='vote',
+            name='question',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, to='polls.question'),
+        ),
+        migrations.RunPython(fill_question_and_dedupe, migrations.RunPython.noop, atomic=True),
+        migrations.AlterField(
+            model_name='vote',
+            name='question',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='polls.question'),
+        ),
+        migrations.AddConstraint(
+            model_name='vote',
+            constraint=models.UniqueConstraint(fields=('user', 'question'), name='unique_vote_per_user_question'),
+        ),
+    ]
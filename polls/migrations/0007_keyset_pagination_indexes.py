@@ -0,0 +1,29 @@
+# Generated by Django 5.1.15 on 2026-10-17 04:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('polls', '0006_hot_query_indexes'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='question',
+            name='question_pub_date_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='question',
+            name='question_no_end_pub_date_idx',
+        ),
+        migrations.AddIndex(
+            model_name='question',
+            index=models.Index(fields=['-pub_date', '-id'], name='question_pub_date_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='question',
+            index=models.Index(condition=models.Q(('end_date__isnull', True)), fields=['-pub_date', '-id'], name='question_no_end_pub_date_idx'),
+        ),
+    ]
@@ -2,12 +2,37 @@
 """
 import datetime
 
+from django.conf import settings
 from django.db import models
+from django.db.models import Q
 from django.utils import timezone
 from django.contrib import admin
 from django.contrib.auth.models import User
 
 
+class QuestionQuerySet(models.QuerySet):
+    """
+    Queryset with SQL-side versions of the Question date checks, so views
+    can filter questions in the database instead of in Python.
+    """
+
+    def was_published_recently(self):
+        """Questions published within the last day."""
+        now = timezone.now()
+        return self.filter(pub_date__gte=now - datetime.timedelta(days=1),
+                           pub_date__lte=now)
+
+    def is_published(self):
+        """Questions whose publication date has been reached."""
+        return self.filter(pub_date__lte=timezone.now())
+
+    def can_vote(self):
+        """Questions that are published and still open for voting."""
+        now = timezone.now()
+        return self.filter(Q(end_date__isnull=True) | Q(end_date__gte=now),
+                           pub_date__lte=now)
+
+
 class Question(models.Model):
     """
     Represents a poll question in the application.
@@ -16,6 +41,24 @@ class Question(models.Model):
     question_text = models.CharField(max_length=200)
     pub_date = models.DateTimeField('date published', default=timezone.now)
     end_date = models.DateTimeField('date ending', null=True, blank=True)
+    total_votes = models.IntegerField(default=0)
+    counter_shards = models.PositiveSmallIntegerField(
+        default=0,
+        help_text="Spread the vote counters of each choice over this many rows, "
+                  "for polls too busy for one counter row (0 for a single row).")
+
+    objects = QuestionQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # Newest published questions first, as listed on the index page,
+            # and paged through by (pub_date, id)
+            models.Index(fields=['-pub_date', '-id'], name='question_pub_date_id_idx'),
+            # Open polls: no end date, or an end date still in the future
+            models.Index(fields=['-pub_date', '-id'], condition=Q(end_date__isnull=True),
+                         name='question_no_end_pub_date_idx'),
+            models.Index(fields=['end_date', 'pub_date'], name='question_end_pub_date_idx'),
+        ]
 
     def was_published_recently(self):
         """Returns True if the question was published within the last day."""
@@ -51,11 +94,14 @@ class Choice(models.Model):
     """
     question = models.ForeignKey(Question, on_delete=models.CASCADE)
     choice_text = models.CharField(max_length=200)
-    # votes = models.IntegerField(default=0)
+    vote_count = models.IntegerField(default=0)
 
     @property
     def votes(self):
         """Return the number of votes for this choice."""
+        if settings.POLLS_VOTE_COUNTERS:
+            sharded = self.choicecountershard_set.aggregate(total=models.Sum('count'))['total']
+            return self.vote_count + (sharded or 0)
         return self.vote_set.count()
 
     def __str__(self):
@@ -63,11 +109,94 @@ class Choice(models.Model):
         return self.choice_text
 
 
+class ChoiceCounterShard(models.Model):
+    """
+    One of the rows a choice's vote counter is spread over, when its
+    question has counter_shards. The choice's votes are its vote_count
+    plus the counts of its shards.
+    """
+
+    choice = models.ForeignKey(Choice, on_delete=models.CASCADE)
+    # Denormalized from choice.question, for compacting a question's shards
+    question = models.ForeignKey(Question, on_delete=models.CASCADE)
+    shard = models.PositiveSmallIntegerField()
+    count = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['choice', 'shard'], name='unique_counter_shard'),
+        ]
+
+    def __str__(self):
+        return f"{self.choice} shard {self.shard}: {self.count}"
+
+
 class Vote(models.Model):
     """A vote by a user for a choice in a poll"""
 
     choice = models.ForeignKey(Choice, on_delete=models.CASCADE)
+    # Denormalized from choice.question, so a user has one vote per question
+    question = models.ForeignKey(Question, on_delete=models.CASCADE)
     user = models.ForeignKey(User, on_delete=models.CASCADE)
+    # When the user first voted on the question, and last chose a choice
+    cast_at = models.DateTimeField(default=timezone.now)
+    changed_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'question'],
+                                    name='unique_vote_per_user_question'),
+        ]
+        indexes = [
+            models.Index(fields=['user', 'choice'], name='vote_user_choice_idx'),
+        ]
+
+    def save(self, *args, **kwargs):
+        """Fill in the question of the chosen choice before saving."""
+        if self.question_id is None:
+            self.question_id = self.choice.question_id
+        super().save(*args, **kwargs)
 
     def __str__(self):
         return f"Vote by {self.user.username} for {self.choice.choice_text}"
+
+
+class VoteRollup(models.Model):
+    """
+    The net number of votes a choice gained within one time bucket, a
+    minute or an hour long, for the vote trends of a question.
+    """
+    MINUTE = 60
+    HOUR = 3600
+
+    choice = models.ForeignKey(Choice, on_delete=models.CASCADE)
+    # Denormalized from choice.question, to read a question's trend
+    question = models.ForeignKey(Question, on_delete=models.CASCADE)
+    # Length of the bucket in seconds
+    resolution = models.PositiveIntegerField(choices=[(MINUTE, 'minute'), (HOUR, 'hour')])
+    bucket = models.DateTimeField()
+    delta = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['choice', 'resolution', 'bucket'],
+                                    name='unique_rollup_per_choice_bucket'),
+        ]
+        indexes = [
+            models.Index(fields=['question', 'resolution', 'bucket'],
+                         name='rollup_question_bucket_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.choice} {self.delta:+d} at {self.bucket:%Y-%m-%d %H:%M}"
+
+
+class FixtureLoad(models.Model):
+    """The checksum of a fixture file when bootstrap last imported it"""
+
+    fixture = models.CharField(max_length=255, unique=True)
+    checksum = models.CharField(max_length=64)
+    loaded_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.fixture} ({self.checksum[:12]})"
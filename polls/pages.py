@@ -0,0 +1,157 @@
+"""Whole-page caching of the polls pages anonymous visitors see.
+
+The index and results pages only differ between anonymous visitors when
+they carry messages, so the anonymous variant of each page is cached
+whole, under a version that changes when the page's data does: the
+index uses the key of the poll schedule, which changes when a question
+is saved or deleted and when a poll opens or closes, and the results
+page uses the question's results version, which votes bump. Nothing has
+to be deleted to purge a page. Pages are keyed on their path and the
+query parameters the view reads, so other parameters can't fill the
+cache with copies of a page.
+
+A request is served from the page cache only when it has neither a
+session cookie nor a messages cookie. Logged-in users always have a
+session cookie, so they never get a cached page. Anonymous pages are
+marked public with an s-maxage of POLLS_PAGE_CACHE_MAX_AGE, and vary on
+Cookie, so a reverse proxy in front of the site can absorb anonymous
+traffic; every other variant of these pages is marked private.
+"""
+import functools
+import hashlib
+import inspect
+from urllib.parse import urlencode
+
+from asgiref.sync import iscoroutinefunction
+from django.conf import settings
+from django.contrib.messages.storage.cookie import CookieStorage
+from django.core.cache import cache
+from django.http import HttpResponse
+from django.utils.cache import patch_cache_control, patch_vary_headers
+
+from .results import aresults_version, results_version
+from .schedule import acurrent_schedule, current_schedule
+
+
+def index_version(request):
+    """Return the version of the index pages."""
+    return current_schedule().key
+
+
+async def aindex_version(request):
+    """Async version of index_version()."""
+    return (await acurrent_schedule()).key
+
+
+def results_page_version(request, pk):
+    """Return the version of a question's results page."""
+    return results_version(pk)
+
+
+async def aresults_page_version(request, pk):
+    """Async version of results_page_version()."""
+    return await aresults_version(pk)
+
+
+def is_anonymous_request(request):
+    """
+    Return True if the request may get the anonymous page: a GET or HEAD
+    without a session or messages cookie. Doesn't touch the database.
+    """
+    return (request.method in ('GET', 'HEAD')
+            and settings.SESSION_COOKIE_NAME not in request.COOKIES
+            and CookieStorage.cookie_name not in request.COOKIES)
+
+
+def _page_key(request, params, version):
+    query = urlencode([(name, request.GET[name]) for name in sorted(params) if name in request.GET])
+    path = hashlib.md5(f'{request.path}?{query}'.encode()).hexdigest()
+    return f'polls:pages:{path}:{version}'
+
+
+def _mark_public(response):
+    patch_cache_control(response, public=True, max_age=0,
+                        s_maxage=settings.POLLS_PAGE_CACHE_MAX_AGE)
+    patch_vary_headers(response, ['Cookie'])
+    return response
+
+
+def _mark_private(response):
+    patch_cache_control(response, private=True)
+    patch_vary_headers(response, ['Cookie'])
+    return response
+
+
+def _cached_response(page):
+    if page is None:
+        return None
+    content, content_type = page
+    return _mark_public(HttpResponse(content, content_type=content_type))
+
+
+def _page(request, response):
+    """
+    Render an anonymous page and return its (content, content type) to
+    cache, or None if it is personal in some way.
+    """
+    if hasattr(response, 'render'):
+        response.render()
+    if (response.status_code == 200 and not response.streaming and not response.cookies
+            and not request.META.get('CSRF_COOKIE_NEEDS_UPDATE')):
+        return response.content, response['Content-Type']
+    return None
+
+
+def _store_response(request, response, key):
+    """Cache a rendered anonymous page, unless it is personal in some way."""
+    page = _page(request, response)
+    if page is None:
+        return _mark_private(response)
+    cache.set(key, page, settings.POLLS_PAGE_CACHE_TIMEOUT)
+    return _mark_public(response)
+
+
+async def _astore_response(request, response, key):
+    """Async version of _store_response()."""
+    page = _page(request, response)
+    if page is None:
+        return _mark_private(response)
+    await cache.aset(key, page, settings.POLLS_PAGE_CACHE_TIMEOUT)
+    return _mark_public(response)
+
+
+def cache_anonymous_page(version, params=()):
+    """
+    Decorate a sync or async view to cache the page anonymous visitors
+    get. `version` is called with the request and the view's keyword
+    arguments and returns the current version of the page; for an async
+    view it may be a coroutine function. `params` names the query
+    parameters the view reads; the others don't change the page.
+    """
+    def decorator(view):
+        def cacheable(request):
+            return settings.POLLS_PAGE_CACHE_TIMEOUT > 0 and is_anonymous_request(request)
+
+        if iscoroutinefunction(view):
+            async def wrapper(request, *args, **kwargs):
+                key = None
+                if cacheable(request):
+                    page_version = version(request, **kwargs)
+                    if inspect.isawaitable(page_version):
+                        page_version = await page_version
+                    key = _page_key(request, params, page_version)
+                if key is None:
+                    return _mark_private(await view(request, *args, **kwargs))
+                return (_cached_response(await cache.aget(key))
+                        or await _astore_response(request, await view(request, *args, **kwargs),
+                                                  key))
+        else:
+            def wrapper(request, *args, **kwargs):
+                key = (_page_key(request, params, version(request, **kwargs))
+                       if cacheable(request) else None)
+                if key is None:
+                    return _mark_private(view(request, *args, **kwargs))
+                return (_cached_response(cache.get(key))
+                        or _store_response(request, view(request, *args, **kwargs), key))
+        return functools.wraps(view)(wrapper)
+    return decorator
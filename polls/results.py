@@ -0,0 +1,202 @@
+"""Vote tallies of a question, and the cache in front of them.
+
+The tallies and the rendered results table of each question are cached
+under a per-question version. Anything that changes a question's votes
+bumps its version, so the next read misses the cache and recounts. The
+POLLS_RESULTS_CACHE_TIMEOUT setting bounds how long an entry can be
+served, in case an update bypasses the invalidation (e.g. raw SQL).
+
+The async functions, for the async views, go through the async cache
+API, as a cache lookup may query the database (with DatabaseCache) and
+so can't run on the event loop.
+"""
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.db.models import Count
+from django.template.loader import render_to_string
+
+from . import counters
+from .models import Choice
+from .routers import use_primary, written_recently
+
+
+def _with_num_votes(choices):
+    """Annotate a Choice queryset with the `num_votes` of every choice."""
+    if counters.counters_enabled():
+        num_votes = counters.vote_count_with_shards()
+    else:
+        num_votes = Count('vote')
+    return choices.annotate(num_votes=num_votes).order_by('pk')
+
+
+def tally_queryset(question):
+    """Return the choices of `question` annotated with their `num_votes`."""
+    return _with_num_votes(question.choice_set.all())
+
+
+def _summarize(choices):
+    total_votes = sum(choice.num_votes for choice in choices)
+    for choice in choices:
+        choice.percentage = (choice.num_votes * 100 / total_votes
+                             if total_votes else 0)
+    return {'choices': choices, 'total_votes': total_votes}
+
+
+def compute_tallies(question):
+    """
+    Count the votes of every choice of `question` in a single query.
+
+    Returns a dict with the `choices`, each annotated with `num_votes`
+    and its `percentage` of the total, and the `total_votes`.
+    """
+    return _summarize(list(tally_queryset(question)))
+
+
+async def acompute_tallies(question):
+    """Async version of compute_tallies(), using the async ORM."""
+    return _summarize([choice async for choice in tally_queryset(question)])
+
+
+def compute_tallies_many(question_ids):
+    """
+    Count the votes of every choice of several questions in a single query.
+
+    Returns a {question_id: tallies} dict of compute_tallies() results.
+    """
+    choices = {question_id: [] for question_id in question_ids}
+    for choice in _with_num_votes(Choice.objects.filter(question_id__in=question_ids)):
+        choices[choice.question_id].append(choice)
+    return {question_id: _summarize(question_choices)
+            for question_id, question_choices in choices.items()}
+
+
+def _version_key(question_id):
+    return f'polls:results:version:{question_id}'
+
+
+def results_version(question_id):
+    """
+    Return the current results version of a question. The version is the
+    time, in nanoseconds, at which the question's results last changed.
+    """
+    return results_versions([question_id])[question_id]
+
+
+def results_versions(question_ids):
+    """Return a {question_id: version} dict, like results_version()."""
+    keys = {_version_key(question_id): question_id for question_id in question_ids}
+    versions = cache.get_many(keys)
+    missing = [key for key in keys if key not in versions]
+    if missing:
+        now = time.time_ns()
+        for key in missing:
+            cache.add(key, now, None)
+        versions.update(cache.get_many(missing))
+    return {keys[key]: version for key, version in versions.items()}
+
+
+async def aresults_versions(question_ids):
+    """Async version of results_versions()."""
+    keys = {_version_key(question_id): question_id for question_id in question_ids}
+    versions = await cache.aget_many(keys)
+    missing = [key for key in keys if key not in versions]
+    if missing:
+        now = time.time_ns()
+        for key in missing:
+            await cache.aadd(key, now, None)
+        versions.update(await cache.aget_many(missing))
+    return {keys[key]: version for key, version in versions.items()}
+
+
+async def aresults_version(question_id):
+    """Async version of results_version()."""
+    return (await aresults_versions([question_id]))[question_id]
+
+
+def _bump_version(question_id):
+    cache.set(_version_key(question_id), time.time_ns(), None)
+
+
+def invalidate_results(question_id):
+    """
+    Drop the cached results of a question.
+
+    Inside a transaction the version is bumped again on commit, so that
+    a read between the change and the commit can't keep stale results.
+    """
+    _bump_version(question_id)
+    if connection.in_atomic_block:
+        transaction.on_commit(lambda: _bump_version(question_id))
+
+
+# Results that changed within POLLS_REPLICA_STICKY_SECONDS are recounted on
+# the primary database, so that a lagging replica can't put stale tallies in
+# the cache under the new version.
+
+def _cached(question, name, compute):
+    version = results_version(question.pk)
+    key = f'polls:results:{name}:{question.pk}:{version}'
+    value = cache.get(key)
+    if value is None:
+        with use_primary(written_recently(version)):
+            value = compute()
+        cache.set(key, value, settings.POLLS_RESULTS_CACHE_TIMEOUT)
+    return value
+
+
+async def _acached(question, name, acompute):
+    version = await aresults_version(question.pk)
+    key = f'polls:results:{name}:{question.pk}:{version}'
+    value = await cache.aget(key)
+    if value is None:
+        with use_primary(written_recently(version)):
+            value = await acompute()
+        await cache.aset(key, value, settings.POLLS_RESULTS_CACHE_TIMEOUT)
+    return value
+
+
+def get_tallies(question):
+    """Return the tallies of `question`, like compute_tallies(), from the cache."""
+    return _cached(question, 'tallies', lambda: compute_tallies(question))
+
+
+def get_tallies_many(question_ids):
+    """
+    Return a {question_id: tallies} dict, like compute_tallies_many(),
+    from the cache. The tallies missing from the cache are counted
+    together in one query.
+    """
+    versions = results_versions(question_ids)
+    keys = {f'polls:results:tallies:{question_id}:{version}': question_id
+            for question_id, version in versions.items()}
+    tallies = {keys[key]: value for key, value in cache.get_many(keys).items()}
+    missing = [question_id for question_id in question_ids if question_id not in tallies]
+    if missing:
+        with use_primary(any(written_recently(versions[question_id]) for question_id in missing)):
+            computed = compute_tallies_many(missing)
+        cache.set_many({f'polls:results:tallies:{question_id}:{versions[question_id]}': value
+                        for question_id, value in computed.items()},
+                       settings.POLLS_RESULTS_CACHE_TIMEOUT)
+        tallies.update(computed)
+    return tallies
+
+
+def get_results_table(question):
+    """Return the rendered results table of `question` from the cache."""
+    return _cached(question, 'table', lambda: render_to_string(
+        'polls/results_table.html', get_tallies(question)))
+
+
+async def aget_tallies(question):
+    """Async version of get_tallies()."""
+    return await _acached(question, 'tallies', lambda: acompute_tallies(question))
+
+
+async def aget_results_table(question):
+    """Async version of get_results_table()."""
+    async def render_table():
+        return render_to_string('polls/results_table.html', await aget_tallies(question))
+    return await _acached(question, 'table', render_table)
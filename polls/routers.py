@@ -0,0 +1,63 @@
+"""Routing the reads of the polls to read replicas.
+
+With replicas in POLLS_READ_REPLICAS, ReplicaRouter sends reads of the
+polls models to a random replica and everything else, including every
+write and the auth and session tables, to the primary ('default').
+
+A replica may lag behind the primary, so reads go to the primary while
+they are pinned to it: for the whole of a request that writes, for the
+requests of a client within POLLS_REPLICA_STICKY_SECONDS of its last
+write (see StickyPrimaryMiddleware), and when recounting results that
+changed within that window.
+"""
+import contextlib
+import contextvars
+import random
+import time
+
+from django.conf import settings
+
+PRIMARY = 'default'
+
+_pinned = contextvars.ContextVar('polls_pinned_to_primary', default=False)
+
+
+@contextlib.contextmanager
+def use_primary(pin=True):
+    """Send the reads in the block to the primary, if `pin` is true."""
+    if not pin:
+        yield
+        return
+    token = _pinned.set(True)
+    try:
+        yield
+    finally:
+        _pinned.reset(token)
+
+
+def written_recently(timestamp_ns):
+    """
+    Return True if a write at `timestamp_ns` (nanoseconds since the epoch)
+    may not have reached the replicas yet.
+    """
+    return time.time_ns() - timestamp_ns < settings.POLLS_REPLICA_STICKY_SECONDS * 1e9
+
+
+class ReplicaRouter:
+    """Sends reads of the polls models to the replicas and the rest to the primary."""
+
+    def db_for_read(self, model, **hints):
+        replicas = settings.POLLS_READ_REPLICAS
+        if not replicas or model._meta.app_label != 'polls' or _pinned.get():
+            return PRIMARY
+        return random.choice(replicas)
+
+    def db_for_write(self, model, **hints):
+        return PRIMARY
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # The replicas hold the same rows as the primary
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == PRIMARY
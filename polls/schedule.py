@@ -0,0 +1,176 @@
+"""When polls next open and close, so caches keyed on them expire on time.
+
+Which polls are open only changes at a boundary, the pub_date or the
+end_date of some question, or when a question is edited. A Schedule
+holds the next of each kind of boundary, so the anonymous index pages,
+which list open polls, can be cached under its key until one is reached.
+It is the same size however many questions there are, and is built with
+two index lookups; the open polls themselves are paged in SQL (see
+views.IndexView). Views that load a question to vote on it check the
+dates on its row.
+
+current_schedule() returns the schedule in effect. It is shared through
+the cache under the schedule version, which question edits bump, and
+each thread keeps a copy, so a lookup costs one cache read. Once the
+next boundary is reached, the first lookup rebuilds the schedule, so
+polls open and close exactly at their dates. `manage.py
+refresh_poll_schedule --loop` rebuilds it at each boundary ahead of the
+requests.
+"""
+import threading
+import time
+
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.utils import timezone
+
+from .models import Question
+from .routers import use_primary, written_recently
+
+VERSION_KEY = 'polls:schedule:version'
+SCHEDULE_KEY = 'polls:schedule'
+
+_local = threading.local()
+
+
+class Schedule:
+    """
+    Valid from when it was built until `opens_at`, the next pub_date, or
+    until after `closes_at`, the next end_date.
+    """
+
+    def __init__(self, version, opens_at, closes_at):
+        self.version = version
+        self.opens_at = opens_at
+        self.closes_at = closes_at
+
+    @property
+    def key(self):
+        """A key that changes whenever the schedule does."""
+        bounds = [bound.timestamp() if bound else None for bound in (self.opens_at, self.closes_at)]
+        return f'{self.version}:{bounds[0]}:{bounds[1]}'
+
+    def is_current(self, now):
+        """Return True if no boundary has been passed at `now`."""
+        return ((self.opens_at is None or now < self.opens_at)
+                and (self.closes_at is None or now <= self.closes_at))
+
+    def next_boundary(self):
+        """Return when the schedule will next change, or None."""
+        return min((bound for bound in (self.opens_at, self.closes_at) if bound), default=None)
+
+
+def _schedule_version():
+    version = cache.get(VERSION_KEY)
+    if version is None:
+        cache.add(VERSION_KEY, time.time_ns(), None)
+        version = cache.get(VERSION_KEY)
+    return version
+
+
+async def _aschedule_version():
+    version = await cache.aget(VERSION_KEY)
+    if version is None:
+        await cache.aadd(VERSION_KEY, time.time_ns(), None)
+        version = await cache.aget(VERSION_KEY)
+    return version
+
+
+def _bump_version():
+    cache.set(VERSION_KEY, time.time_ns(), None)
+
+
+def invalidate_schedule():
+    """
+    Rebuild the schedule on its next lookup, after a question changed.
+    Inside a transaction the version is bumped again on commit.
+    """
+    _bump_version()
+    if connection.in_atomic_block:
+        transaction.on_commit(_bump_version)
+
+
+def _next_opening(now):
+    # The first row along question_pub_date_id_idx
+    return (Question.objects.filter(pub_date__gt=now).order_by('pub_date')
+            .values_list('pub_date', flat=True))
+
+
+def _next_closing(now):
+    # The first row along question_end_pub_date_idx
+    return (Question.objects.filter(end_date__gte=now).order_by('end_date')
+            .values_list('end_date', flat=True))
+
+
+def build_schedule(version, now):
+    """Build the schedule in effect at `now`, in two index lookups."""
+    # Like results, a schedule that just changed is read from the primary
+    with use_primary(written_recently(version)):
+        return Schedule(version, _next_opening(now).first(), _next_closing(now).first())
+
+
+async def abuild_schedule(version, now):
+    """Async version of build_schedule()."""
+    with use_primary(written_recently(version)):
+        return Schedule(version, await _next_opening(now).afirst(),
+                        await _next_closing(now).afirst())
+
+
+def _in_effect(schedule, version, now):
+    return schedule is not None and schedule.version == version and schedule.is_current(now)
+
+
+def _lookup(version, now):
+    """Return this thread's copy of the schedule, or the cached one, if still in effect."""
+    schedule = getattr(_local, 'schedule', None)
+    if _in_effect(schedule, version, now):
+        return schedule
+    schedule = cache.get(SCHEDULE_KEY)
+    if _in_effect(schedule, version, now):
+        _local.schedule = schedule
+        return schedule
+    return None
+
+
+async def _alookup(version, now):
+    """Async version of _lookup()."""
+    schedule = getattr(_local, 'schedule', None)
+    if _in_effect(schedule, version, now):
+        return schedule
+    schedule = await cache.aget(SCHEDULE_KEY)
+    if _in_effect(schedule, version, now):
+        _local.schedule = schedule
+        return schedule
+    return None
+
+
+def _store(schedule):
+    cache.set(SCHEDULE_KEY, schedule, None)
+    _local.schedule = schedule
+
+
+async def _astore(schedule):
+    await cache.aset(SCHEDULE_KEY, schedule, None)
+    _local.schedule = schedule
+
+
+def current_schedule(rebuild=False):
+    """Return the schedule in effect now, rebuilding it if it changed."""
+    now = timezone.now()
+    version = _schedule_version()
+    schedule = None if rebuild else _lookup(version, now)
+    if schedule is None:
+        schedule = build_schedule(version, now)
+        _store(schedule)
+    return schedule
+
+
+async def acurrent_schedule():
+    """Async version of current_schedule()."""
+    now = timezone.now()
+    version = await _aschedule_version()
+    schedule = await _alookup(version, now)
+    if schedule is None:
+        schedule = await abuild_schedule(version, now)
+        await _astore(schedule)
+    return schedule
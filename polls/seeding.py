@@ -0,0 +1,79 @@
+"""Synthetic polls data for load tests and benchmarks.
+
+Everything is inserted with bulk_create() in batches. Seeded users are
+named with a prefix and all share one password, hashed once.
+"""
+import datetime
+import random
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.utils import timezone
+
+from . import counters
+from .models import Choice, Question, Vote
+from .results import invalidate_results
+from .schedule import invalidate_schedule
+
+DEFAULT_PASSWORD = 'bench-password'
+
+
+def _batches(items, size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def seed_dataset(questions=100, choices=4, users=1000, votes=10000, closed=0.1,
+                 prefix='bench', password=DEFAULT_PASSWORD, seed=0, batch_size=5000):
+    """
+    Insert `questions` published questions with `choices` choices each, of
+    which a share `closed` has ended, `users` users and `votes` votes, each
+    by a different (user, question) pair. Returns a dict of the created ids,
+    'questions', 'choices' ({question_id: [choice ids]}) and 'users', and
+    the number of 'votes'.
+    """
+    rng = random.Random(seed)
+    now = timezone.now()
+    votes = min(votes, questions * users)
+
+    created_questions = []
+    for batch in _batches((Question(
+            question_text=f'{prefix} question {i}',
+            pub_date=now - datetime.timedelta(days=rng.randint(1, 365), seconds=i),
+            end_date=now - datetime.timedelta(hours=1) if rng.random() < closed else None,
+    ) for i in range(questions)), batch_size):
+        created_questions.extend(Question.objects.bulk_create(batch))
+    question_ids = [question.pk for question in created_questions]
+
+    choice_ids = {question_id: [] for question_id in question_ids}
+    for batch in _batches((Choice(question_id=question_id, choice_text=f'Choice {j}')
+                           for question_id in question_ids for j in range(choices)), batch_size):
+        for choice in Choice.objects.bulk_create(batch):
+            choice_ids[choice.question_id].append(choice.pk)
+
+    password_hash = make_password(password)
+    user_ids = []
+    for batch in _batches((User(username=f'{prefix}{i}', password=password_hash)
+                           for i in range(users)), batch_size):
+        user_ids.extend(user.pk for user in User.objects.bulk_create(batch))
+
+    # Each vote is a distinct (user, question) pair, numbered user-major
+    pairs = rng.sample(range(questions * users), votes)
+    for batch in _batches((Vote(user_id=user_ids[pair // questions],
+                                question_id=question_ids[pair % questions],
+                                choice_id=rng.choice(choice_ids[question_ids[pair % questions]]))
+                           for pair in pairs), batch_size):
+        Vote.objects.bulk_create(batch)
+
+    if counters.counters_enabled():
+        counters.reconcile_counters()
+    for question_id in question_ids:
+        invalidate_results(question_id)
+    invalidate_schedule()
+    return {'questions': question_ids, 'choices': choice_ids, 'users': user_ids, 'votes': votes}
@@ -0,0 +1,95 @@
+"""Signal receivers for the polls application."""
+from django.core.signals import request_started
+from django.db import transaction
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_delete, post_save, pre_delete
+from django.dispatch import receiver
+
+from . import bootstrap, counters, instrumentation
+from .broadcast import get_broadcaster
+from .models import Choice, Question, Vote
+from .schedule import invalidate_schedule
+from .results import invalidate_results
+from .voting import forget_user_votes
+
+
+@receiver(post_delete, sender=Vote)
+def update_counters_on_vote_delete(sender, instance, **kwargs):
+    """Take a deleted vote, including cascaded deletes, off the counters."""
+    if not counters.counters_enabled():
+        return
+    counters.record_vote_change(instance.question_id, instance.choice_id, None, use_shards=False)
+
+
+@receiver(pre_delete, sender=Choice)
+def fold_counter_shards_on_choice_delete(sender, instance, **kwargs):
+    """
+    Fold a choice's counter shards into its counters before it and its
+    votes are deleted, as the deleted votes are taken off the counters.
+    """
+    if counters.counters_enabled():
+        counters.compact_shards(choice_ids=[instance.pk])
+
+
+@receiver(post_save, sender=Vote)
+@receiver(post_delete, sender=Vote)
+def forget_user_votes_on_change(sender, instance, **kwargs):
+    """Drop the cached vote map of the user whose vote changed."""
+    forget_user_votes(instance.user_id)
+
+
+@receiver(post_save, sender=Vote)
+@receiver(post_delete, sender=Vote)
+def notify_live_results_on_change(sender, instance, **kwargs):
+    """Push the new results to live results subscribers once committed."""
+    question_id = instance.question_id
+    transaction.on_commit(lambda: get_broadcaster().notify(question_id))
+
+
+@receiver(post_save, sender=Vote)
+@receiver(post_delete, sender=Vote)
+@receiver(post_save, sender=Choice)
+@receiver(post_delete, sender=Choice)
+def invalidate_results_on_change(sender, instance, **kwargs):
+    """Drop the cached results of the question a vote or choice belongs to."""
+    invalidate_results(instance.question_id)
+
+
+@receiver(post_save, sender=Question)
+@receiver(post_delete, sender=Question)
+def invalidate_results_on_question_change(sender, instance, **kwargs):
+    """Drop the cached results of a changed question."""
+    invalidate_results(instance.pk)
+
+
+@receiver(post_save, sender=Question)
+@receiver(post_delete, sender=Question)
+def forget_counter_shards_on_question_change(sender, instance, **kwargs):
+    """Drop the cached counter_shards of a changed question."""
+    counters.forget_counter_shards(instance.pk)
+
+
+@receiver(post_save, sender=Question)
+@receiver(post_delete, sender=Question)
+def invalidate_schedule_on_question_change(sender, instance, **kwargs):
+    """Rebuild the poll schedule, and so the anonymous index pages, when a question changes."""
+    invalidate_schedule()
+
+
+@receiver(request_started)
+def report_first_request(sender, **kwargs):
+    """Log the time to first request of this process."""
+    bootstrap.report_first_request()
+
+
+@receiver(request_started)
+def count_request(sender, **kwargs):
+    """Count the request in the instrumentation."""
+    instrumentation.record_request()
+
+
+@receiver(connection_created)
+def count_connection(sender, connection, **kwargs):
+    """Count and instrument the new database connection."""
+    instrumentation.record_connection(connection.alias)
+    instrumentation.instrument_connection(connection)
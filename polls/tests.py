@@ -1,10 +1,37 @@
+import asyncio
+import contextlib
 import datetime
+import json
+import logging
+import re
+import tempfile
+import threading
+import time
+import unittest
 
-from django.test import TestCase
+from io import StringIO
+from unittest import mock
+
+from asgiref.sync import sync_to_async
+from django.contrib.auth.models import Permission, User
+from django.core.cache import cache
+from django.core.management import CommandError, call_command
+from django.core.management.base import SystemCheckError
+from django.db import IntegrityError, connection, connections
+from django.db.models import F, Sum
+from django.test import Client, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.utils import timezone
 from django.urls import reverse
 
-from .models import Question
+from . import bootstrap, checks, ingest, instrumentation, routers, schedule, trends
+from .broadcast import CachePollingBroadcaster, ResultsBroadcaster
+from .log import JsonFormatter, QueueingStreamHandler, RateLimitFilter
+from .transfer import _read_json_array
+from .models import Choice, ChoiceCounterShard, FixtureLoad, Question, Vote, VoteRollup
+from .results import get_tallies
+from .seeding import seed_dataset
+from .voting import cast_vote, cast_votes, get_user_votes
 
 
 class QuestionModelTests(TestCase):
@@ -96,6 +123,42 @@ class QuestionModelTests(TestCase):
         self.assertIs(question.can_vote(), True)
 
 
+class QuestionQuerySetTests(TestCase):
+
+    def setUp(self):
+        now = timezone.now()
+        self.future = Question.objects.create(
+            question_text="Future.", pub_date=now + datetime.timedelta(days=30))
+        self.recent = Question.objects.create(
+            question_text="Recent.", pub_date=now - datetime.timedelta(hours=1))
+        self.old = Question.objects.create(
+            question_text="Old.", pub_date=now - datetime.timedelta(days=5))
+        self.closed = Question.objects.create(
+            question_text="Closed.", pub_date=now - datetime.timedelta(days=5),
+            end_date=now - datetime.timedelta(days=1))
+        self.open = Question.objects.create(
+            question_text="Open.", pub_date=now - datetime.timedelta(days=5),
+            end_date=now + datetime.timedelta(days=1))
+
+    def test_querysets_match_instance_methods(self):
+        """
+        The queryset filters select exactly the questions for which the
+        instance methods return True.
+        """
+        for name in ('was_published_recently', 'is_published', 'can_vote'):
+            with self.subTest(name=name):
+                expected = {q.pk for q in Question.objects.all() if getattr(q, name)()}
+                actual = set(getattr(Question.objects, name)().values_list('pk', flat=True))
+                self.assertEqual(actual, expected)
+
+    def test_can_vote(self):
+        """can_vote() keeps open questions with or without an end date."""
+        self.assertQuerySetEqual(
+            Question.objects.can_vote().order_by('pk'),
+            [self.recent, self.old, self.open],
+        )
+
+
 def create_question(question_text, days):
     """
     Create a question with the given `question_text` and published the
@@ -107,6 +170,9 @@ def create_question(question_text, days):
 
 
 class QuestionIndexViewTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
     def test_no_questions(self):
         """
         If no questions exist, an appropriate message is displayed.
@@ -164,6 +230,63 @@ class QuestionIndexViewTests(TestCase):
         )
 
 
+@override_settings(POLLS_INDEX_PAGE_SIZE=5)
+class QuestionIndexPaginationTests(TestCase):
+    def setUp(self):
+        now = timezone.now()
+        # Pairs of questions share a pub_date, to page through ties
+        self.questions = [
+            Question.objects.create(question_text=f"Question {i}.",
+                                    pub_date=now - datetime.timedelta(days=i // 2 + 1))
+            for i in range(12)
+        ]
+        self.newest_first = sorted(self.questions, key=lambda q: (q.pub_date, q.pk),
+                                   reverse=True)
+
+    def get_pages(self, **params):
+        """Follow the next-page cursors and return every page of questions."""
+        pages = []
+        while True:
+            response = self.client.get(reverse('polls:index'), params)
+            pages.append(list(response.context['latest_question_list']))
+            if response.context['next_cursor'] is None:
+                return pages
+            params['cursor'] = response.context['next_cursor']
+
+    def test_pages(self):
+        """The pages list every question once, newest first."""
+        pages = self.get_pages()
+        self.assertEqual([len(page) for page in pages], [5, 5, 2])
+        self.assertEqual(sum(pages, []), self.newest_first)
+
+    def test_next_page_link(self):
+        """The index links to the next page while there is one."""
+        response = self.client.get(reverse('polls:index'))
+        self.assertContains(response, f"?cursor={response.context['next_cursor']}")
+
+    def test_deep_page_queries(self):
+        """A later page runs the same queries as the first."""
+        response = self.client.get(reverse('polls:index'))
+        with self.assertNumQueries(1):
+            self.client.get(reverse('polls:index'), {'cursor': response.context['next_cursor']})
+
+    def test_invalid_cursor(self):
+        """A cursor that can't be decoded is not found."""
+        response = self.client.get(reverse('polls:index'), {'cursor': 'not-a-cursor'})
+        self.assertEqual(response.status_code, 404)
+
+    def test_status_filter(self):
+        """The status parameter lists only open or only closed polls."""
+        closed = self.questions[:3]
+        for question in closed:
+            question.end_date = timezone.now() - datetime.timedelta(hours=1)
+            question.save()
+        closed_pages = self.get_pages(status='closed')
+        self.assertEqual(sum(closed_pages, []), [q for q in self.newest_first if q in closed])
+        open_pages = self.get_pages(status='open')
+        self.assertEqual(sum(open_pages, []), [q for q in self.newest_first if q not in closed])
+
+
 class QuestionDetailViewTests(TestCase):
     def test_future_question(self):
         """
@@ -184,3 +307,1768 @@ class QuestionDetailViewTests(TestCase):
         url = reverse('polls:detail', args=(past_question.id,))
         response = self.client.get(url)
         self.assertContains(response, past_question.question_text)
+
+
+def create_choices(question, count):
+    """Create `count` choices for the given `question`."""
+    return [question.choice_set.create(choice_text=f"Choice {i}")
+            for i in range(count)]
+
+
+def create_users(count, start=0):
+    """Create `count` users that can cast votes, numbered from `start`."""
+    return [User.objects.create(username=f"voter{i}")
+            for i in range(start, start + count)]
+
+
+def format_queries(queries):
+    """Number the SQL statements run, for failure messages."""
+    return "\n".join(f"  {number}. {query['sql']}" for number, query in enumerate(queries, 1))
+
+
+class QueryBudgetMixin:
+    """Assertions on the number of queries a block of code runs."""
+
+    @contextlib.contextmanager
+    def assertQueryBudget(self, budget, label="The block"):
+        """Fail, showing the SQL, if the block runs more than `budget` queries."""
+        with CaptureQueriesContext(connection) as captured:
+            yield captured
+        if len(captured) > budget:
+            self.fail(f"{label} ran {len(captured)} queries, over its budget of {budget}:\n"
+                      f"{format_queries(captured)}")
+
+    def assertQueriesIndependentOfData(self, budget, label, small, large):
+        """
+        Run the `small` and `large` callables, which make the same request
+        on a small and a large dataset, and fail, showing the SQL, if either
+        goes over `budget` or the large one runs more queries.
+        """
+        runs = []
+        for size, make_request in (("small", small), ("large", large)):
+            cache.clear()
+            with self.assertQueryBudget(budget, f"{label} on the {size} dataset") as captured:
+                response = make_request()
+            self.assertLess(response.status_code, 400, f"{label} on the {size} dataset")
+            runs.append(captured)
+        if len(runs[1]) > len(runs[0]):
+            self.fail(f"{label} ran {len(runs[0])} queries on the small dataset but "
+                      f"{len(runs[1])} on the large one.\nSmall:\n{format_queries(runs[0])}\n"
+                      f"Large:\n{format_queries(runs[1])}")
+
+
+class QuestionResultsViewTests(TestCase):
+    def test_tallies_and_percentages(self):
+        """
+        The results page shows each choice's tally, its share of the total
+        and the total number of votes.
+        """
+        question = create_question(question_text="Past question.", days=-1)
+        first, second = create_choices(question, 2)
+        users = create_users(4)
+        for user in users[:3]:
+            Vote.objects.create(user=user, choice=first)
+        Vote.objects.create(user=users[3], choice=second)
+        response = self.client.get(reverse('polls:results', args=(question.id,)))
+        self.assertEqual(response.context['total_votes'], 4)
+        tallies = {choice.id: (choice.num_votes, choice.percentage)
+                   for choice in response.context['choices']}
+        self.assertEqual(tallies, {first.id: (3, 75), second.id: (1, 25)})
+        self.assertContains(response, "75.0%")
+
+    def test_no_votes(self):
+        """
+        A question without votes shows zero tallies and no division error.
+        """
+        question = create_question(question_text="Past question.", days=-1)
+        create_choices(question, 3)
+        response = self.client.get(reverse('polls:results', args=(question.id,)))
+        self.assertEqual(response.context['total_votes'], 0)
+        self.assertEqual([choice.percentage for choice in response.context['choices']],
+                         [0, 0, 0])
+
+    def test_constant_number_of_queries(self):
+        """
+        Rendering results runs the same number of queries no matter
+        how many choices the question has.
+        """
+        users = create_users(3)
+        small = create_question(question_text="Small question.", days=-1)
+        large = create_question(question_text="Large question.", days=-1)
+        for question, count in ((small, 2), (large, 20)):
+            for choice, user in zip(create_choices(question, count), users):
+                Vote.objects.create(user=user, choice=choice)
+        for question in (small, large):
+            with self.assertNumQueries(2):
+                self.client.get(reverse('polls:results', args=(question.id,)))
+
+    def test_future_question(self):
+        """
+        The results of a question that isn't published yet are not found.
+        """
+        future_question = create_question(question_text="Future question.", days=5)
+        response = self.client.get(reverse('polls:results', args=(future_question.id,)))
+        self.assertEqual(response.status_code, 404)
+
+
+class VoteViewTests(TestCase):
+    def setUp(self):
+        self.user = create_users(1)[0]
+        self.client.force_login(self.user)
+
+    def test_vote(self):
+        """A vote on an open question is recorded."""
+        question = create_question(question_text="Open question.", days=-1)
+        choice = create_choices(question, 2)[1]
+        response = self.client.post(reverse('polls:vote', args=(question.id,)),
+                                    {'choice': choice.id})
+        self.assertRedirects(response, reverse('polls:results', args=(question.id,)))
+        self.assertEqual(Vote.objects.get(user=self.user).choice, choice)
+
+    def test_changed_vote(self):
+        """Voting again replaces the user's vote on the question."""
+        question = create_question(question_text="Open question.", days=-1)
+        first, second = create_choices(question, 2)
+        url = reverse('polls:vote', args=(question.id,))
+        self.client.post(url, {'choice': first.id})
+        self.client.post(url, {'choice': second.id})
+        vote = Vote.objects.get(user=self.user)
+        self.assertEqual((vote.question, vote.choice), (question, second))
+
+    def test_vote_on_closed_question(self):
+        """A vote on a question past its end date is rejected."""
+        question = create_question(question_text="Closed question.", days=-2)
+        question.end_date = timezone.now() - datetime.timedelta(days=1)
+        question.save()
+        choice = create_choices(question, 1)[0]
+        response = self.client.post(reverse('polls:vote', args=(question.id,)),
+                                    {'choice': choice.id})
+        self.assertRedirects(response, reverse('polls:index'))
+        self.assertFalse(Vote.objects.exists())
+
+    def test_vote_on_future_question(self):
+        """A vote on a question that isn't published yet is rejected."""
+        question = create_question(question_text="Future question.", days=5)
+        choice = create_choices(question, 1)[0]
+        response = self.client.post(reverse('polls:vote', args=(question.id,)),
+                                    {'choice': choice.id})
+        self.assertRedirects(response, reverse('polls:index'))
+        self.assertFalse(Vote.objects.exists())
+
+
+@override_settings(POLLS_VOTE_COUNTERS=True)
+class VoteCounterTests(TestCase):
+    def setUp(self):
+        self.question = create_question(question_text="Open question.", days=-1)
+        self.first, self.second = create_choices(self.question, 2)
+        self.user = create_users(1)[0]
+        self.client.force_login(self.user)
+
+    def vote_for(self, choice):
+        return self.client.post(reverse('polls:vote', args=(self.question.id,)),
+                                {'choice': choice.id})
+
+    def assertCounters(self, first, second):
+        """Assert the counters of both choices and of the question."""
+        self.first.refresh_from_db()
+        self.second.refresh_from_db()
+        self.question.refresh_from_db()
+        self.assertEqual((self.first.vote_count, self.second.vote_count), (first, second))
+        self.assertEqual(self.question.total_votes, first + second)
+
+    def test_new_vote(self):
+        """A new vote increments its choice and the question total."""
+        self.vote_for(self.first)
+        self.assertCounters(1, 0)
+
+    def test_changed_vote(self):
+        """A changed vote moves one count between choices."""
+        self.vote_for(self.first)
+        self.vote_for(self.second)
+        self.assertCounters(0, 1)
+
+    def test_same_vote_twice(self):
+        """Voting for the same choice again leaves the counters alone."""
+        self.vote_for(self.first)
+        self.vote_for(self.first)
+        self.assertCounters(1, 0)
+
+    def test_deleted_vote(self):
+        """Deleting a vote, directly or by cascade, decrements the counters."""
+        other = create_users(1, start=1)[0]
+        self.vote_for(self.first)
+        self.client.force_login(other)
+        self.vote_for(self.second)
+        Vote.objects.get(user=self.user).delete()
+        self.assertCounters(0, 1)
+        other.delete()
+        self.assertCounters(0, 0)
+
+    def test_results_read_counters(self):
+        """Results are read from the counters."""
+        self.vote_for(self.first)
+        Choice.objects.filter(pk=self.second.pk).update(vote_count=3)
+        response = self.client.get(reverse('polls:results', args=(self.question.id,)))
+        self.assertEqual([choice.num_votes for choice in response.context['choices']],
+                         [1, 3])
+
+    def test_reconcile_command(self):
+        """The reconcile command recounts counters that drifted."""
+        self.vote_for(self.first)
+        Choice.objects.filter(pk=self.first.pk).update(vote_count=7)
+        Question.objects.filter(pk=self.question.pk).update(total_votes=7)
+        out = StringIO()
+        call_command('reconcile_vote_counters', stdout=out)
+        self.assertIn("Reconciled 1 choice and 1 question counters.", out.getvalue())
+        self.assertCounters(1, 0)
+
+
+@override_settings(POLLS_VOTE_COUNTERS=True)
+class ShardedCounterTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.question = Question.objects.create(question_text="Busy question.",
+                                                pub_date=timezone.now() - datetime.timedelta(days=1),
+                                                counter_shards=4)
+        self.first, self.second = create_choices(self.question, 2)
+        self.users = create_users(6)
+
+    def tallies(self):
+        cache.clear()
+        return [choice.num_votes for choice in get_tallies(self.question)['choices']]
+
+    def test_votes_go_to_shards(self):
+        """Votes on a sharded question add to shards, not to the choice's counter row."""
+        for user in self.users:
+            cast_vote(user, self.first)
+        cast_vote(self.users[0], self.second)
+        self.first.refresh_from_db()
+        self.assertEqual(self.first.vote_count, 0)
+        self.assertEqual(ChoiceCounterShard.objects.filter(choice=self.first).aggregate(
+            total=Sum('count'))['total'], 5)
+        self.assertLessEqual(ChoiceCounterShard.objects.filter(choice=self.first).count(), 4)
+        self.assertEqual(self.tallies(), [5, 1])
+        self.assertEqual((self.first.votes, self.second.votes), (5, 1))
+
+    def test_batch_votes(self):
+        """Votes cast in a batch are sharded too."""
+        cast_votes([(user.id, self.question.id, self.second.id) for user in self.users])
+        self.assertEqual(self.tallies(), [0, 6])
+
+    def test_compaction(self):
+        """Compaction folds the shards into the counters without changing the tallies."""
+        for user in self.users[:3]:
+            cast_vote(user, self.first)
+        cast_vote(self.users[3], self.second)
+        out = StringIO()
+        call_command('compact_vote_counters', stdout=out)
+        self.assertIn("Compacted", out.getvalue())
+        self.assertFalse(ChoiceCounterShard.objects.exists())
+        self.first.refresh_from_db()
+        self.question.refresh_from_db()
+        self.assertEqual((self.first.vote_count, self.question.total_votes), (3, 4))
+        self.assertEqual(self.tallies(), [3, 1])
+        cast_vote(self.users[4], self.first)
+        self.assertEqual(self.tallies(), [4, 1])
+
+    def test_deleted_votes(self):
+        """Votes deleted, alone or with their choice, come off the tallies."""
+        for user in self.users[:2]:
+            cast_vote(user, self.first)
+        Vote.objects.get(user=self.users[0]).delete()
+        self.assertEqual(self.tallies(), [1, 0])
+        self.first.delete()
+        self.assertEqual(self.tallies(), [0])
+
+    def test_deleted_choice_total(self):
+        """Deleting a choice with shards left keeps the question's total right after compaction."""
+        for user in self.users[:3]:
+            cast_vote(user, self.first)
+        for user in self.users[3:5]:
+            cast_vote(user, self.second)
+        self.first.delete()
+        call_command('compact_vote_counters', stdout=StringIO())
+        self.question.refresh_from_db()
+        self.assertEqual(self.question.total_votes, 2)
+        self.assertEqual(self.tallies(), [2])
+
+    def test_reconcile(self):
+        """Reconciling folds the shards and recounts the counters."""
+        for user in self.users[:2]:
+            cast_vote(user, self.first)
+        call_command('reconcile_vote_counters', stdout=StringIO())
+        self.first.refresh_from_db()
+        self.assertEqual(self.first.vote_count, 2)
+        self.assertEqual(self.tallies(), [2, 0])
+
+    def test_turned_off(self):
+        """With sharding turned off votes go to the counter row, and the shards still count."""
+        cast_vote(self.users[0], self.first)
+        self.question.counter_shards = 0
+        self.question.save()
+        cast_vote(self.users[1], self.first)
+        self.first.refresh_from_db()
+        self.assertEqual(self.first.vote_count, 1)
+        self.assertEqual(self.tallies(), [2, 0])
+
+
+class CastVoteTests(TestCase):
+    def setUp(self):
+        self.question = create_question(question_text="Open question.", days=-1)
+        self.first, self.second = create_choices(self.question, 2)
+        self.user = create_users(1)[0]
+
+    def test_first_vote(self):
+        """The first vote has no previous choice."""
+        self.assertIsNone(cast_vote(self.user, self.first))
+        self.assertEqual(Vote.objects.get(user=self.user).choice, self.first)
+
+    def test_replaced_vote(self):
+        """A later vote replaces the earlier one and returns its choice."""
+        cast_vote(self.user, self.first)
+        self.assertEqual(cast_vote(self.user, self.second), self.first.id)
+        self.assertEqual(Vote.objects.get(user=self.user).choice, self.second)
+
+    def test_save_fills_question(self):
+        """Saving a vote copies the question of its choice."""
+        vote = Vote.objects.create(user=self.user, choice=self.second)
+        self.assertEqual(vote.question, self.question)
+
+    def test_one_vote_per_user_and_question(self):
+        """The database rejects a second vote of a user on a question."""
+        Vote.objects.create(user=self.user, choice=self.first)
+        with self.assertRaises(IntegrityError):
+            Vote.objects.create(user=self.user, choice=self.second)
+
+    @override_settings(POLLS_VOTE_COUNTERS=True)
+    def test_cast_votes_last_write_wins(self):
+        """Batched votes keep each user's last vote and update the counters."""
+        other = create_users(1, start=1)[0]
+        cast_vote(self.user, self.first)
+        previous = cast_votes([
+            (self.user.id, self.question.id, self.second.id),
+            (other.id, self.question.id, self.second.id),
+            (other.id, self.question.id, self.first.id),
+        ])
+        self.assertEqual(previous, {(self.user.id, self.question.id): self.first.id,
+                                    (other.id, self.question.id): None})
+        self.assertEqual(dict(Vote.objects.values_list('user_id', 'choice_id')),
+                         {self.user.id: self.second.id, other.id: self.first.id})
+        self.assertEqual(list(Choice.objects.values_list('vote_count', flat=True)), [1, 1])
+        self.question.refresh_from_db()
+        self.assertEqual(self.question.total_votes, 2)
+
+
+@unittest.skipUnless(connection.vendor == 'postgresql', "needs concurrent writes")
+@override_settings(POLLS_VOTE_COUNTERS=True, POLLS_VOTE_TRENDS=True)
+class ConcurrentVoteTests(TransactionTestCase):
+    def test_simultaneous_votes_counted_once(self):
+        """Votes of one user sent at the same time are counted once."""
+        question = create_question(question_text="Open question.", days=-1)
+        choices = create_choices(question, 2)
+        user = create_users(1)[0]
+        barrier = threading.Barrier(8)
+
+        def vote(choice):
+            try:
+                barrier.wait()
+                cast_vote(user, choice)
+            finally:
+                connection.close()
+        threads = [threading.Thread(target=vote, args=(choices[i % 2],)) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        vote = Vote.objects.get()
+        self.assertEqual(dict(Choice.objects.values_list('pk', 'vote_count')),
+                         {choice.pk: int(choice == vote.choice) for choice in choices})
+        question.refresh_from_db()
+        self.assertEqual(question.total_votes, 1)
+        self.assertEqual(VoteRollup.objects.aggregate(total=Sum('delta'))['total'], 1)
+
+
+@override_settings(POLLS_VOTE_TRENDS=True)
+class VoteTrendTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.question = create_question(question_text="Open question.", days=-1)
+        self.first, self.second = create_choices(self.question, 2)
+        self.user = create_users(1)[0]
+        self.start = timezone.now().replace(second=30, microsecond=0)
+
+    def at(self, moment):
+        return mock.patch('django.utils.timezone.now', return_value=moment)
+
+    def rollups(self, resolution=VoteRollup.MINUTE):
+        return list(VoteRollup.objects.filter(resolution=resolution).order_by('bucket', 'choice')
+                    .values_list('choice_id', 'bucket', 'delta'))
+
+    def test_vote_times(self):
+        """A vote records when it was cast and when its choice last changed."""
+        later = self.start + datetime.timedelta(minutes=5)
+        with self.at(self.start):
+            cast_vote(self.user, self.first)
+        with self.at(later):
+            cast_vote(self.user, self.second)
+        vote = Vote.objects.get(user=self.user)
+        self.assertEqual((vote.cast_at, vote.changed_at), (self.start, later))
+
+    def test_votes_rolled_up_per_minute(self):
+        """Casting and changing votes adds to the minute rollups of the choices."""
+        minute = self.start.replace(second=0)
+        with self.at(self.start):
+            cast_vote(self.user, self.first)
+            cast_vote(create_users(1, start=1)[0], self.first)
+        with self.at(self.start + datetime.timedelta(minutes=1)):
+            cast_vote(self.user, self.second)
+        self.assertEqual(self.rollups(), [
+            (self.first.id, minute, 2),
+            (self.first.id, minute + datetime.timedelta(minutes=1), -1),
+            (self.second.id, minute + datetime.timedelta(minutes=1), 1),
+        ])
+
+    def test_batch_votes_rolled_up(self):
+        """Votes cast in a batch are rolled up too."""
+        users = create_users(3, start=1)
+        cast_votes([(user.id, self.question.id, self.second.id) for user in users])
+        self.assertEqual([delta for _, _, delta in self.rollups()], [3])
+
+    @override_settings(POLLS_VOTE_TRENDS=False)
+    def test_trends_off(self):
+        """With trends off, votes aren't rolled up."""
+        cast_vote(self.user, self.first)
+        self.assertEqual(self.rollups(), [])
+
+    def test_compaction(self):
+        """Old minute rollups are folded into hour rollups, leaving the hourly trend as it was."""
+        old = self.start - datetime.timedelta(days=2)
+        with self.at(old):
+            cast_vote(self.user, self.first)
+        with self.at(old + datetime.timedelta(minutes=1)):
+            cast_vote(create_users(1, start=1)[0], self.first)
+        cast_vote(create_users(1, start=2)[0], self.second)
+        before = trends.get_trend(self.question, VoteRollup.HOUR, 72)
+        self.assertEqual(trends.compact_rollups(), 2)
+        self.assertEqual(trends.get_trend(self.question, VoteRollup.HOUR, 72), before)
+        self.assertEqual(self.rollups(VoteRollup.HOUR),
+                         [(self.first.id, old.replace(minute=0, second=0), 2)])
+        self.assertEqual(len(self.rollups()), 1)
+
+    def test_rebuild(self):
+        """Rollups can be rebuilt from the votes, such as after an import."""
+        Vote.objects.create(user=self.user, choice=self.first, changed_at=self.start)
+        call_command('compact_vote_rollups', '--rebuild', stdout=StringIO())
+        self.assertEqual(self.rollups(), [(self.first.id, self.start.replace(second=0), 1)])
+
+    def test_trend_json(self):
+        """The trend endpoint reports each choice's net votes per bucket with a sparkline."""
+        with self.at(self.start - datetime.timedelta(minutes=2)):
+            cast_vote(self.user, self.first)
+        with self.at(self.start):
+            cast_vote(self.user, self.second)
+        with self.at(self.start):
+            response = self.client.get(reverse('polls:trend_json', args=(self.question.id,)),
+                                       {'buckets': 3})
+        data = response.json()
+        self.assertEqual(len(data['buckets']), 3)
+        self.assertEqual([(choice['id'], choice['votes'], choice['sparkline'])
+                          for choice in data['choices']],
+                         [(self.first.id, [1, 0, -1], '█▅▁'), (self.second.id, [0, 0, 1], '▁▁█')])
+
+    def test_trend_json_invalid(self):
+        """Unknown resolutions and bucket counts are rejected."""
+        url = reverse('polls:trend_json', args=(self.question.id,))
+        self.assertEqual(self.client.get(url, {'resolution': 'day'}).status_code, 400)
+        self.assertEqual(self.client.get(url, {'buckets': 'many'}).status_code, 400)
+        self.assertEqual(self.client.get(url, {'buckets': 100000}).status_code, 400)
+
+
+@override_settings(POLLS_PAGE_CACHE_TIMEOUT=0)
+class ResultsCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.question = create_question(question_text="Open question.", days=-1)
+        self.first, self.second = create_choices(self.question, 2)
+        self.user = create_users(1)[0]
+        self.url = reverse('polls:results', args=(self.question.id,))
+
+    def tallies(self):
+        response = self.client.get(self.url)
+        return [choice.num_votes for choice in response.context['choices']]
+
+    def test_cached_read(self):
+        """A second read serves the tallies and the table from the cache."""
+        self.client.get(self.url)
+        with self.assertNumQueries(1):
+            response = self.client.get(self.url)
+        self.assertContains(response, '<td class="vote_count">0</td>', html=True)
+
+    def test_vote_visible_on_next_read(self):
+        """A vote through the vote view shows on the very next read."""
+        self.assertEqual(self.tallies(), [0, 0])
+        self.client.force_login(self.user)
+        vote_url = reverse('polls:vote', args=(self.question.id,))
+        self.client.post(vote_url, {'choice': self.first.id})
+        self.assertEqual(self.tallies(), [1, 0])
+        self.client.post(vote_url, {'choice': self.second.id})
+        self.assertEqual(self.tallies(), [0, 1])
+        response = self.client.get(self.url)
+        self.assertContains(response, '<td class="vote_count">100.0%</td>', html=True)
+
+    def test_saved_and_deleted_votes_visible_on_next_read(self):
+        """Votes saved or deleted outside the vote view also invalidate the cache."""
+        self.assertEqual(self.tallies(), [0, 0])
+        vote = Vote.objects.create(user=self.user, choice=self.second)
+        self.assertEqual(self.tallies(), [0, 1])
+        vote.delete()
+        self.assertEqual(self.tallies(), [0, 0])
+
+    @override_settings(POLLS_RESULTS_CACHE_TIMEOUT=0)
+    def test_staleness_bound(self):
+        """Results are recounted once the cache timeout has passed."""
+        self.assertEqual(self.tallies(), [0, 0])
+        Vote.objects.bulk_create([Vote(user=self.user, question=self.question,
+                                       choice=self.first)])
+        self.assertEqual(self.tallies(), [1, 0])
+
+
+class PageCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.question = create_question(question_text="Open question.", days=-1)
+        self.first, self.second = create_choices(self.question, 2)
+        self.user = create_users(1)[0]
+        self.index_url = reverse('polls:index')
+        self.results_url = reverse('polls:results', args=(self.question.id,))
+
+    def test_anonymous_page_cached(self):
+        """A second anonymous read is served whole from the cache, marked public."""
+        self.client.get(self.results_url)
+        with self.assertNumQueries(0):
+            response = self.client.get(self.results_url)
+        self.assertContains(response, "Log in")
+        self.assertContains(response, '<td class="vote_count">0</td>', html=True)
+        self.assertIn('public', response['Cache-Control'])
+        self.assertIn('s-maxage=5', response['Cache-Control'])
+        self.assertIn('Cookie', response['Vary'])
+
+    def test_unread_parameters_share_page(self):
+        """Query parameters the view doesn't read don't make new copies of a page."""
+        self.client.get(self.index_url, {'x': 'first'})
+        with self.assertNumQueries(0):
+            self.client.get(self.index_url, {'x': 'second'})
+        response = self.client.get(self.index_url, {'status': 'open', 'x': 'first'})
+        self.assertIsNotNone(response.context)
+        with self.assertNumQueries(0):
+            response = self.client.get(self.index_url, {'x': 'second', 'status': 'open'})
+        self.assertIsNone(response.context)
+
+    def test_logged_in_never_gets_cached_page(self):
+        """Logged-in users get their own page, marked private, not the cached one."""
+        self.client.get(self.index_url)
+        self.client.get(self.results_url)
+        self.client.force_login(self.user)
+        for url in (self.index_url, self.results_url):
+            response = self.client.get(url)
+            self.assertContains(response, f"Welcome back, {self.user.username}")
+            self.assertNotContains(response, "Log in")
+            self.assertIn('private', response['Cache-Control'])
+            self.assertIn('Cookie', response['Vary'])
+
+    def test_logged_in_page_not_cached(self):
+        """Anonymous visitors don't get a page rendered for a logged-in user."""
+        self.client.force_login(self.user)
+        self.client.get(self.index_url)
+        self.client.logout()
+        response = self.client.get(self.index_url)
+        self.assertContains(response, "Log in")
+        self.assertNotContains(response, "Welcome back")
+
+    def test_messages_bypass_cache(self):
+        """An anonymous visitor with a message gets it, not the cached page."""
+        self.client.get(self.index_url)
+        future_question = create_question(question_text="Future question.", days=5)
+        response = self.client.get(reverse('polls:detail', args=(future_question.id,)),
+                                   follow=True)
+        self.assertContains(response, "This question is not available.")
+        self.assertIn('private', response['Cache-Control'])
+
+    def test_vote_purges_results_page(self):
+        """A new vote shows on the next anonymous read of the results page."""
+        self.client.get(self.results_url)
+        Vote.objects.create(user=self.user, choice=self.first)
+        response = self.client.get(self.results_url)
+        self.assertContains(response, '<td class="vote_count">1</td>', html=True)
+
+    def test_question_edit_purges_index(self):
+        """A question edited in the admin shows on the next anonymous index read."""
+        self.client.get(self.index_url)
+        self.question.question_text = "Edited question."
+        self.question.save()
+        response = self.client.get(self.index_url)
+        self.assertContains(response, "Edited question.")
+
+    @override_settings(POLLS_PAGE_CACHE_TIMEOUT=0)
+    def test_page_cache_off(self):
+        """With no page cache timeout every read renders the page."""
+        self.client.get(self.results_url)
+        response = self.client.get(self.results_url)
+        self.assertEqual(response.context['total_votes'], 0)
+        self.assertIn('private', response['Cache-Control'])
+
+
+class UserVotesTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = create_users(1)[0]
+        self.client.force_login(self.user)
+        self.questions = [create_question(question_text=f"Question {i}.", days=-i - 1)
+                          for i in range(5)]
+        self.choices = [create_choices(question, 2) for question in self.questions]
+
+    def test_detail_shows_last_vote(self):
+        """The detail page preselects the user's current choice."""
+        question, (first, second) = self.questions[0], self.choices[0]
+        self.client.post(reverse('polls:vote', args=(question.id,)), {'choice': second.id})
+        response = self.client.get(reverse('polls:detail', args=(question.id,)))
+        self.assertEqual(response.context['last_vote'], second.id)
+
+    def test_detail_uses_cached_votes(self):
+        """Once the vote map is cached, the detail page doesn't query votes."""
+        Vote.objects.create(user=self.user, choice=self.choices[0][1])
+        url = reverse('polls:detail', args=(self.questions[0].id,))
+        self.client.get(url)
+        with self.assertNumQueries(4):
+            response = self.client.get(url)
+        self.assertEqual(response.context['last_vote'], self.choices[0][1].id)
+
+    def test_index_marks_voted_questions(self):
+        """The index marks the questions the user voted on."""
+        for choices in self.choices[:2]:
+            Vote.objects.create(user=self.user, choice=choices[0])
+        response = self.client.get(reverse('polls:index'))
+        self.assertEqual([question.voted for question in response.context['latest_question_list']],
+                         [True, True, False, False, False])
+        self.assertContains(response, "Voted", count=2)
+
+    def test_index_queries_independent_of_votes(self):
+        """Marking voted questions takes one query, however many rows are shown."""
+        for choices in self.choices:
+            Vote.objects.create(user=self.user, choice=choices[0])
+        with self.assertNumQueries(4):
+            self.client.get(reverse('polls:index'))
+
+    def test_deleted_vote_forgotten(self):
+        """Deleting a vote drops it from the user's vote map."""
+        vote = Vote.objects.create(user=self.user, choice=self.choices[0][0])
+        url = reverse('polls:detail', args=(self.questions[0].id,))
+        self.assertEqual(self.client.get(url).context['last_vote'], vote.choice_id)
+        vote.delete()
+        self.assertIsNone(self.client.get(url).context['last_vote'])
+
+
+def create_kiosk():
+    """Create a user allowed to upload batches of votes."""
+    kiosk = User.objects.create(username="kiosk")
+    kiosk.user_permissions.add(Permission.objects.get(codename='add_vote'))
+    return kiosk
+
+
+class BatchVoteTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(create_kiosk())
+        self.users = create_users(3)
+        self.question = create_question(question_text="Open.", days=-1)
+        self.choices = create_choices(self.question, 2)
+
+    def upload(self, votes, client=None):
+        return (client or self.client).post(reverse('polls:batch_vote'), {'votes': votes},
+                                            content_type='application/json')
+
+    def record(self, user, choice, question=None):
+        return {'user': user.username, 'question': (question or self.question).id,
+                'choice': choice.id}
+
+    def test_votes_recorded(self):
+        """Valid votes are recorded, each with its status in order."""
+        cast_vote(self.users[1], self.choices[0])
+        cast_vote(self.users[2], self.choices[1])
+        response = self.upload([self.record(self.users[0], self.choices[0]),
+                                self.record(self.users[1], self.choices[1]),
+                                self.record(self.users[2], self.choices[1])])
+        self.assertEqual(response.json()['results'], [
+            {'status': 'created'},
+            {'status': 'changed', 'previous_choice': self.choices[0].id},
+            {'status': 'unchanged'},
+        ])
+        self.assertEqual(dict(Vote.objects.values_list('user_id', 'choice_id')),
+                         {self.users[0].id: self.choices[0].id,
+                          self.users[1].id: self.choices[1].id,
+                          self.users[2].id: self.choices[1].id})
+
+    def test_later_record_replaces_earlier(self):
+        """Of two records of a user on a question, the later one is recorded."""
+        response = self.upload([self.record(self.users[0], self.choices[0]),
+                                self.record(self.users[0], self.choices[1])])
+        self.assertEqual(response.json()['results'],
+                         [{'status': 'replaced'}, {'status': 'created'}])
+        self.assertEqual(Vote.objects.get().choice, self.choices[1])
+
+    def test_invalid_records_rejected(self):
+        """Invalid records are rejected one by one; the valid ones are still recorded."""
+        closed = create_question(question_text="Closed.", days=5)
+        other_choice = create_choices(closed, 1)[0]
+        inactive = User.objects.create(username="inactive", is_active=False)
+        response = self.upload([
+            self.record(self.users[0], self.choices[0]),
+            {'user': self.users[1].username, 'question': str(self.question.id)},
+            self.record(inactive, self.choices[0]),
+            self.record(self.users[1], other_choice, question=closed),
+            self.record(self.users[2], other_choice),
+        ])
+        statuses = [result['status'] for result in response.json()['results']]
+        self.assertEqual(statuses, ['created'] + ['rejected'] * 4)
+        self.assertEqual(list(Vote.objects.values_list('user_id', flat=True)), [self.users[0].id])
+
+    def test_results_and_vote_maps_updated(self):
+        """Uploaded votes show in the results and in each user's vote map."""
+        self.assertEqual(get_tallies(self.question)['total_votes'], 0)
+        voter = Client()
+        voter.force_login(self.users[0])
+        voter.get(reverse('polls:detail', args=(self.question.id,)))
+        self.upload([self.record(self.users[0], self.choices[1])])
+        self.assertEqual(get_tallies(self.question)['total_votes'], 1)
+        response = voter.get(reverse('polls:detail', args=(self.question.id,)))
+        self.assertEqual(response.context['last_vote'], self.choices[1].id)
+
+    def test_needs_permission(self):
+        """Anonymous clients and users without polls.add_vote can't upload votes."""
+        self.assertEqual(self.upload([], client=Client()).status_code, 401)
+        voter = Client()
+        voter.force_login(self.users[0])
+        self.assertEqual(self.upload([self.record(self.users[0], self.choices[0])],
+                                     client=voter).status_code, 403)
+        self.assertFalse(Vote.objects.exists())
+
+    def test_bad_batch(self):
+        """A body that isn't a list of 1 to MAX_BATCH_VOTES votes is a bad request."""
+        self.assertEqual(self.upload([]).status_code, 400)
+        response = self.client.post(reverse('polls:batch_vote'), 'not json',
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        with mock.patch('polls.views.MAX_BATCH_VOTES', 1):
+            self.assertEqual(self.upload([self.record(user, self.choices[0])
+                                          for user in self.users]).status_code, 400)
+
+
+class QueuedVoteTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        settings_override = override_settings(POLLS_VOTE_INGESTION='queued',
+                                              POLLS_VOTE_JOURNAL=f'{directory.name}/journal.sqlite3')
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.user = create_users(1)[0]
+        self.client.force_login(self.user)
+        self.question = create_question(question_text="Queued.", days=-1)
+        self.choices = create_choices(self.question, 2)
+
+    def vote(self, choice):
+        return self.client.post(reverse('polls:vote', args=(self.question.id,)), {'choice': choice.id})
+
+    def test_vote_is_queued(self):
+        """A queued vote is journaled, not written to the database."""
+        self.vote(self.choices[0])
+        self.assertFalse(Vote.objects.exists())
+        self.assertEqual(ingest.get_journal().lag()[0], 1)
+
+    def test_user_reads_own_queued_vote(self):
+        """The detail page shows a queued vote, even without a cached vote map."""
+        self.vote(self.choices[0])
+        self.vote(self.choices[1])
+        cache.clear()
+        response = self.client.get(reverse('polls:detail', args=(self.question.id,)))
+        self.assertEqual(response.context['last_vote'], self.choices[1].id)
+
+    def test_changed_queued_vote_message(self):
+        """Changing a vote still in the journal is reported as a change."""
+        self.vote(self.choices[0])
+        response = self.vote(self.choices[1])
+        self.assertEqual([str(message) for message in response.wsgi_request._messages],
+                         ["You voted for 'Choice 0'", "Your vote was changed to 'Choice 1'"])
+
+    def test_flush_last_write_wins(self):
+        """Flushing writes the user's last vote and empties the journal."""
+        self.vote(self.choices[0])
+        self.vote(self.choices[1])
+        out = StringIO()
+        call_command('flush_vote_journal', stdout=out)
+        self.assertIn("Flushed 2 votes", out.getvalue())
+        self.assertEqual(list(Vote.objects.values_list('choice_id', flat=True)), [self.choices[1].id])
+        self.assertEqual(ingest.get_journal().lag(), (0, 0.0))
+
+    def test_flush_keeps_vote_map(self):
+        """A vote map loaded before a flush still shows the flushed vote after it."""
+        self.vote(self.choices[0])
+        self.assertEqual(get_user_votes(self.user), {self.question.id: self.choices[0].id})
+        with mock.patch('polls.broadcast.ResultsBroadcaster.notify') as notify, \
+                self.captureOnCommitCallbacks(execute=True):
+            call_command('flush_vote_journal', stdout=StringIO())
+        notify.assert_called_once_with(self.question.id)
+        self.assertEqual(get_user_votes(self.user), {self.question.id: self.choices[0].id})
+        response = self.client.get(reverse('polls:detail', args=(self.question.id,)))
+        self.assertEqual(response.context['last_vote'], self.choices[0].id)
+
+    @override_settings(POLLS_VOTE_QUEUE_MAX_PENDING=1)
+    def test_backpressure_writes_directly(self):
+        """Once the journal is full, votes are written directly."""
+        self.vote(self.choices[0])
+        self.vote(self.choices[1])
+        self.assertEqual(Vote.objects.get().choice, self.choices[1])
+        # The direct vote replaced the queued one
+        self.assertEqual(ingest.get_journal().lag()[0], 0)
+        call_command('flush_vote_journal', stdout=StringIO())
+        self.assertEqual(Vote.objects.get().choice, self.choices[1])
+
+    def test_flush_skips_votes_older_than_stored(self):
+        """A queued vote doesn't replace a vote written directly after it was queued."""
+        ingest.enqueue_vote(self.user, self.choices[0])
+        cast_vote(self.user, self.choices[1])
+        call_command('flush_vote_journal', stdout=StringIO())
+        self.assertEqual(Vote.objects.get().choice, self.choices[1])
+        self.assertEqual(ingest.get_journal().lag()[0], 0)
+
+    def test_flush_drops_votes_of_deleted_rows(self):
+        """Queued votes whose user or choice was deleted are dropped with a warning."""
+        other = create_users(1, start=1)[0]
+        ingest.enqueue_vote(other, self.choices[0])
+        ingest.enqueue_vote(self.user, self.choices[1])
+        self.vote(self.choices[0])
+        other.delete()
+        self.choices[1].delete()
+        with self.assertLogs('polls', 'WARNING') as logs:
+            call_command('flush_vote_journal', stdout=StringIO())
+        self.assertEqual(len(logs.records), 2)
+        self.assertEqual(Vote.objects.get().choice, self.choices[0])
+        self.assertEqual(ingest.get_journal().lag()[0], 0)
+
+    def test_flush_loop_survives_errors(self):
+        """A failing batch is logged and retried instead of stopping the worker."""
+        class Stop(Exception):
+            pass
+
+        with mock.patch('polls.ingest.flush', side_effect=[RuntimeError("boom"), 0]) as flush, \
+                mock.patch('time.sleep', side_effect=[None, Stop]), \
+                self.assertLogs('polls', 'ERROR'), self.assertRaises(Stop):
+            call_command('flush_vote_journal', loop=True, stdout=StringIO())
+        self.assertEqual(flush.call_count, 2)
+
+
+class ImportExportTests(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+    def import_polls(self, *args):
+        out = StringIO()
+        call_command('import_polls', *args, stdout=out)
+        return out.getvalue()
+
+    def test_import_fixtures(self):
+        """The fixtures loaded on start are imported, in small batches too."""
+        output = self.import_polls('data/users.json', 'data/polls-v4.json',
+                                   'data/votes-v4.json', '--batch-size', '2')
+        self.assertIn("rows/s", output)
+        self.assertEqual(Question.objects.count(), 5)
+        self.assertEqual(Vote.objects.count(), 4)
+        self.assertTrue(User.objects.filter(username='demo1').exists())
+
+    def test_import_legacy_votes(self):
+        """The votes field of old fixtures is imported into the counters."""
+        self.import_polls('data/users.json', 'data/polls-v1.json')
+        self.assertEqual(Choice.objects.filter(vote_count=1).count(), 1)
+        self.assertEqual(sum(Question.objects.values_list('total_votes', flat=True)), 1)
+
+    def test_reimport_keeps_missing_fields(self):
+        """Importing again updates rows but keeps the fields the file doesn't have."""
+        self.import_polls('data/users.json', 'data/polls-v1.json')
+        self.import_polls('data/polls-v4.json')
+        self.assertEqual(Choice.objects.filter(vote_count=1).count(), 1)
+        self.assertEqual(Question.objects.count(), 5)
+
+    def test_export_import_round_trip(self):
+        """Exported JSON, JSONL and CSV files import back to the same rows."""
+        self.import_polls('data/users.json', 'data/polls-v4.json', 'data/votes-v4.json')
+        votes = list(Vote.objects.values_list('pk', 'user_id', 'question_id', 'choice_id'))
+        for name, args in [('polls.json', []), ('polls.jsonl', []),
+                           ('votes.csv', ['--model', 'polls.vote'])]:
+            path = f'{self.directory}/{name}'
+            call_command('export_polls', path, *args, stderr=StringIO())
+            Vote.objects.all().delete()
+            self.import_polls(path, *args)
+            self.assertEqual(list(Vote.objects.values_list('pk', 'user_id', 'question_id', 'choice_id')),
+                             votes)
+
+    def test_conflicting_votes_skipped(self):
+        """Votes of a user who has another vote on the question are skipped, not fatal."""
+        self.import_polls('data/users.json', 'data/polls-v4.json', 'data/votes-v4.json')
+        path = f'{self.directory}/votes.jsonl'
+        with open(path, 'w') as stream:
+            for pk, user, question, choice in [(99, 2, 2, 6), (100, 4, 1, 2), (101, 4, 1, 3)]:
+                stream.write(json.dumps({'model': 'polls.vote', 'pk': pk, 'fields': {
+                    'user': user, 'question': question, 'choice': choice}}) + '\n')
+        with self.assertLogs('polls', 'WARNING') as logs:
+            output = self.import_polls(path)
+        self.assertEqual(len(logs.records), 2)
+        self.assertIn("polls.vote: 2 conflicting rows skipped", output)
+        self.assertEqual(Vote.objects.get(user_id=2, question_id=2).pk, 1)
+        self.assertEqual(Vote.objects.get(user_id=4, question_id=1).choice_id, 3)
+        self.assertFalse(Vote.objects.filter(pk__in=[99, 100]).exists())
+
+    def test_csv_needs_model(self):
+        """Importing CSV without its model is an error."""
+        path = f'{self.directory}/votes.csv'
+        with open(path, 'w') as stream:
+            stream.write('pk,choice,question,user\n')
+        with self.assertRaises(CommandError):
+            self.import_polls(path)
+
+    def test_json_read_in_chunks(self):
+        """Fixtures are parsed incrementally, whatever the chunk size."""
+        stream = StringIO(' [ {"model": "Polls.Question", "pk": 1, "fields": {"question_text": "[]"}},'
+                          '\n{"model": "polls.choice", "pk": 2, "fields": {}} ] ')
+        self.assertEqual([(obj['model'], obj['pk']) for obj in _read_json_array(stream, chunk_size=5)],
+                         [('Polls.Question', 1), ('polls.choice', 2)])
+
+
+class BootstrapCommandTests(TestCase):
+    fixtures_args = ['data/users.json', 'data/polls-v4.json', 'data/votes-v4.json']
+
+    def bootstrap(self, *args):
+        out = StringIO()
+        call_command('bootstrap', *args, stdout=out)
+        return out.getvalue()
+
+    def test_first_boot(self):
+        """The first boot imports the fixtures and creates the admin."""
+        output = self.bootstrap(*self.fixtures_args)
+        self.assertIn("Applied 0 migrations", output)
+        self.assertIn("Imported 3 fixtures, 0 unchanged", output)
+        self.assertEqual(Question.objects.count(), 5)
+        self.assertEqual(FixtureLoad.objects.count(), 3)
+        self.assertTrue(User.objects.get(username='admin').is_superuser)
+
+    def test_second_boot_skips_unchanged(self):
+        """Booting again imports nothing and keeps the admin."""
+        self.bootstrap(*self.fixtures_args)
+        Question.objects.filter(pk=5).delete()
+        output = self.bootstrap(*self.fixtures_args)
+        self.assertIn("Imported 0 fixtures, 3 unchanged", output)
+        self.assertIn("Admin 'admin' already exists", output)
+        self.assertEqual(Question.objects.count(), 4)
+
+    def test_changed_fixture_is_imported(self):
+        """A fixture is imported again once its contents change."""
+        self.bootstrap(*self.fixtures_args)
+        FixtureLoad.objects.filter(fixture='data/polls-v4.json').update(checksum='old')
+        output = self.bootstrap(*self.fixtures_args, '--no-admin')
+        self.assertIn("Imported 1 fixtures, 2 unchanged", output)
+
+    def test_shared_cache_check(self):
+        """Several gunicorn workers with a local memory cache fail the system checks."""
+        locmem = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+        with override_settings(SERVER_MODE='wsgi', WEB_CONCURRENCY=4, CACHES=locmem):
+            self.assertEqual([error.id for error in checks.check_shared_cache(None)], ['polls.E001'])
+            with self.assertRaises(SystemCheckError):
+                call_command('check', stdout=StringIO(), stderr=StringIO())
+        with override_settings(SERVER_MODE='wsgi', WEB_CONCURRENCY=1, CACHES=locmem):
+            self.assertEqual(checks.check_shared_cache(None), [])
+
+    def test_database_cache_check(self):
+        """Serving with the database cache warns that each lookup is a query."""
+        database = {'default': {'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+                                'LOCATION': 'polls_cache'}}
+        with override_settings(SERVER_MODE='asgi', CACHES=database):
+            self.assertEqual([warning.id for warning in checks.check_database_cache(None)],
+                             ['polls.W001'])
+        filebased = {'default': {'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+                                 'LOCATION': '/var/tmp/ku-polls-cache'}}
+        with override_settings(SERVER_MODE='asgi', CACHES=filebased):
+            self.assertEqual(checks.check_database_cache(None), [])
+            self.assertEqual(checks.check_shared_cache(None), [])
+
+    def test_first_request_reported(self):
+        """The first request of the process logs its time since start."""
+        bootstrap._first_request_seen = False
+        with self.assertLogs('polls', 'INFO') as logs:
+            self.client.get(reverse('polls:index'))
+            self.client.get(reverse('polls:index'))
+        self.assertEqual(len([line for line in logs.output if "First request" in line]), 1)
+
+
+class InstrumentationTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        instrumentation.reset()
+
+    def test_connection_usage(self):
+        """The connection report counts requests and the connections they open."""
+        def get():
+            # A new thread has no connection yet, so the request opens one
+            try:
+                self.client.get(reverse('polls:index'))
+            finally:
+                connections.close_all()
+        thread = threading.Thread(target=get)
+        thread.start()
+        thread.join()
+        usage = instrumentation.connection_usage()
+        self.assertEqual(usage['requests'], 1)
+        self.assertEqual(usage['databases']['default']['connections_opened'], 1)
+        self.assertEqual(usage['databases']['default']['opened_per_request'], 1.0)
+
+    def test_request_log_fields(self):
+        """Each request is logged with its view, queries and timings."""
+        create_question(question_text="Past question.", days=-1)
+        with self.assertLogs('polls.requests', 'DEBUG') as logs:
+            self.client.get(reverse('polls:index'))
+        record = logs.records[0]
+        self.assertEqual((record.view, record.method, record.status), ('polls:index', 'GET', 200))
+        self.assertGreater(record.db_queries, 0)
+        self.assertGreater(record.render_ms, 0)
+        self.assertGreaterEqual(record.duration_ms, record.render_ms)
+
+    @override_settings(POLLS_SLOW_SQL_SAMPLE_RATE=1, POLLS_SLOW_REQUEST_MS=0)
+    def test_slow_request_sql_logged(self):
+        """The SQL of a sampled slow request is logged."""
+        with self.assertLogs('polls.requests', 'WARNING') as logs:
+            self.client.get(reverse('polls:index'))
+        self.assertIn("SELECT", logs.output[0])
+
+    @override_settings(POLLS_SLOW_SQL_SAMPLE_RATE=0, POLLS_SLOW_REQUEST_MS=0)
+    def test_slow_request_logged(self):
+        """A slow request is logged as a warning with LOG_REQUESTS off and its SQL unsampled."""
+        with self.assertLogs('polls.requests', 'WARNING') as logs:
+            self.client.get(reverse('polls:index'))
+        self.assertEqual([record.levelname for record in logs.records], ['WARNING'])
+        self.assertIn("Slow request GET /polls/", logs.output[0])
+        self.assertNotIn("SELECT", logs.output[0])
+
+    def test_metrics_disabled(self):
+        """The metrics endpoint is off by default."""
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, 404)
+
+    @override_settings(POLLS_METRICS_ENABLED=True)
+    def test_metrics_histograms(self):
+        """The metrics endpoint serves histograms per URL name."""
+        self.client.get(reverse('polls:index'))
+        self.client.get(reverse('polls:index'))
+        response = self.client.get(reverse('metrics'))
+        self.assertEqual(response['Content-Type'], 'text/plain; version=0.0.4; charset=utf-8')
+        self.assertContains(response, 'polls_request_duration_seconds_count{view="polls:index"} 2')
+        self.assertContains(response, 'polls_db_queries_bucket{view="polls:index",le="+Inf"} 2')
+        self.assertContains(response, '# TYPE polls_template_render_seconds histogram')
+        self.assertContains(response, 'polls_requests_total 3')
+
+
+@override_settings(POLLS_READ_REPLICAS=['replica'])
+class ReplicaRouterTests(TestCase):
+    def setUp(self):
+        self.router = routers.ReplicaRouter()
+        self.user = create_users(1)[0]
+        self.client.force_login(self.user)
+        self.question = create_question(question_text="Routed.", days=-1)
+        self.choice = create_choices(self.question, 1)[0]
+
+    def read_db_during(self, method, url, **kwargs):
+        """Make a request and return where a Question read in its view would go."""
+        seen = []
+        original = self.router.db_for_read
+
+        def record(model, **hints):
+            seen.append(original(Question))
+            return 'default'
+        with mock.patch.object(routers.ReplicaRouter, 'db_for_read', side_effect=record):
+            getattr(self.client, method)(url, **kwargs)
+        return seen
+
+    def test_reads_and_writes(self):
+        """Polls reads go to a replica; writes and other apps go to the primary."""
+        self.assertEqual(self.router.db_for_read(Question), 'replica')
+        self.assertEqual(self.router.db_for_read(User), 'default')
+        self.assertEqual(self.router.db_for_write(Vote), 'default')
+        self.assertFalse(self.router.allow_migrate('replica', 'polls'))
+
+    @override_settings(POLLS_READ_REPLICAS=[])
+    def test_without_replicas(self):
+        """Without replicas everything goes to the primary."""
+        self.assertEqual(self.router.db_for_read(Question), 'default')
+
+    def test_pinned_to_primary(self):
+        """Pinned reads go to the primary."""
+        with routers.use_primary():
+            self.assertEqual(self.router.db_for_read(Question), 'default')
+        self.assertNotEqual(self.router.db_for_read(Question), 'default')
+
+    def test_voter_sticks_to_primary(self):
+        """A vote and the voter's next requests read from the primary."""
+        detail_url = reverse('polls:detail', args=(self.question.id,))
+        self.assertNotIn('default', self.read_db_during('get', detail_url))
+        vote_url = reverse('polls:vote', args=(self.question.id,))
+        self.assertEqual(set(self.read_db_during('post', vote_url, data={'choice': self.choice.id})),
+                         {'default'})
+        self.assertIn('polls_primary_until', self.client.cookies)
+        self.assertEqual(set(self.read_db_during('get', detail_url)), {'default'})
+
+    @override_settings(POLLS_REPLICA_STICKY_SECONDS=0)
+    def test_window_ends(self):
+        """After the window, the voter reads from replicas again."""
+        self.client.post(reverse('polls:vote', args=(self.question.id,)), {'choice': self.choice.id})
+        detail_url = reverse('polls:detail', args=(self.question.id,))
+        self.assertNotIn('default', self.read_db_during('get', detail_url))
+
+    def test_recent_results_recounted_on_primary(self):
+        """Results that just changed are recounted on the primary."""
+        cache.clear()
+        results_url = reverse('polls:results', args=(self.question.id,))
+        self.assertIn('default', self.read_db_during('get', results_url))
+
+
+@override_settings(POLLS_READ_REPLICAS=['replica'])
+class ReplicaRoutingTests(TransactionTestCase):
+    """
+    Requests against the `replica` test alias, a second connection to the
+    test database, so the queries routed to it are really run on it.
+    """
+    databases = {'default', 'replica'}
+
+    def setUp(self):
+        cache.clear()
+        self.user = create_users(1)[0]
+        self.question = create_question(question_text="Routed.", days=-1)
+        self.choice = create_choices(self.question, 1)[0]
+
+    def polls_queries(self, method, url, **kwargs):
+        """Make a request and return the number of polls queries it ran on each database."""
+        with CaptureQueriesContext(connections['default']) as primary, \
+                CaptureQueriesContext(connections['replica']) as replica:
+            response = getattr(self.client, method)(url, **kwargs)
+        self.assertLess(response.status_code, 400)
+        return {alias: sum('polls_' in query['sql'] for query in captured)
+                for alias, captured in (('default', primary), ('replica', replica))}
+
+    @override_settings(POLLS_REPLICA_STICKY_SECONDS=0)
+    def test_pages_read_from_replica(self):
+        """The index and results pages read the polls from the replica."""
+        for url in (reverse('polls:index'), reverse('polls:results', args=(self.question.id,))):
+            queries = self.polls_queries('get', url)
+            self.assertGreater(queries['replica'], 0, url)
+            self.assertEqual(queries['default'], 0, url)
+
+    def test_voter_reads_from_primary(self):
+        """After a vote, the voter's reads within the sticky window use the primary."""
+        self.client.force_login(self.user)
+        detail_url = reverse('polls:detail', args=(self.question.id,))
+        queries = self.polls_queries('get', detail_url)
+        self.assertGreater(queries['replica'], 0)
+        self.assertEqual(queries['default'], 0)
+        queries = self.polls_queries('post', reverse('polls:vote', args=(self.question.id,)),
+                                     data={'choice': self.choice.id})
+        self.assertEqual(queries['replica'], 0)
+        for url in (detail_url, reverse('polls:results', args=(self.question.id,))):
+            queries = self.polls_queries('get', url)
+            self.assertGreater(queries['default'], 0, url)
+            self.assertEqual(queries['replica'], 0, url)
+        self.assertTrue(Vote.objects.using('replica').filter(user=self.user).exists())
+
+
+class SlowStream:
+    """A log sink that takes `delay` seconds per write."""
+
+    def __init__(self, delay):
+        self.delay = delay
+        self.lines = []
+
+    def write(self, text):
+        time.sleep(self.delay)
+        self.lines.append(text)
+
+    def flush(self):
+        pass
+
+
+class StructuredLoggingTests(TestCase):
+    def make_record(self, msg="%s failed to log in", args=('x',), **extra):
+        record = logging.LogRecord('polls', logging.WARNING, __file__, 0, msg, args, None)
+        record.__dict__.update(extra)
+        return record
+
+    def test_failed_vote_fields(self):
+        """A failed vote is logged with the user, question and address fields."""
+        user = create_users(1)[0]
+        self.client.force_login(user)
+        question = create_question(question_text="Logged.", days=-1)
+        with self.assertLogs('polls', 'WARNING') as logs:
+            self.client.post(reverse('polls:vote', args=(question.id,)))
+        record = logs.records[0]
+        self.assertEqual((record.event, record.user, record.question, record.choice, record.ip),
+                         ('vote_failed', user.username, question.id, None, '127.0.0.1'))
+        self.assertEqual(record.getMessage(), f"{user.username} failed to vote in Logged. from 127.0.0.1")
+
+    def test_json_format(self):
+        """Records are formatted as JSON objects with their extra fields."""
+        data = json.loads(JsonFormatter().format(self.make_record(ip='10.0.0.1', rate_limit_key='k')))
+        self.assertEqual((data['level'], data['message'], data['ip']),
+                         ('WARNING', "x failed to log in", '10.0.0.1'))
+        self.assertNotIn('rate_limit_key', data)
+
+    def test_rate_limit(self):
+        """Repeated records with the same key are suppressed, and then counted."""
+        rate_limit = RateLimitFilter(rate=2, per=0.05)
+        passed = [rate_limit.filter(self.make_record(rate_limit_key='a')) for _ in range(5)]
+        self.assertEqual(passed, [True, True, False, False, False])
+        self.assertTrue(rate_limit.filter(self.make_record(rate_limit_key='b')))
+        self.assertTrue(rate_limit.filter(self.make_record()))
+        time.sleep(0.06)
+        record = self.make_record(rate_limit_key='a')
+        self.assertTrue(rate_limit.filter(record))
+        self.assertEqual(record.suppressed, 3)
+
+    def test_slow_sink_does_not_block(self):
+        """Logging returns at once however slow the sink, which gets every record later."""
+        stream = SlowStream(0.01)
+        handler = QueueingStreamHandler(stream)
+        handler.setFormatter(JsonFormatter())
+        threads = []
+
+        class Caller:
+            def __str__(self):
+                threads.append(threading.get_ident())
+                return 'caller'
+
+        start = time.perf_counter()
+        for _ in range(20):
+            handler.handle(self.make_record(args=(Caller(),)))
+        self.assertLess(time.perf_counter() - start, 0.1)
+        handler.close()
+        self.assertEqual(len(stream.lines), 20)
+        self.assertNotIn(threading.get_ident(), threads)
+
+    def test_full_queue_drops(self):
+        """Records are dropped, and counted, instead of waiting on a full queue."""
+        stream = SlowStream(0.05)
+        handler = QueueingStreamHandler(stream, maxsize=1)
+        for _ in range(10):
+            handler.handle(self.make_record())
+        handler.close()
+        self.assertLess(len(stream.lines), 10)
+        self.assertTrue(any("Dropped" in line for line in stream.lines) or handler.dropped)
+
+
+class SeedPollsCommandTests(TestCase):
+    def test_seed(self):
+        """The seeded dataset has the requested size and valid votes."""
+        out = StringIO()
+        call_command('seed_polls', '--questions', '10', '--choices', '3', '--users', '8',
+                     '--votes', '50', '--batch-size', '7', stdout=out)
+        self.assertIn("Seeded 10 questions, 30 choices, 8 users and 50 votes", out.getvalue())
+        self.assertEqual(Vote.objects.count(), 50)
+        self.assertFalse(Vote.objects.exclude(choice__question=F('question')).exists())
+        self.assertTrue(Question.objects.can_vote().exists())
+
+    def test_votes_capped(self):
+        """There are at most as many votes as user and question pairs."""
+        out = StringIO()
+        call_command('seed_polls', '--questions', '2', '--users', '3', '--votes', '100', stdout=out)
+        self.assertEqual(Vote.objects.count(), 6)
+
+
+class PollScheduleTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.now = timezone.now()
+        self.opening = Question.objects.create(question_text="Opening.",
+                                               pub_date=self.now + datetime.timedelta(hours=1))
+        self.closing = Question.objects.create(question_text="Closing.",
+                                               pub_date=self.now - datetime.timedelta(days=1),
+                                               end_date=self.now + datetime.timedelta(hours=2))
+        self.open = create_question(question_text="Open.", days=-2)
+        self.closed = Question.objects.create(question_text="Closed.",
+                                              pub_date=self.now - datetime.timedelta(days=3),
+                                              end_date=self.now - datetime.timedelta(days=1))
+
+    def at(self, moment):
+        return mock.patch('django.utils.timezone.now', return_value=moment)
+
+    def open_polls(self):
+        """Return the ids of the polls the anonymous open index lists."""
+        response = self.client.get(reverse('polls:index'), {'status': 'open'})
+        if response.context is None:
+            # Served from the page cache
+            return {int(pk) for pk in re.findall(r'/polls/(\d+)/', response.content.decode())}
+        return {question.pk for question in response.context['latest_question_list']}
+
+    def test_same_as_model_at_boundaries(self):
+        """At and around every boundary, the open index agrees with Question.can_vote()."""
+        tick = datetime.timedelta(microseconds=1)
+        questions = list(Question.objects.all())
+        for boundary in (self.opening.pub_date, self.closing.end_date):
+            for moment in (boundary - tick, boundary, boundary + tick):
+                with self.at(moment):
+                    expected = {question.pk for question in questions if question.can_vote()}
+                    self.assertEqual(set(Question.objects.can_vote().values_list('pk', flat=True)),
+                                     expected)
+                    self.assertEqual(self.open_polls(), expected, moment)
+
+    def test_next_boundaries(self):
+        """The schedule holds the next pub_date and end_date, and changes at them."""
+        current = schedule.current_schedule()
+        self.assertEqual((current.opens_at, current.closes_at),
+                         (self.opening.pub_date, self.closing.end_date))
+        with self.at(self.opening.pub_date):
+            self.assertIsNone(schedule.current_schedule().opens_at)
+        with self.at(self.closing.end_date):
+            self.assertEqual(schedule.current_schedule().closes_at, self.closing.end_date)
+        with self.at(self.closing.end_date + datetime.timedelta(microseconds=1)):
+            self.assertIsNone(schedule.current_schedule().closes_at)
+
+    def test_lookup_without_queries(self):
+        """Between boundaries the schedule is looked up without any query."""
+        key = schedule.current_schedule().key
+        with self.assertNumQueries(0):
+            self.assertEqual(schedule.current_schedule().key, key)
+
+    def test_edit_rebuilds(self):
+        """Ending a poll early closes it on the next lookup."""
+        self.assertIn(self.open.pk, self.open_polls())
+        self.open.end_date = self.now - datetime.timedelta(minutes=1)
+        self.open.save()
+        self.assertNotIn(self.open.pk, self.open_polls())
+
+    def test_open_pages(self):
+        """Open polls with and without an end date are paged through together, newest first."""
+        for days in range(2, 8):
+            Question.objects.create(question_text=f"Ending {days}.",
+                                    pub_date=self.now - datetime.timedelta(days=days, hours=1),
+                                    end_date=self.now + datetime.timedelta(days=days))
+            create_question(question_text=f"Endless {days}.", days=-days - 0.5)
+        expected = list(Question.objects.can_vote().order_by('-pub_date', '-pk'))
+        pages, cursor = [], None
+        while True:
+            response = self.client.get(reverse('polls:index'),
+                                       {'status': 'open', **({'cursor': cursor} if cursor else {})})
+            pages.append(list(response.context['latest_question_list']))
+            cursor = response.context['next_cursor']
+            if cursor is None:
+                break
+        self.assertEqual(sum(pages, []), expected)
+        self.assertEqual([len(page) for page in pages], [5, 5, 4])
+
+    def test_vote_view_at_end_date(self):
+        """The vote view accepts votes at the end_date, and not after."""
+        choice = create_choices(self.closing, 1)[0]
+        self.client.force_login(create_users(1)[0])
+        url = reverse('polls:vote', args=(self.closing.id,))
+        with self.at(self.closing.end_date):
+            response = self.client.post(url, {'choice': choice.id})
+        self.assertRedirects(response, reverse('polls:results', args=(self.closing.id,)))
+        with self.at(self.closing.end_date + datetime.timedelta(microseconds=1)):
+            response = self.client.post(url, {'choice': choice.id})
+        self.assertRedirects(response, reverse('polls:index'))
+
+    def test_open_index_at_boundaries(self):
+        """The open polls on the index change exactly at the boundaries."""
+        url = reverse('polls:index')
+        with self.at(self.opening.pub_date):
+            response = self.client.get(url, {'status': 'open'})
+        self.assertEqual(list(response.context['latest_question_list']),
+                         [self.opening, self.closing, self.open])
+        with self.at(self.closing.end_date + datetime.timedelta(microseconds=1)):
+            response = self.client.get(url, {'status': 'open'})
+        self.assertEqual(list(response.context['latest_question_list']),
+                         [self.opening, self.open])
+
+    def test_vote_view_checks_question_row(self):
+        """A poll closed by another process, without a schedule change here, rejects votes."""
+        choice = create_choices(self.open, 1)[0]
+        self.client.force_login(create_users(1)[0])
+        schedule.current_schedule()
+        Question.objects.filter(pk=self.open.pk).update(
+            end_date=self.now - datetime.timedelta(minutes=1))
+        response = self.client.get(reverse('polls:detail', args=(self.open.id,)))
+        self.assertRedirects(response, reverse('polls:index'))
+        response = self.client.post(reverse('polls:vote', args=(self.open.id,)),
+                                    {'choice': choice.id})
+        self.assertRedirects(response, reverse('polls:index'))
+        self.assertFalse(Vote.objects.exists())
+
+    def test_bulk_writes_rebuild(self):
+        """Questions seeded or imported with bulk_create() change the schedule's key."""
+        key = schedule.current_schedule().key
+        seed_dataset(questions=2, choices=1, users=1, votes=0, closed=0)
+        self.assertNotEqual(schedule.current_schedule().key, key)
+        key = schedule.current_schedule().key
+        call_command('import_polls', 'data/polls-v4.json', stdout=StringIO())
+        self.assertNotEqual(schedule.current_schedule().key, key)
+
+    def test_refresh_command(self):
+        """The command rebuilds the schedule and reports the next change."""
+        out = StringIO()
+        call_command('refresh_poll_schedule', stdout=out)
+        self.assertIn(f"Next change: {self.opening.pub_date.isoformat()}", out.getvalue())
+
+
+class QueryBudgetTests(QueryBudgetMixin, TestCase):
+    """
+    Every view in polls/urls.py, run with a cold cache on a small and on a
+    large dataset, stays within its query budget and doesn't run more
+    queries for more data.
+    """
+
+    def setUp(self):
+        self.user = create_users(1)[0]
+        self.client.force_login(self.user)
+        voters = create_users(60, start=1)
+        self.small = create_question(question_text="Small.", days=-1)
+        create_choices(self.small, 2)
+        self.large = create_question(question_text="Large.", days=-2)
+        choices = create_choices(self.large, 30)
+        Vote.objects.bulk_create(Vote(user=voter, question=self.large, choice=choices[i % 30])
+                                 for i, voter in enumerate(voters))
+        self.many = [create_question(question_text=f"Many {i}.", days=-3 - i) for i in range(40)]
+        for question in self.many:
+            Vote.objects.create(user=self.user, choice=create_choices(question, 4)[0])
+
+    def check(self, budget, name, small_question, large_question):
+        """Check a view taking a question id on the small and the large question."""
+        self.assertQueriesIndependentOfData(
+            budget, name,
+            lambda: self.client.get(reverse(name, args=(small_question.pk,))),
+            lambda: self.client.get(reverse(name, args=(large_question.pk,))))
+
+    def test_index(self):
+        """The index page, for a user with one vote and for one with many."""
+        voter = Client()
+        voter.force_login(User.objects.get(username='voter1'))
+        self.assertQueriesIndependentOfData(
+            4, 'polls:index',
+            lambda: voter.get(reverse('polls:index')),
+            lambda: self.client.get(reverse('polls:index')))
+
+    def test_detail(self):
+        self.check(7, 'polls:detail', self.small, self.large)
+
+    def test_results(self):
+        self.check(4, 'polls:results', self.small, self.large)
+
+    def test_results_json(self):
+        self.check(4, 'polls:results_json', self.small, self.large)
+
+    def test_results_stream(self):
+        self.check(0, 'polls:results_stream', self.small, self.large)
+
+    def test_bulk_results_json(self):
+        url = reverse('polls:bulk_results_json')
+        many_ids = ','.join(str(question.pk) for question in [self.large, *self.many])
+        self.assertQueriesIndependentOfData(
+            4, 'polls:bulk_results_json',
+            lambda: self.client.get(url, {'ids': self.small.pk}),
+            lambda: self.client.get(url, {'ids': many_ids}))
+
+    def test_trend_json(self):
+        trends.rebuild_rollups()
+        self.check(5, 'polls:trend_json', self.small, self.large)
+
+    def test_vote(self):
+        small_choice = self.small.choice_set.first()
+        large_choice = self.large.choice_set.first()
+        # On PostgreSQL the vote is a single upsert, without savepoints
+        self.assertQueriesIndependentOfData(
+            8, 'polls:vote',
+            lambda: self.client.post(reverse('polls:vote', args=(self.small.pk,)),
+                                     {'choice': small_choice.pk}),
+            lambda: self.client.post(reverse('polls:vote', args=(self.large.pk,)),
+                                     {'choice': large_choice.pk}))
+
+    def test_batch_vote(self):
+        voters = list(User.objects.filter(username__startswith='voter').order_by('pk'))
+        kiosk = Client()
+        kiosk.force_login(create_kiosk())
+        choice = self.small.choice_set.first()
+
+        def upload(users):
+            return kiosk.post(reverse('polls:batch_vote'),
+                              {'votes': [{'user': user.username, 'question': self.small.pk,
+                                          'choice': choice.pk} for user in users]},
+                              content_type='application/json')
+        # Two of them load the kiosk's permissions
+        self.assertQueriesIndependentOfData(
+            10, 'polls:batch_vote', lambda: upload(voters[:1]), lambda: upload(voters[1:]))
+
+
+
+class ExplainPollsCommandTests(TestCase):
+    def test_explains_every_view(self):
+        """explain_polls prints a plan for the queries of every view."""
+        question = create_question(question_text="Past question.", days=-1)
+        create_choices(question, 2)
+        create_users(1)
+        out = StringIO()
+        call_command('explain_polls', stdout=out)
+        for view_name in ('polls:index', 'polls:detail', 'polls:results', 'polls:vote'):
+            self.assertIn(view_name, out.getvalue())
+
+    def test_no_question(self):
+        """explain_polls needs a published question."""
+        with self.assertRaises(CommandError):
+            call_command('explain_polls', stdout=StringIO())
+
+
+class ResultsJsonTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.question = create_question(question_text="Open question.", days=-1)
+        self.first, self.second = create_choices(self.question, 2)
+        self.user = create_users(1)[0]
+        Vote.objects.create(user=self.user, choice=self.first)
+        self.url = reverse('polls:results_json', args=(self.question.id,))
+
+    def test_results(self):
+        """The JSON results list every choice's tally."""
+        data = self.client.get(self.url).json()
+        self.assertEqual(data['total_votes'], 1)
+        self.assertEqual([(choice['id'], choice['votes'], choice['percentage'])
+                          for choice in data['choices']],
+                         [(self.first.id, 1, 100), (self.second.id, 0, 0)])
+
+    def test_future_question(self):
+        """Questions that aren't published yet are not found."""
+        future_question = create_question(question_text="Future question.", days=5)
+        response = self.client.get(reverse('polls:results_json', args=(future_question.id,)))
+        self.assertEqual(response.status_code, 404)
+
+    def test_conditional_get(self):
+        """A conditional GET is answered with 304 without querying the database."""
+        response = self.client.get(self.url)
+        with self.assertNumQueries(0):
+            not_modified = self.client.get(self.url, headers={'If-None-Match': response['ETag']})
+        self.assertEqual(not_modified.status_code, 304)
+        with self.assertNumQueries(0):
+            not_modified = self.client.get(
+                self.url, headers={'If-Modified-Since': response['Last-Modified']})
+        self.assertEqual(not_modified.status_code, 304)
+
+    def test_new_vote_changes_etag(self):
+        """A new vote changes the ETag, so clients get the new results."""
+        etag = self.client.get(self.url)['ETag']
+        Vote.objects.create(user=create_users(1, start=1)[0], choice=self.second)
+        response = self.client.get(self.url, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['total_votes'], 2)
+
+    def test_bulk_results(self):
+        """The bulk results count missing tallies in one query."""
+        other = create_question(question_text="Other question.", days=-1)
+        create_choices(other, 3)
+        cache.clear()
+        url = reverse('polls:bulk_results_json')
+        with self.assertNumQueries(2):
+            data = self.client.get(url, {'ids': f'{self.question.id},{other.id},999'}).json()
+        self.assertEqual([(result['id'], len(result['choices']), result['total_votes'])
+                          for result in data['results']],
+                         [(self.question.id, 2, 1), (other.id, 3, 0)])
+        self.assertEqual(data['not_found'], [999])
+
+    def test_bulk_conditional_get(self):
+        """A conditional bulk GET is answered with 304 without querying the database."""
+        url = reverse('polls:bulk_results_json')
+        params = {'ids': str(self.question.id)}
+        etag = self.client.get(url, params)['ETag']
+        with self.assertNumQueries(0):
+            response = self.client.get(url, params, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+
+    def test_bulk_invalid_ids(self):
+        """Missing or malformed ids are rejected."""
+        url = reverse('polls:bulk_results_json')
+        for ids in ('', 'a,b', ','.join(str(i) for i in range(101))):
+            with self.subTest(ids=ids):
+                self.assertEqual(self.client.get(url, {'ids': ids}).status_code, 400)
+
+
+class LiveResultsTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.question = create_question(question_text="Open question.", days=-1)
+        self.first, self.second = create_choices(self.question, 2)
+        self.users = create_users(3)
+
+    async def test_coalesced_updates(self):
+        """
+        Subscribers get the full tallies, then one update holding only
+        the changed choices, however many notifications came in.
+        """
+        broadcaster = ResultsBroadcaster(rate=50)
+        updates = broadcaster.subscribe(self.question.id)
+        self.assertEqual(await anext(updates), {self.first.id: 0, self.second.id: 0})
+        for user in self.users:
+            await sync_to_async(Vote.objects.create)(user=user, choice=self.second)
+        for _ in self.users:
+            broadcaster.notify(self.question.id)
+        self.assertEqual(await asyncio.wait_for(anext(updates), 1), {self.second.id: 3})
+        with self.assertRaises(asyncio.TimeoutError):
+            await asyncio.wait_for(anext(updates), 0.1)
+        await updates.aclose()
+        self.assertEqual(broadcaster._tickers, {})
+
+    async def test_concurrent_first_subscribers(self):
+        """Subscribers arriving together share one ticker, stopped with the last of them."""
+        broadcaster = ResultsBroadcaster(rate=50)
+        first = broadcaster.subscribe(self.question.id)
+        second = broadcaster.subscribe(self.question.id)
+        snapshots = await asyncio.gather(anext(first), anext(second))
+        self.assertEqual(snapshots, [{self.first.id: 0, self.second.id: 0}] * 2)
+
+        def tickers():
+            return [task for task in asyncio.all_tasks() if not task.done()
+                    and task.get_coro().__qualname__ == 'ResultsBroadcaster._tick']
+        self.assertEqual(len(tickers()), 1)
+        await first.aclose()
+        await second.aclose()
+        await asyncio.sleep(0)
+        self.assertEqual(tickers(), [])
+
+    async def test_cache_polling(self):
+        """The cache polling broadcaster sees votes without being notified."""
+        broadcaster = CachePollingBroadcaster(rate=50)
+        updates = broadcaster.subscribe(self.question.id)
+        await anext(updates)
+        await asyncio.sleep(0.05)
+        await sync_to_async(Vote.objects.create)(user=self.users[0], choice=self.first)
+        self.assertEqual(await asyncio.wait_for(anext(updates), 1), {self.first.id: 1})
+        await updates.aclose()
+
+    async def test_heartbeat(self):
+        """An idle subscriber gets None as a heartbeat."""
+        broadcaster = ResultsBroadcaster(rate=50)
+        updates = broadcaster.subscribe(self.question.id, heartbeat=0.01)
+        await anext(updates)
+        self.assertIsNone(await anext(updates))
+        await updates.aclose()
+
+    async def test_stream(self):
+        """The stream starts with the full tallies as a snapshot event."""
+        url = reverse('polls:results_stream', args=(self.question.id,))
+        response = await self.async_client.get(url)
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        events = aiter(response.streaming_content)
+        self.assertTrue((await anext(events)).startswith(b'event: snapshot\ndata: '))
+        await events.aclose()
+
+    async def test_stream_future_question(self):
+        """Questions that aren't published yet have no stream."""
+        future_question = await sync_to_async(create_question)(
+            question_text="Future question.", days=5)
+        url = reverse('polls:results_stream', args=(future_question.id,))
+        response = await self.async_client.get(url)
+        self.assertEqual(response.status_code, 404)
+
+    def test_stream_under_wsgi(self):
+        """Under WSGI the stream tells the browser to stop connecting."""
+        url = reverse('polls:results_stream', args=(self.question.id,))
+        self.assertEqual(self.client.get(url).status_code, 204)
+
+
+@override_settings(ROOT_URLCONF='mysite.async_urls')
+class AsyncViewTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.question = create_question(question_text="Open question.", days=-1)
+        self.first, self.second = create_choices(self.question, 2)
+        self.user = create_users(1)[0]
+
+    async def test_index(self):
+        """The async index lists the questions and marks voted ones."""
+        await sync_to_async(Vote.objects.create)(user=self.user, choice=self.first)
+        await self.async_client.aforce_login(self.user)
+        response = await self.async_client.get(reverse('polls:index'))
+        self.assertEqual(response.context['latest_question_list'], [self.question])
+        self.assertContains(response, "Voted")
+        self.assertContains(response, f"Welcome back, {self.user.username}")
+
+    async def test_detail(self):
+        """The async detail page preselects the user's vote."""
+        await sync_to_async(Vote.objects.create)(user=self.user, choice=self.second)
+        await self.async_client.aforce_login(self.user)
+        response = await self.async_client.get(reverse('polls:detail', args=(self.question.id,)))
+        self.assertEqual(response.context['last_vote'], self.second.id)
+        self.assertContains(response, self.first.choice_text)
+
+    async def test_detail_future_question(self):
+        """The async detail page redirects away from unpublished questions."""
+        future_question = await sync_to_async(create_question)(
+            question_text="Future question.", days=5)
+        response = await self.async_client.get(
+            reverse('polls:detail', args=(future_question.id,)), follow=True)
+        self.assertContains(response, "This question is not available.")
+
+    async def test_results(self):
+        """The async results page shows the tallies."""
+        await sync_to_async(Vote.objects.create)(user=self.user, choice=self.first)
+        response = await self.async_client.get(reverse('polls:results', args=(self.question.id,)))
+        self.assertEqual(response.context['total_votes'], 1)
+        self.assertContains(response, '<td class="vote_count">100.0%</td>', html=True)
+
+    async def test_results_page_cache(self):
+        """The async results page is cached for anonymous visitors only."""
+        url = reverse('polls:results', args=(self.question.id,))
+        await self.async_client.get(url)
+        response = await self.async_client.get(url)
+        self.assertIsNone(response.context)
+        self.assertIn('public', response['Cache-Control'])
+        await self.async_client.aforce_login(self.user)
+        response = await self.async_client.get(url)
+        self.assertContains(response, f"Welcome back, {self.user.username}")
+
+    async def test_vote_requires_login(self):
+        """Anonymous votes are redirected to the login page."""
+        response = await self.async_client.post(reverse('polls:vote', args=(self.question.id,)),
+                                                {'choice': self.first.id})
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(response.url.startswith(reverse('login')))
+
+    async def test_vote(self):
+        """Async votes are recorded, changed and confirmed with a message."""
+        await self.async_client.aforce_login(self.user)
+        url = reverse('polls:vote', args=(self.question.id,))
+        response = await self.async_client.post(url, {'choice': self.first.id}, follow=True)
+        self.assertEqual([str(message) for message in response.context['messages']],
+                         [f"You voted for '{self.first.choice_text}'"])
+        response = await self.async_client.post(url, {'choice': self.second.id}, follow=True)
+        self.assertEqual([str(message) for message in response.context['messages']],
+                         [f"Your vote was changed to '{self.second.choice_text}'"])
+        self.assertEqual(response.context['total_votes'], 1)
+        vote = await Vote.objects.aget(user=self.user)
+        self.assertEqual(vote.choice_id, self.second.id)
+
+    async def test_vote_without_choice(self):
+        """An async vote without a choice redisplays the form."""
+        await self.async_client.aforce_login(self.user)
+        response = await self.async_client.post(reverse('polls:vote', args=(self.question.id,)))
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, self.first.choice_text)
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+                                       'LOCATION': 'polls_cache'}})
+class AsyncViewDatabaseCacheTests(AsyncViewTests):
+    """The async views again, with a cache whose lookups are database queries."""
+
+    @classmethod
+    def setUpTestData(cls):
+        call_command('createcachetable', verbosity=0)
@@ -0,0 +1,349 @@
+"""Streaming import and export of polls data.
+
+Rows are read and written one at a time in three formats:
+
+- ``json``: Django fixtures, a JSON array of {"model", "pk", "fields"} objects
+- ``jsonl``: one such object per line
+- ``csv``: one model per file, with a ``pk`` column and a column per field
+
+Imports are upserts on the primary key, written with bulk_create() in
+batches that each commit on their own, so a failed import can simply be
+run again. A vote whose user already has another vote on its question,
+in the database or later in the file, is skipped and reported as a
+conflict instead of failing the import on the one vote per user and
+question constraint. Exports read each model in primary key order, one batch at a
+time. Memory use depends on the batch size, not on the size of the data.
+
+The ``votes`` field of choices in old fixtures (polls-v1.json) held
+anonymous vote counts; it is imported into the persisted counters, which
+are recounted from the Vote table instead when counters are enabled and
+votes are imported.
+"""
+import csv
+import json
+import logging
+
+from django.apps import apps
+from django.core.exceptions import FieldDoesNotExist
+from django.core.management.color import no_style
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connection, transaction
+from django.db.models import OuterRef, Subquery, Sum
+
+from . import counters
+from .models import Choice, Question, Vote
+from .results import invalidate_results
+from .schedule import invalidate_schedule
+from .voting import forget_user_votes
+
+logger = logging.getLogger('polls')
+
+FORMATS = ('json', 'jsonl', 'csv')
+
+# The models exported by default, in an order that can be imported back.
+EXPORT_MODELS = ('auth.user', 'polls.question', 'polls.choice', 'polls.vote')
+
+# Fields of older fixtures, mapped to the fields that replaced them.
+LEGACY_FIELDS = {
+    'polls.choice': {'votes': 'vote_count'},
+}
+
+
+class TransferError(Exception):
+    """Raised for data that can't be imported."""
+
+
+def guess_format(path):
+    """Return the format of a file from its extension."""
+    for fmt in FORMATS:
+        if str(path).endswith(f'.{fmt}'):
+            return fmt
+    raise TransferError(f"Can't tell the format of {path}; use one of {', '.join(FORMATS)}.")
+
+
+def _read_json_array(stream, chunk_size=1 << 16):
+    """Yield the elements of a JSON array in `stream`, reading it in chunks."""
+    decoder = json.JSONDecoder()
+    buffer, pos = '', 0
+
+    def read_more():
+        nonlocal buffer, pos
+        chunk = stream.read(chunk_size)
+        buffer, pos = buffer[pos:] + chunk, 0
+        return bool(chunk)
+
+    started = False
+    while True:
+        while pos == len(buffer) or buffer[pos] in ' \t\r\n,':
+            if pos < len(buffer):
+                pos += 1
+            elif not read_more():
+                raise TransferError("Unexpected end of JSON file.")
+        if not started:
+            if buffer[pos] != '[':
+                raise TransferError("A JSON fixture must be an array.")
+            started = True
+            pos += 1
+        elif buffer[pos] == ']':
+            return
+        else:
+            while True:
+                try:
+                    element, pos = decoder.raw_decode(buffer, pos)
+                    break
+                except json.JSONDecodeError:
+                    if not read_more():
+                        raise TransferError(f"Invalid JSON near {buffer[pos:pos + 80]!r}.")
+            yield element
+
+
+def read_rows(stream, fmt, model=None):
+    """
+    Yield (model_label, pk, fields) for each row in `stream`. CSV files hold
+    the rows of a single `model`.
+    """
+    if fmt == 'json':
+        for obj in _read_json_array(stream):
+            yield obj['model'].lower(), obj.get('pk'), obj['fields']
+    elif fmt == 'jsonl':
+        for line in stream:
+            if line.strip():
+                obj = json.loads(line)
+                yield obj['model'].lower(), obj.get('pk'), obj['fields']
+    elif fmt == 'csv':
+        if model is None:
+            raise TransferError("Importing CSV needs the model of its rows.")
+        for row in csv.DictReader(stream):
+            pk = row.pop('pk') or None
+            yield model.lower(), pk, row
+    else:
+        raise TransferError(f"Unknown format {fmt!r}.")
+
+
+def _field_values(model, label, fields, from_csv):
+    """Convert a row's fields to {attname: value} and {m2m field: [pks]}."""
+    legacy = LEGACY_FIELDS.get(label, {})
+    values, m2m = {}, {}
+    for name, value in fields.items():
+        name = legacy.get(name, name)
+        try:
+            field = model._meta.get_field(name)
+        except FieldDoesNotExist:
+            raise TransferError(f"{label} has no field {name!r}.")
+        if from_csv and value == '' and field.null:
+            value = None
+        if field.many_to_many:
+            m2m[field] = value
+        elif field.is_relation:
+            values[field.attname] = None if value is None else field.target_field.to_python(value)
+        else:
+            values[field.attname] = field.to_python(value)
+    return values, m2m
+
+
+class Importer:
+    """Upserts rows into the database in batches of `batch_size`."""
+
+    def __init__(self, batch_size=1000):
+        self.batch_size = batch_size
+        self.batch_key = None
+        self.batch = []
+        self.m2m = {}
+        self.counts = {}
+        # {model_label: rows skipped as conflicts}
+        self.conflicts = {}
+        self.question_ids = set()
+        self.legacy_question_ids = set()
+
+    def add(self, label, pk, fields, from_csv=False):
+        """Queue a row, writing the queued rows once a batch is full."""
+        try:
+            model = apps.get_model(label)
+        except LookupError:
+            raise TransferError(f"Unknown model {label!r}.")
+        values, m2m = _field_values(model, label, fields, from_csv)
+        # A batch holds rows of one model with the same fields, so that
+        # fields missing from the rows keep their values in the database.
+        batch_key = (model, frozenset(values))
+        if batch_key != self.batch_key:
+            self.flush()
+            self.batch_key = batch_key
+        instance = model(pk=model._meta.pk.to_python(pk), **values)
+        self.batch.append(instance)
+        for field, pks in m2m.items():
+            self.m2m.setdefault(field, []).append((instance, pks))
+        if label in LEGACY_FIELDS and set(fields) & set(LEGACY_FIELDS[label]):
+            self.legacy_question_ids.add(instance.question_id)
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """Write the queued rows in one transaction."""
+        if not self.batch:
+            return
+        model, attnames = self.batch_key
+        if model is Vote:
+            self._fill_vote_questions()
+            self._skip_vote_conflicts()
+            attnames |= {'question_id'}
+        fields = [field.name for field in model._meta.concrete_fields
+                  if not field.primary_key and field.attname in attnames]
+        with transaction.atomic():
+            if fields:
+                model.objects.bulk_create(self.batch, update_conflicts=True,
+                                          unique_fields=['pk'], update_fields=fields)
+            else:
+                model.objects.bulk_create(self.batch, ignore_conflicts=True)
+            for field, links in self.m2m.items():
+                through = field.remote_field.through
+                source = f'{field.m2m_field_name()}_id'
+                target = f'{field.m2m_reverse_field_name()}_id'
+                through.objects.filter(**{f'{source}__in': [instance.pk for instance, _ in links]}).delete()
+                through.objects.bulk_create([through(**{source: instance.pk, target: pk})
+                                             for instance, pks in links for pk in pks])
+        if model is Choice or model is Vote:
+            self.question_ids.update(instance.question_id for instance in self.batch)
+        if model is Vote:
+            for user_id in {vote.user_id for vote in self.batch}:
+                forget_user_votes(user_id)
+        label = model._meta.label_lower
+        self.counts[label] = self.counts.get(label, 0) + len(self.batch)
+        self.batch, self.m2m = [], {}
+
+    def _fill_vote_questions(self):
+        """Fill in the question of votes from fixtures older than Vote.question."""
+        missing = {vote.choice_id for vote in self.batch if vote.question_id is None}
+        if missing:
+            questions = dict(Choice.objects.filter(pk__in=missing).values_list('pk', 'question_id'))
+            for vote in self.batch:
+                if vote.question_id is None:
+                    vote.question_id = questions.get(vote.choice_id)
+
+    def _skip_vote_conflicts(self):
+        """
+        Leave out the votes of the batch whose user has another vote, under
+        another primary key, on the same question: in the database, or later
+        in the batch, whose vote is the one kept.
+        """
+        last = {(vote.user_id, vote.question_id): vote for vote in self.batch}
+        existing = {(user_id, question_id): pk for pk, user_id, question_id in Vote.objects.filter(
+            user_id__in={user_id for user_id, _ in last},
+            question_id__in={question_id for _, question_id in last},
+        ).values_list('pk', 'user_id', 'question_id')}
+        kept = []
+        for vote in self.batch:
+            key = (vote.user_id, vote.question_id)
+            if last[key] is vote and existing.get(key, vote.pk) == vote.pk:
+                kept.append(vote)
+                continue
+            logger.warning("Skipped vote %s of user %s on question %s; the user has another vote "
+                           "on the question", vote.pk, vote.user_id, vote.question_id,
+                           extra={'event': 'import_conflict', 'vote': vote.pk,
+                                  'user_id': vote.user_id, 'question': vote.question_id})
+        skipped = len(self.batch) - len(kept)
+        if skipped:
+            self.conflicts['polls.vote'] = self.conflicts.get('polls.vote', 0) + skipped
+        self.batch = kept
+
+    def finish(self):
+        """
+        Write the last batch, then fix sequences, counters and caches for
+        the imported rows. Returns a {model_label: rows} dict.
+        """
+        self.flush()
+        models = [apps.get_model(label) for label in self.counts]
+        with connection.cursor() as cursor:
+            for sql in connection.ops.sequence_reset_sql(no_style(), models):
+                cursor.execute(sql)
+        if counters.counters_enabled() and 'polls.vote' in self.counts:
+            counters.reconcile_counters()
+        elif self.legacy_question_ids:
+            Question.objects.filter(pk__in=self.legacy_question_ids).update(total_votes=Subquery(
+                Choice.objects.filter(question=OuterRef('pk')).values('question')
+                .annotate(total=Sum('vote_count')).values('total')))
+        for question_id in self.question_ids:
+            invalidate_results(question_id)
+        # bulk_create() sends no signals, so the schedule isn't invalidated otherwise
+        if 'polls.question' in self.counts:
+            invalidate_schedule()
+        return self.counts
+
+
+def export_rows(labels, batch_size=1000):
+    """Yield (model_label, pk, fields) for every row of the given models, in pk order."""
+    for label in labels:
+        try:
+            model = apps.get_model(label)
+        except LookupError:
+            raise TransferError(f"Unknown model {label!r}.")
+        label = model._meta.label_lower
+        fields = [field for field in model._meta.concrete_fields if not field.primary_key]
+        m2m_fields = list(model._meta.many_to_many)
+        names = [field.attname for field in fields]
+        last_pk = None
+        while True:
+            queryset = model._base_manager.order_by('pk')
+            if last_pk is not None:
+                queryset = queryset.filter(pk__gt=last_pk)
+            rows = list(queryset.values_list('pk', *names)[:batch_size])
+            if not rows:
+                break
+            related = {}
+            for field in m2m_fields:
+                through = field.remote_field.through
+                source = f'{field.m2m_field_name()}_id'
+                target = f'{field.m2m_reverse_field_name()}_id'
+                links = {}
+                for source_pk, target_pk in (through.objects
+                                             .filter(**{f'{source}__in': [row[0] for row in rows]})
+                                             .order_by(source, target)
+                                             .values_list(source, target)):
+                    links.setdefault(source_pk, []).append(target_pk)
+                related[field.name] = links
+            for pk, *values in rows:
+                row = {field.name: value for field, value in zip(fields, values)}
+                for name, links in related.items():
+                    row[name] = links.get(pk, [])
+                yield label, pk, row
+            last_pk = rows[-1][0]
+
+
+def write_json(rows, stream):
+    """Write rows as a Django fixture, one object per element."""
+    stream.write('[')
+    first = True
+    for label, pk, fields in rows:
+        stream.write('\n' if first else ',\n')
+        json.dump({'model': label, 'pk': pk, 'fields': fields}, stream, cls=DjangoJSONEncoder)
+        first = False
+    stream.write('\n]\n')
+
+
+def write_jsonl(rows, stream):
+    """Write rows as one fixture object per line."""
+    for label, pk, fields in rows:
+        json.dump({'model': label, 'pk': pk, 'fields': fields}, stream, cls=DjangoJSONEncoder)
+        stream.write('\n')
+
+
+def write_csv(rows, stream):
+    """Write the rows of a single model as CSV, leaving out many-to-many fields."""
+    writer = None
+    for label, pk, fields in rows:
+        if writer is None:
+            model = apps.get_model(label)
+            names = [field.name for field in model._meta.concrete_fields if not field.primary_key]
+            writer = csv.DictWriter(stream, ['pk', *names], extrasaction='ignore')
+            writer.writeheader()
+        writer.writerow({'pk': pk, **{name: _csv_value(value) for name, value in fields.items()}})
+
+
+def _csv_value(value):
+    if value is None:
+        return ''
+    if hasattr(value, 'isoformat'):
+        return DjangoJSONEncoder().default(value)
+    return value
+
+
+WRITERS = {'json': write_json, 'jsonl': write_jsonl, 'csv': write_csv}
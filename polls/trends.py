@@ -0,0 +1,151 @@
+"""Vote trends: net votes per choice in minute and hour buckets.
+
+Every vote cast through polls.voting adds to the minute rollup of the
+choices it moved between, in the transaction that records the vote. The
+compact_vote_rollups command folds minute rollups older than
+POLLS_TREND_MINUTE_RETENTION hours into hour rollups, so the table grows
+with time and the number of choices, not with the number of votes.
+Trends are read from the rollups alone. They show how votes moved, so
+votes deleted afterwards, for example with their user, stay in them.
+
+The rollups are opt-in through the POLLS_VOTE_TRENDS setting: they take a
+vote off the single-statement upsert, and all votes on a choice within a
+minute update the same rollup row.
+"""
+import datetime
+from collections import Counter
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Sum
+from django.db.models.functions import Trunc
+from django.utils import timezone
+
+from .counters import add_to_counts
+from .models import Vote, VoteRollup
+
+RESOLUTIONS = {'minute': VoteRollup.MINUTE, 'hour': VoteRollup.HOUR}
+
+SPARK_BARS = '▁▂▃▄▅▆▇█'
+
+
+def trends_enabled():
+    """Return True if the vote rollups are maintained."""
+    return settings.POLLS_VOTE_TRENDS
+
+
+def bucket_start(when, resolution):
+    """Return the start of the bucket of `resolution` seconds holding `when`."""
+    if resolution == VoteRollup.HOUR:
+        return when.replace(minute=0, second=0, microsecond=0)
+    return when.replace(second=0, microsecond=0)
+
+
+def record_vote_changes(changes, when=None):
+    """
+    Add vote changes, given as (question_id, old_choice_id, new_choice_id)
+    tuples like counters.record_vote_changes(), to the minute rollups of
+    `when` (now by default). Call this inside the transaction that changes
+    the votes.
+    """
+    if not trends_enabled():
+        return
+    bucket = bucket_start(when or timezone.now(), VoteRollup.MINUTE)
+    deltas = Counter()
+    for question_id, old_choice_id, new_choice_id in changes:
+        if old_choice_id == new_choice_id:
+            continue
+        if old_choice_id is not None:
+            deltas[(question_id, old_choice_id, VoteRollup.MINUTE, bucket)] -= 1
+        if new_choice_id is not None:
+            deltas[(question_id, new_choice_id, VoteRollup.MINUTE, bucket)] += 1
+    add_to_rollups(deltas)
+
+
+def add_to_rollups(deltas):
+    """
+    Add the {(question_id, choice_id, resolution, bucket): delta} deltas to
+    the rollups, creating the missing ones.
+    """
+    add_to_counts(VoteRollup, ('question_id', 'choice_id', 'resolution', 'bucket'),
+                  ('choice_id', 'resolution', 'bucket'), 'delta', deltas)
+
+
+def _hour_totals(rollups):
+    return {(row['question_id'], row['choice_id'], VoteRollup.HOUR, row['hour']): row['total']
+            for row in rollups.annotate(hour=Trunc('bucket', 'hour', tzinfo=datetime.timezone.utc))
+            .values('question_id', 'choice_id', 'hour').annotate(total=Sum('delta'))}
+
+
+def compact_rollups(before=None):
+    """
+    Fold the minute rollups of buckets before `before` (by default
+    POLLS_TREND_MINUTE_RETENTION hours ago) into hour rollups. Returns the
+    number of minute rollups folded.
+    """
+    if before is None:
+        before = timezone.now() - datetime.timedelta(hours=settings.POLLS_TREND_MINUTE_RETENTION)
+    # Votes only add to the current minute, so these rollups don't change
+    minutes = VoteRollup.objects.filter(resolution=VoteRollup.MINUTE,
+                                        bucket__lt=bucket_start(before, VoteRollup.MINUTE))
+    with transaction.atomic():
+        add_to_rollups(_hour_totals(minutes))
+        folded, _ = minutes.delete()
+    return folded
+
+
+def rebuild_rollups():
+    """
+    Replace all rollups with one counting each current vote when it was
+    last changed, for votes that were imported or seeded rather than
+    cast. Returns the number of rollups created.
+    """
+    retention = timezone.now() - datetime.timedelta(hours=settings.POLLS_TREND_MINUTE_RETENTION)
+    cutoff = bucket_start(retention, VoteRollup.HOUR)
+    votes = Vote.objects.values('question_id', 'choice_id')
+    with transaction.atomic():
+        VoteRollup.objects.all().delete()
+        deltas = {
+            (row['question_id'], row['choice_id'], VoteRollup.MINUTE, row['minute']): row['total']
+            for row in votes.filter(changed_at__gte=cutoff)
+            .annotate(minute=Trunc('changed_at', 'minute', tzinfo=datetime.timezone.utc))
+            .values('question_id', 'choice_id', 'minute').annotate(total=Count('pk'))}
+        deltas.update(
+            ((row['question_id'], row['choice_id'], VoteRollup.HOUR, row['hour']), row['total'])
+            for row in votes.filter(changed_at__lt=cutoff)
+            .annotate(hour=Trunc('changed_at', 'hour', tzinfo=datetime.timezone.utc))
+            .values('question_id', 'choice_id', 'hour').annotate(total=Count('pk')))
+        add_to_rollups(deltas)
+    return len(deltas)
+
+
+def sparkline(values):
+    """Draw a list of numbers as a string of bar characters."""
+    if not values:
+        return ''
+    low, high = min(values), max(values)
+    if high == low:
+        return SPARK_BARS[0] * len(values)
+    scale = (len(SPARK_BARS) - 1) / (high - low)
+    return ''.join(SPARK_BARS[round((value - low) * scale)] for value in values)
+
+
+def get_trend(question, resolution, buckets, now=None):
+    """
+    Return the net votes of each choice of `question` in the last `buckets`
+    buckets of `resolution` seconds, the current bucket included, read from
+    the rollups in one query. Minute rollups not compacted yet are added to
+    their hour.
+    """
+    now = now or timezone.now()
+    last = bucket_start(now, resolution)
+    starts = [last - datetime.timedelta(seconds=resolution * i) for i in range(buckets - 1, -1, -1)]
+    rollups = VoteRollup.objects.filter(question=question, bucket__gte=starts[0],
+                                        resolution__lte=resolution)
+    positions = {start: i for i, start in enumerate(starts)}
+    votes = {}
+    for choice_id, bucket, delta in rollups.values_list('choice_id', 'bucket', 'delta'):
+        position = positions.get(bucket_start(bucket, resolution))
+        if position is not None:
+            votes.setdefault(choice_id, [0] * buckets)[position] += delta
+    return {'buckets': starts, 'votes': votes}
@@ -1,10 +1,19 @@
 from django.urls import path
 from . import views
+from .pages import cache_anonymous_page, index_version, results_page_version
 
 app_name = 'polls'
 urlpatterns = [
-    path('', views.IndexView.as_view(), name='index'),
+    path('', cache_anonymous_page(index_version, params=views.IndexView.query_params)(
+        views.IndexView.as_view()), name='index'),
     path('<int:pk>/', views.DetailView.as_view(), name='detail'),
-    path('<int:pk>/results/', views.ResultsView.as_view(), name='results'),
+    path('<int:pk>/results/',
+         cache_anonymous_page(results_page_version)(views.ResultsView.as_view()),
+         name='results'),
+    path('<int:pk>/results.json', views.results_json, name='results_json'),
+    path('<int:pk>/results/stream/', views.results_stream, name='results_stream'),
+    path('<int:pk>/trend.json', views.trend_json, name='trend_json'),
+    path('results.json', views.bulk_results_json, name='bulk_results_json'),
+    path('votes/', views.batch_vote, name='batch_vote'),
     path('<int:question_id>/vote/', views.vote, name='vote'),
 ]
@@ -1,34 +1,138 @@
 """View modules for handling polling functionality in KU Polls."""
-from django.http import Http404, HttpResponseRedirect
+import base64
+import datetime
+import hashlib
+import json
+
+from django.conf import settings
+from django.db.models import Q
+from django.db import transaction
+from django.core.handlers.asgi import ASGIRequest
+from django.http import Http404, HttpResponse, HttpResponseRedirect, JsonResponse, \
+    StreamingHttpResponse
 from django.shortcuts import get_object_or_404, render
 from django.urls import reverse
 from django.views import generic
 from django.utils import timezone
+from django.utils.cache import patch_cache_control
+from django.views.decorators.http import condition, require_POST, require_safe
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required
+from django.contrib.auth.models import User
 from django.contrib.auth.signals import user_logged_in, \
     user_logged_out, user_login_failed
 from django.dispatch import receiver
 import logging
 
-from .models import Choice, Question, Vote
+from .broadcast import get_broadcaster, results_events
+from .ingest import discard_pending, enqueue_vote, queue_accepting
+from .instrumentation import render_metrics
+from .models import Choice, Question
+from .results import get_results_table, get_tallies, get_tallies_many, invalidate_results, \
+    results_version, results_versions
+from .trends import RESOLUTIONS, get_trend, sparkline
+from .voting import cast_vote, cast_votes, forget_user_votes_many, get_user_votes, remember_vote
+
+
+def encode_cursor(question):
+    """Return an opaque index page cursor pointing after `question`."""
+    position = json.dumps([question.pub_date.isoformat(), question.pk])
+    return base64.urlsafe_b64encode(position.encode()).decode()
+
+
+def decode_cursor(cursor):
+    """Return the (pub_date, id) position encoded in an index page cursor."""
+    try:
+        pub_date, pk = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return datetime.datetime.fromisoformat(pub_date), int(pk)
+    except (ValueError, TypeError):
+        raise Http404("Invalid cursor.")
 
 
 class IndexView(generic.ListView):
     """
-    View class that displays a list of the latest published questions.
+    View class that displays a page of the latest published questions.
+
+    Pages are found by seeking past the (pub_date, id) of the last question
+    of the previous page, passed as an opaque `cursor` parameter, so deep
+    pages cost the same as the first. The `status` parameter limits the
+    list to `open` or `closed` polls; a page of open polls is merged from
+    a page of those without an end date and a page of those with one,
+    each read along its own index.
     """
     template_name = 'polls/index.html'
     context_object_name = 'latest_question_list'
+    # The query parameters the page depends on, for the page cache
+    query_params = ('status', 'cursor')
 
     def get_queryset(self):
         """
-        Return the last five published questions (not including those set to be
-        published in the future).
+        Return the published questions of the requested page (not including
+        those set to be published in the future), newest first, plus the
+        first question of the next page.
+        """
+        now = timezone.now()
+        questions = Question.objects.filter(pub_date__lte=now)
+        self.status = self.request.GET.get('status', '')
+        cursor = self.request.GET.get('cursor')
+        position = decode_cursor(cursor) if cursor else None
+        page_size = settings.POLLS_INDEX_PAGE_SIZE
+        if self.status == 'open':
+            # Along question_no_end_pub_date_idx and question_end_pub_date_idx
+            without_end = questions.filter(end_date__isnull=True)
+            ending = questions.filter(end_date__gte=now)
+            questions = Question.objects.filter(
+                Q(pk__in=self.page(without_end, position, page_size).values('pk'))
+                | Q(pk__in=self.page(ending, position, page_size).values('pk')))
+            position = None
+        elif self.status == 'closed':
+            questions = questions.filter(end_date__lt=now)
+        else:
+            self.status = ''
+        return self.page(questions, position, page_size)
+
+    @staticmethod
+    def page(questions, position, page_size):
         """
-        return Question.objects.filter(
-            pub_date__lte=timezone.now()
-        ).order_by('-pub_date')[:5]
+        Return the `questions` after the (pub_date, id) `position`, newest
+        first, up to a page plus one.
+        """
+        if position:
+            pub_date, pk = position
+            questions = questions.filter(pub_date__lte=pub_date).filter(
+                Q(pub_date__lt=pub_date) | Q(pk__lt=pk))
+        return questions.order_by('-pub_date', '-pk')[:page_size + 1]
+
+    def get_page_context(self, questions, user_votes):
+        """
+        Return the page context for the fetched `questions`: the list
+        trimmed to one page and the cursor of the next page. Mark the
+        questions found in the `user_votes` map as voted.
+        """
+        page_size = settings.POLLS_INDEX_PAGE_SIZE
+        has_next = len(questions) > page_size
+        questions = questions[:page_size]
+        for question in questions:
+            question.voted = question.pk in user_votes
+        return {
+            'latest_question_list': questions,
+            'object_list': questions,
+            'next_cursor': encode_cursor(questions[-1]) if has_next else None,
+            'status': self.status,
+        }
+
+    def get_context_data(self, **kwargs):
+        """
+        Trim the list to one page and add the cursor of the next page.
+        Mark the questions the user already voted on, using the user's
+        cached vote map instead of a query per question.
+        """
+        context = super().get_context_data(**kwargs)
+        user_votes = {}
+        if self.request.user.is_authenticated:
+            user_votes = get_user_votes(self.request.user)
+        context.update(self.get_page_context(list(context['latest_question_list']), user_votes))
+        return context
 
 
 class DetailView(generic.DetailView):
@@ -42,7 +146,7 @@ class DetailView(generic.DetailView):
         """
         Excludes any questions that aren't published yet.
         """
-        return Question.objects.filter(pub_date__lte=timezone.now())
+        return Question.objects.is_published()
 
     def get(self, request, *args, **kwargs):
         """
@@ -57,6 +161,8 @@ class DetailView(generic.DetailView):
             messages.error(request, "This question is not available.")
             return HttpResponseRedirect(reverse('polls:index'))
 
+        # The dates are checked on the row itself, so a poll closed or
+        # reopened by another process is seen at once
         if not question.can_vote():
             messages.error(request, "Voting on this question is currently not allowed.")
             return HttpResponseRedirect(reverse('polls:index'))
@@ -64,11 +170,12 @@ class DetailView(generic.DetailView):
         this_user = request.user
         last_vote = None
         if this_user.is_authenticated:
-            try:
-                last_vote = Vote.objects.get(user=this_user, choice__question=question).choice.id
-            except Vote.DoesNotExist:
-                last_vote = None
-        return render(request, self.template_name, {'question': question, 'last_vote': last_vote})
+            last_vote = get_user_votes(this_user).get(question.id)
+        return render(request, self.template_name, {
+            'question': question,
+            'choices': question.choice_set.all(),
+            'last_vote': last_vote,
+        })
 
 
 class ResultsView(generic.DetailView):
@@ -82,9 +189,175 @@ class ResultsView(generic.DetailView):
         """
         Excludes any questions that aren't published yet.
         """
-        published_question_list = [q.pk for q in Question.objects.all()
-                                   if q.is_published()]
-        return Question.objects.filter(pk__in=published_question_list)
+        return Question.objects.is_published()
+
+    def get_context_data(self, **kwargs):
+        """
+        Add the vote tally of every choice, the total number of votes,
+        each choice's share of the total and the rendered results table,
+        all read from the results cache.
+        """
+        context = super().get_context_data(**kwargs)
+        context.update(get_tallies(self.object))
+        context['results_table'] = get_results_table(self.object)
+        return context
+
+
+# Most questions the bulk results API reports on in one request
+MAX_BULK_RESULTS = 100
+
+
+def _version_time(version):
+    """Return the time a results version was stamped at."""
+    return datetime.datetime.fromtimestamp(version / 1e9, tz=datetime.timezone.utc)
+
+
+def _bulk_result_ids(request):
+    """Return the question ids asked for by the `ids` parameter, or None if invalid."""
+    try:
+        ids = sorted({int(pk) for pk in request.GET.get('ids', '').split(',') if pk.strip()})
+    except ValueError:
+        return None
+    if not ids or len(ids) > MAX_BULK_RESULTS:
+        return None
+    return ids
+
+
+def _results_etag(versions):
+    return hashlib.md5(repr(sorted(versions.items())).encode()).hexdigest()
+
+
+def _results_data(question, tallies):
+    """Return the JSON-ready results of a question."""
+    return {
+        'id': question.pk,
+        'question_text': question.question_text,
+        'pub_date': question.pub_date,
+        'end_date': question.end_date,
+        'can_vote': question.can_vote(),
+        'total_votes': tallies['total_votes'],
+        'choices': [{
+            'id': choice.pk,
+            'choice_text': choice.choice_text,
+            'votes': choice.num_votes,
+            'percentage': round(choice.percentage, 2),
+        } for choice in tallies['choices']],
+    }
+
+
+def _json_results_response(data):
+    response = JsonResponse(data)
+    # Clients may keep the results, but must revalidate them on every use
+    patch_cache_control(response, no_cache=True)
+    return response
+
+
+@require_safe
+@condition(
+    etag_func=lambda request, pk: _results_etag({pk: results_version(pk)}),
+    last_modified_func=lambda request, pk: _version_time(results_version(pk)),
+)
+def results_json(request, pk):
+    """
+    Return the results of a question as JSON. The ETag and Last-Modified
+    headers come from the question's results version, so a conditional
+    GET is answered with 304 Not Modified without any database query.
+    """
+    question = get_object_or_404(Question.objects.is_published(), pk=pk)
+    return _json_results_response(_results_data(question, get_tallies(question)))
+
+
+def _bulk_results_etag(request):
+    ids = _bulk_result_ids(request)
+    return _results_etag(results_versions(ids)) if ids else None
+
+
+def _bulk_results_last_modified(request):
+    ids = _bulk_result_ids(request)
+    return _version_time(max(results_versions(ids).values())) if ids else None
+
+
+@require_safe
+@condition(etag_func=_bulk_results_etag, last_modified_func=_bulk_results_last_modified)
+def bulk_results_json(request):
+    """
+    Return the results of the questions listed by the comma-separated
+    `ids` parameter as JSON, counting the votes missing from the cache in
+    one query. Conditional GETs work like they do for results_json().
+    """
+    ids = _bulk_result_ids(request)
+    if ids is None:
+        return JsonResponse({'error': f"Pass 1 to {MAX_BULK_RESULTS} comma-separated "
+                                      f"question ids as the 'ids' parameter."},
+                            status=400)
+    questions = Question.objects.is_published().in_bulk(ids)
+    tallies = get_tallies_many(list(questions))
+    return _json_results_response({
+        'results': [_results_data(questions[pk], tallies[pk])
+                    for pk in ids if pk in questions],
+        'not_found': [pk for pk in ids if pk not in questions],
+    })
+
+
+# Most buckets a vote trend reports on in one request
+MAX_TREND_BUCKETS = 1440
+
+
+@require_safe
+def trend_json(request, pk):
+    """
+    Return how the votes of a question moved, as JSON: the net votes each
+    choice gained per `minute` or `hour` (the `resolution` parameter) in
+    the last `buckets` buckets, with a sparkline of each. It is read from
+    the vote rollups only, so it costs the same however many votes came in.
+    """
+    name = request.GET.get('resolution', 'minute')
+    try:
+        buckets = int(request.GET.get('buckets', 60))
+    except ValueError:
+        buckets = 0
+    if name not in RESOLUTIONS or not 1 <= buckets <= MAX_TREND_BUCKETS:
+        return JsonResponse({'error': f"Pass a resolution of {' or '.join(RESOLUTIONS)} and "
+                                      f"1 to {MAX_TREND_BUCKETS} buckets."},
+                            status=400)
+    question = get_object_or_404(Question.objects.is_published(), pk=pk)
+    trend = get_trend(question, RESOLUTIONS[name], buckets)
+    choices = []
+    for choice_id, choice_text in question.choice_set.order_by('pk').values_list('pk', 'choice_text'):
+        votes = trend['votes'].get(choice_id, [0] * buckets)
+        choices.append({'id': choice_id, 'choice_text': choice_text,
+                        'votes': votes, 'sparkline': sparkline(votes)})
+    return _json_results_response({
+        'id': question.pk,
+        'resolution': name,
+        'buckets': trend['buckets'],
+        'choices': choices,
+    })
+
+
+async def results_stream(request, pk):
+    """
+    Stream the live results of a question as Server-Sent Events: the full
+    tallies first, then the changed tallies whenever votes come in. Serve
+    it under ASGI (mysite.asgi), where idle streams don't hold a thread;
+    under WSGI the stream answers 204, which tells browsers not to retry.
+    """
+    if not isinstance(request, ASGIRequest):
+        return HttpResponse(status=204)
+    if not await Question.objects.is_published().filter(pk=pk).aexists():
+        raise Http404("No question found matching the query.")
+    response = StreamingHttpResponse(results_events(pk), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+@require_safe
+def metrics(request):
+    """Serve the request metrics of this process, if POLLS_METRICS_ENABLED."""
+    if not settings.POLLS_METRICS_ENABLED:
+        raise Http404("Metrics are disabled.")
+    return HttpResponse(render_metrics(), content_type='text/plain; version=0.0.4; charset=utf-8')
 
 
 def get_client_ip(request):
@@ -107,53 +380,195 @@ def vote(request, question_id):
     """
     Handling voting for a specific question.
     """
-    question = get_object_or_404(Question, pk=question_id)
+    question = Question.objects.filter(pk=question_id).first()
+    if question is None or not question.can_vote():
+        messages.error(request, "Voting on this question is currently not allowed.")
+        return HttpResponseRedirect(reverse('polls:index'))
     this_user = request.user
     ip_address = get_client_ip(request)
 
     try:
         selected_choice = question.choice_set.get(pk=request.POST['choice'])
     except (KeyError, Choice.DoesNotExist):
-        logger.warning(f"{this_user} failed to vote in {question} from {ip_address}")
+        logger.warning("%s failed to vote in %s from %s", this_user, question, ip_address,
+                       extra=vote_log_fields(this_user, question, None, ip_address, 'vote_failed'))
         # Redisplay the question voting form.
         return render(request, 'polls/detail.html', {
             'question': question,
+            'choices': question.choice_set.all(),
             'error_message': "You didn't select a choice.",
         })
 
     # Reference to the current user
     this_user = request.user
 
-    # Get the user's vote
-    try:
-        vote = Vote.objects.get(user=this_user, choice__question=question)
-        # user has a vote for this question! Update his vote
-        vote.choice = selected_choice
-        vote.save()
+    # Record the vote, replacing the user's earlier vote on this question.
+    # Under load it is queued and written later by flush_vote_journal;
+    # written directly, it replaces the user's queued votes on the question.
+    if queue_accepting():
+        previous_choice_id = get_user_votes(this_user).get(question.id)
+        enqueue_vote(this_user, selected_choice)
+    else:
+        previous_choice_id = cast_vote(this_user, selected_choice)
+        discard_pending([(this_user.pk, question.id)])
+        invalidate_results(question.id)
+        transaction.on_commit(lambda: get_broadcaster().notify(question.id))
+    remember_vote(this_user, question.id, selected_choice.id)
 
-        logger.info(f'{this_user} voted for Choice {selected_choice.id} in Question {question.id} from {ip_address}')
-        messages.success(request, f"Your vote was changed to '{selected_choice.choice_text}'")
-    except Vote.DoesNotExist:
-        # does not have a vote
-        vote = Vote.objects.create(user=this_user, choice=selected_choice)
-        # automatically saved
+    if previous_choice_id is None:
         messages.success(request, f"You voted for '{selected_choice.choice_text}'")
+    else:
+        logger.info("%s voted for Choice %s in Question %s from %s",
+                    this_user, selected_choice.id, question.id, ip_address,
+                    extra=vote_log_fields(this_user, question, selected_choice, ip_address, 'vote_changed'))
+        messages.success(request, f"Your vote was changed to '{selected_choice.choice_text}'")
 
-        # Always return an HttpResponseRedirect after successfully dealing
-        # with POST data. This prevents data from being posted twice if a
-        # user hits the Back button.
+    # Always return an HttpResponseRedirect after successfully dealing
+    # with POST data. This prevents data from being posted twice if a
+    # user hits the Back button.
     return HttpResponseRedirect(reverse('polls:results', args=(question.id,)))
 
 
+# Most votes taken by one batch vote request
+MAX_BATCH_VOTES = 5000
+
+
+def _parse_batch(request):
+    """Return the list of vote records in the request body, or None if it isn't one."""
+    try:
+        records = json.loads(request.body)['votes']
+    except (ValueError, TypeError, KeyError):
+        return None
+    if not isinstance(records, list) or not 1 <= len(records) <= MAX_BATCH_VOTES:
+        return None
+    return records
+
+
+def _check_batch(records):
+    """
+    Validate vote records with one query for their users and one for their
+    choices and questions. Returns a list with a (user_id, question_id, choice_id) tuple
+    for each valid record and an error message for each invalid one.
+    """
+    def field(record, name, kind):
+        value = record.get(name) if isinstance(record, dict) else None
+        return value if isinstance(value, kind) and not isinstance(value, bool) else None
+
+    usernames = {field(record, 'user', str) for record in records} - {None}
+    choice_ids = {field(record, 'choice', int) for record in records} - {None}
+    user_ids = dict(User.objects.filter(username__in=usernames, is_active=True)
+                    .values_list('username', 'pk'))
+    choice_questions = {pk: Question(pk=question_id, pub_date=pub_date, end_date=end_date)
+                        for pk, question_id, pub_date, end_date
+                        in Choice.objects.filter(pk__in=choice_ids).values_list(
+                            'pk', 'question_id', 'question__pub_date', 'question__end_date')}
+
+    checked = []
+    for record in records:
+        username = field(record, 'user', str)
+        question_id = field(record, 'question', int)
+        choice_id = field(record, 'choice', int)
+        if username is None or question_id is None or choice_id is None:
+            checked.append("Each vote needs a user name and question and choice ids.")
+        elif username not in user_ids:
+            checked.append(f"No active user named {username!r}.")
+        elif (question := choice_questions.get(choice_id)) is None or question.pk != question_id:
+            checked.append("The choice is not a choice of the question.")
+        elif not question.can_vote():
+            checked.append("Voting on this question is currently not allowed.")
+        else:
+            checked.append((user_ids[username], question_id, choice_id))
+    return checked
+
+
+@require_POST
+def batch_vote(request):
+    """
+    Record a batch of votes, like the ones a polling kiosk collects
+    offline, for users with the polls.add_vote permission. The body is
+    JSON: {"votes": [{"user": <user name>, "question": <id>, "choice": <id>}]}.
+
+    The records are validated together and the valid ones recorded in one
+    transaction, each replacing the user's earlier vote on the question;
+    a later record of the same user on the same question replaces an
+    earlier one. The response has the status of each record, in order.
+    """
+    if not request.user.is_authenticated:
+        return JsonResponse({'error': "Log in to upload votes."}, status=401)
+    if not request.user.has_perm('polls.add_vote'):
+        return JsonResponse({'error': "You may not upload votes."}, status=403)
+    records = _parse_batch(request)
+    if records is None:
+        return JsonResponse({'error': f"Post a JSON object with a 'votes' list of 1 to "
+                                      f"{MAX_BATCH_VOTES} votes."},
+                            status=400)
+
+    checked = _check_batch(records)
+    votes = [vote for vote in checked if isinstance(vote, tuple)]
+    previous = cast_votes(votes)
+    discard_pending({(user_id, question_id) for user_id, question_id, _ in votes})
+    for question_id in {question_id for _, question_id, _ in votes}:
+        invalidate_results(question_id)
+        transaction.on_commit(lambda question_id=question_id: get_broadcaster().notify(question_id))
+    forget_user_votes_many({user_id for user_id, _, _ in votes})
+
+    # The last record of each user and question is the one recorded
+    last = {}
+    for index, vote in enumerate(checked):
+        if isinstance(vote, tuple):
+            last[vote[:2]] = index
+    results = []
+    for index, vote in enumerate(checked):
+        if not isinstance(vote, tuple):
+            results.append({'status': 'rejected', 'error': vote})
+            continue
+        user_id, question_id, choice_id = vote
+        previous_choice_id = previous[(user_id, question_id)]
+        if last[(user_id, question_id)] != index:
+            results.append({'status': 'replaced'})
+        elif previous_choice_id is None:
+            results.append({'status': 'created'})
+        elif previous_choice_id == choice_id:
+            results.append({'status': 'unchanged'})
+        else:
+            results.append({'status': 'changed', 'previous_choice': previous_choice_id})
+    logger.info("%s uploaded %d votes, %d rejected", request.user, len(votes),
+                len(records) - len(votes),
+                extra={'event': 'batch_vote', 'user': request.user.get_username(),
+                       'votes': len(votes), 'rejected': len(records) - len(votes)})
+    return JsonResponse({'results': results})
+
+
+def vote_log_fields(user, question, choice, ip_address, event):
+    """
+    Return the structured fields of a vote log record. Failed votes are
+    rate limited per address.
+    """
+    fields = {
+        'event': event,
+        'user': user.get_username(),
+        'question': question.id,
+        'choice': choice.id if choice else None,
+        'ip': ip_address,
+    }
+    if event == 'vote_failed':
+        fields['rate_limit_key'] = f'vote_failed:{ip_address}'
+    return fields
+
+
 def log_user_activity(action, user=None, request=None):
     """
     Helper function to log user activities like login, logout, and login failures.
+    Login failures are rate limited per address.
     """
     ip_address = get_client_ip(request) if request else 'Unknown IP'
+    fields = {'event': action.replace(' ', '_'), 'ip': ip_address}
     if user:
-        logger.info(f'{user} {action} from {ip_address}')
+        logger.info("%s %s from %s", user, action, ip_address,
+                    extra={**fields, 'user': user.get_username()})
     else:
-        logger.warning(f'{action} from {ip_address}')
+        logger.warning("%s from %s", action, ip_address,
+                       extra={**fields, 'rate_limit_key': f'{action}:{ip_address}'})
 
 
 @receiver(user_logged_in)
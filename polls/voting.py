@@ -0,0 +1,250 @@
+"""Recording votes.
+
+A user has at most one vote per question, enforced by a unique
+(user, question) constraint on Vote. Casting a vote is an upsert on that
+constraint: on PostgreSQL it is a single INSERT ... ON CONFLICT DO UPDATE
+round trip, which also stays correct when the same user votes twice at
+the same time. When the vote counters or trends are kept, the previous
+choice has to be exact even then, so the user's vote row is locked first.
+
+The votes of each user are also cached as a {question_id: choice_id} map,
+so pages can show which polls a user voted on without querying per poll.
+Votes still waiting in the ingestion journal (see polls.ingest) are
+merged into the map, so users see their own votes before they are flushed.
+"""
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.utils import timezone
+
+from . import counters, ingest, trends
+from .models import Vote, VoteRollup
+
+
+def cast_vote(user, choice):
+    """
+    Record `user`'s vote for `choice`, replacing any earlier vote of the
+    user on the same question.
+
+    Returns the id of the previously chosen choice, or None if this is
+    the user's first vote on the question.
+    """
+    now = timezone.now()
+    if (connection.vendor == 'postgresql' and not counters.counters_enabled()
+            and not trends.trends_enabled()):
+        return _upsert_postgresql(user.pk, choice, now)
+    with transaction.atomic():
+        if connection.vendor == 'postgresql':
+            previous_choice_id = _upsert_postgresql_exact(user.pk, choice, now)
+        else:
+            previous_choice_id = _upsert(user.pk, choice, now)
+        change = (choice.question_id, previous_choice_id, choice.pk)
+        counters.record_vote_changes([change])
+        trends.record_vote_changes([change], now)
+    return previous_choice_id
+
+
+def cast_votes(votes):
+    """
+    Record many votes in one transaction, given as (user_id, question_id,
+    choice_id) tuples whose choices belong to their questions. A later vote
+    of a user on a question replaces an earlier one.
+
+    A vote may carry the time it was cast as a fourth item, for votes
+    written after the fact like journaled ones. Such a vote is skipped if
+    the user's vote on the question changed after it was cast, so that it
+    can't undo a newer vote.
+
+    Returns a {(user_id, question_id): previous_choice_id} dict, with None
+    for a user's first vote on a question.
+    """
+    now = timezone.now()
+    latest = {}
+    for user_id, question_id, choice_id, *cast_at in votes:
+        latest[(user_id, question_id)] = (choice_id, cast_at[0] if cast_at else None)
+    if not latest:
+        return {}
+    with transaction.atomic():
+        existing = Vote.objects.select_for_update().filter(
+            user_id__in={user_id for user_id, _ in latest},
+            question_id__in={question_id for _, question_id in latest},
+        ).values_list('user_id', 'question_id', 'choice_id', 'changed_at')
+        existing = {(user_id, question_id): (choice_id, changed_at)
+                    for user_id, question_id, choice_id, changed_at in existing}
+        previous = {key: existing[key][0] if key in existing else None for key in latest}
+        latest = {key: (choice_id, cast_at or now) for key, (choice_id, cast_at) in latest.items()
+                  if cast_at is None or key not in existing or cast_at >= existing[key][1]}
+        Vote.objects.bulk_create(
+            [Vote(user_id=user_id, question_id=question_id, choice_id=choice_id,
+                  cast_at=cast_at, changed_at=cast_at)
+             for (user_id, question_id), (choice_id, cast_at) in latest.items()
+             if previous[(user_id, question_id)] != choice_id],
+            update_conflicts=True,
+            unique_fields=['user', 'question'],
+            update_fields=['choice', 'changed_at'],
+            batch_size=1000,
+        )
+        changes = {}
+        for (user_id, question_id), (choice_id, cast_at) in latest.items():
+            minute = trends.bucket_start(cast_at, VoteRollup.MINUTE)
+            changes.setdefault(minute, []).append(
+                (question_id, previous[(user_id, question_id)], choice_id))
+        counters.record_vote_changes([change for group in changes.values() for change in group])
+        for minute, group in changes.items():
+            trends.record_vote_changes(group, minute)
+    return previous
+
+
+# The upsert is a raw SQL statement, which has no async ORM equivalent
+acast_vote = sync_to_async(cast_vote)
+
+
+_UPSERT_SQL = """
+    WITH previous AS (
+        SELECT {choice} FROM {vote} WHERE {user} = %s AND {question} = %s FOR UPDATE
+    )
+    INSERT INTO {vote} ({user}, {question}, {choice}, {cast_at}, {changed_at})
+    VALUES (%s, %s, %s, %s, %s)
+    ON CONFLICT ({user}, {question})
+    DO UPDATE SET {choice} = EXCLUDED.{choice}, {changed_at} = EXCLUDED.{changed_at}
+    RETURNING (SELECT {choice} FROM previous)
+"""
+
+_LOCK_SQL = """
+    SELECT {choice} FROM {vote} WHERE {user} = %s AND {question} = %s FOR UPDATE
+"""
+
+_UPDATE_SQL = """
+    UPDATE {vote} SET {choice} = %s, {changed_at} = %s WHERE {user} = %s AND {question} = %s
+"""
+
+_INSERT_SQL = """
+    INSERT INTO {vote} ({user}, {question}, {choice}, {cast_at}, {changed_at})
+    VALUES (%s, %s, %s, %s, %s)
+    ON CONFLICT ({user}, {question}) DO NOTHING
+    RETURNING 1
+"""
+
+
+def _vote_sql(sql):
+    qn = connection.ops.quote_name
+    return sql.format(
+        vote=qn(Vote._meta.db_table),
+        user=qn(Vote._meta.get_field('user').column),
+        question=qn(Vote._meta.get_field('question').column),
+        choice=qn(Vote._meta.get_field('choice').column),
+        cast_at=qn(Vote._meta.get_field('cast_at').column),
+        changed_at=qn(Vote._meta.get_field('changed_at').column),
+    )
+
+
+def _upsert_postgresql(user_id, choice, now):
+    """
+    Upsert the vote and read the previous choice in one statement. When
+    the same user votes twice at once, the previous choice may be missed,
+    so only use it where an approximate answer will do.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(_vote_sql(_UPSERT_SQL), [user_id, choice.question_id,
+                                                user_id, choice.question_id, choice.pk, now, now])
+        return cursor.fetchone()[0]
+
+
+def _upsert_postgresql_exact(user_id, choice, now):
+    """
+    Upsert the vote with its row locked, so the previous choice is exact
+    even when the same user votes twice at once; call inside a
+    transaction. Either the existing vote is locked and updated, or the
+    new one inserted; if a concurrent vote inserted it first, the insert
+    does nothing and the now committed vote is locked and updated.
+    """
+    with connection.cursor() as cursor:
+        while True:
+            cursor.execute(_vote_sql(_LOCK_SQL), [user_id, choice.question_id])
+            row = cursor.fetchone()
+            if row is not None:
+                cursor.execute(_vote_sql(_UPDATE_SQL),
+                               [choice.pk, now, user_id, choice.question_id])
+                return row[0]
+            cursor.execute(_vote_sql(_INSERT_SQL),
+                           [user_id, choice.question_id, choice.pk, now, now])
+            if cursor.fetchone() is not None:
+                return None
+
+
+def _upsert(user_id, choice, now):
+    """Upsert the vote on other databases; call inside a transaction."""
+    previous_choice_id = Vote.objects.select_for_update() \
+        .filter(user_id=user_id, question_id=choice.question_id) \
+        .values_list('choice_id', flat=True).first()
+    Vote.objects.bulk_create(
+        [Vote(user_id=user_id, question_id=choice.question_id, choice=choice,
+              cast_at=now, changed_at=now)],
+        update_conflicts=True,
+        unique_fields=['user', 'question'],
+        update_fields=['choice', 'changed_at'],
+    )
+    return previous_choice_id
+
+
+def _user_votes_key(user_id):
+    return f'polls:user-votes:{user_id}'
+
+
+def get_user_votes(user):
+    """
+    Return a {question_id: choice_id} map of all votes of `user`, loaded
+    with one query and then served from the cache.
+    """
+    key = _user_votes_key(user.pk)
+    user_votes = cache.get(key)
+    if user_votes is None:
+        user_votes = dict(Vote.objects.filter(user_id=user.pk)
+                          .values_list('question_id', 'choice_id'))
+        cache.set(key, user_votes, settings.POLLS_USER_VOTES_CACHE_TIMEOUT)
+    if ingest.queue_enabled():
+        user_votes = {**user_votes, **ingest.pending_votes(user)}
+    return user_votes
+
+
+async def aget_user_votes(user):
+    """Async version of get_user_votes(), loading the map with the async ORM."""
+    key = _user_votes_key(user.pk)
+    user_votes = await cache.aget(key)
+    if user_votes is None:
+        user_votes = {question_id: choice_id async for question_id, choice_id
+                      in Vote.objects.filter(user_id=user.pk)
+                      .values_list('question_id', 'choice_id')}
+        await cache.aset(key, user_votes, settings.POLLS_USER_VOTES_CACHE_TIMEOUT)
+    if ingest.queue_enabled():
+        user_votes = {**user_votes, **await sync_to_async(ingest.pending_votes)(user)}
+    return user_votes
+
+
+def remember_vote(user, question_id, choice_id):
+    """Record a vote just cast by `user` in their cached vote map."""
+    key = _user_votes_key(user.pk)
+    user_votes = cache.get(key)
+    if user_votes is not None:
+        user_votes[question_id] = choice_id
+        cache.set(key, user_votes, settings.POLLS_USER_VOTES_CACHE_TIMEOUT)
+
+
+async def aremember_vote(user, question_id, choice_id):
+    """Async version of remember_vote()."""
+    key = _user_votes_key(user.pk)
+    user_votes = await cache.aget(key)
+    if user_votes is not None:
+        user_votes[question_id] = choice_id
+        await cache.aset(key, user_votes, settings.POLLS_USER_VOTES_CACHE_TIMEOUT)
+
+
+def forget_user_votes(user_id):
+    """Drop the cached vote map of a user, to be reloaded on next use."""
+    cache.delete(_user_votes_key(user_id))
+
+
+def forget_user_votes_many(user_ids):
+    """Drop the cached vote maps of many users at once."""
+    cache.delete_many([_user_votes_key(user_id) for user_id in user_ids])